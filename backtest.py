@@ -0,0 +1,29 @@
+import numpy as np
+
+# VECTORIZED EQUITY CURVE BACKTEST
+# ----------------------------------------------------------------------------------------------------------------------
+# Buy and hold: the starting capital is split between the assets according to the weights and every asset position
+# compounds with its own daily returns. The value of a position at day t is capital * w_i * prod(daily returns up to t),
+# so the equity curves of k weight vectors are one cumulative product followed by one matrix product:
+#   curves = growth (days+1 x n_assets) @ (capital * W).T (n_assets x k)
+
+
+def growth_matrix(daily_returns):
+    # cumulative growth of 1 unit invested in every asset, first row is the starting point (all ones)
+    # daily_returns: (days x n_assets) ratios of price(t) / price(t-1), as returned by calculate_return
+    daily_returns = np.asarray(daily_returns, dtype=np.float64)
+    if daily_returns.ndim == 1:
+        daily_returns = daily_returns[:, None]
+    growth = np.empty((len(daily_returns) + 1, daily_returns.shape[1]))
+    growth[0] = 1.0
+    np.cumprod(daily_returns, axis=0, out=growth[1:])
+    return growth
+
+
+def equity_curves(daily_returns, weights, start_capital):
+    # portfolio value over time for every weight vector.
+    # weights: (n_assets,) for a single portfolio or (k x n_assets) for k portfolios
+    # returns (days+1,) for a single portfolio or (days+1 x k)
+    weights = np.asarray(weights, dtype=np.float64)
+    curves = growth_matrix(daily_returns) @ (start_capital * np.atleast_2d(weights)).T
+    return curves[:, 0] if weights.ndim == 1 else curves
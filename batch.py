@@ -0,0 +1,127 @@
+import argparse
+import datetime as dt
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import engine
+from constraints import WeightConstraints
+from universe import shared_universe
+
+# BATCH COMMAND LINE TOOL
+# ----------------------------------------------------------------------------------------------------------------------
+# Runs the headless engine for many baskets in parallel across a process pool and writes one result per basket.
+#
+#   python batch.py baskets.jsonl --out results/ --workers 8
+#
+# The input file has one JSON object per line, only "tickers" is required:
+#   {"name": "tech", "tickers": ["AAPL", "MSFT"], "start": "2015-01-01", "end": "2022-01-01",
+#    "num_portfolios": 50000, "method": "exact", "seed": 1, "sampler": "sparse", "tol": 0.001,
+#    "walk_forward": "Monthly", "lookback": 1, "workers": 1, "covariance": "ledoit_wolf", "factors": 10,
+#    "risk_confidence": 0.95, "min_weight": 0.02, "max_weight": 0.3, "class_max": {"crypto": 0.1},
+#    "num_resamples": 500, "block_size": 21}
+# "method" is "monte_carlo", "exact" or "resampled" (exact portfolios averaged over "num_resamples" block bootstrap
+# resamples of "block_size" days, with a 5% - 95% band of every weight).
+# "workers" > 1 runs the monte carlo / resampling stage of one basket on its own process pool (for very large runs),
+# "covariance" is "sample", "ledoit_wolf" or "factor" (k = "factors" principal components, for large baskets).
+# "risk_confidence" (e.g. 0.95) adds the historical VaR / CVaR, max drawdown and Sortino ratio of the optimal
+# portfolios and the min CVaR and max return / CVaR portfolios of the simulation.
+# "min_weight" / "max_weight" bound the weight of every asset, "class_min" / "class_max" the total weight of an asset
+# class ("stock", "etf" or "crypto", looked up in the ticker universe), see constraints.py.
+# For every basket <out>/<name>.json holds the optimal weights and statistics and <out>/<name>_equity.csv the
+# equity curves. Set MPT_PRICE_FIXTURES to run offline from local price files, set MPT_INSTRUMENTATION to append the
+# timing and memory of every stage of every basket to .metrics/spans.jsonl (see instrumentation.py).
+
+DEFAULT_START_DATE = dt.date(2015, 1, 1)
+
+
+def read_baskets(path):
+    baskets = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            basket = json.loads(line)
+            basket.setdefault("name", f"basket_{line_number}")
+            baskets.append(basket)
+    return baskets
+
+
+def basket_constraints(basket):
+    # WeightConstraints of a basket, None when it has no weight constraint keys
+    if not any(key in basket for key in ("min_weight", "max_weight", "class_min", "class_max")):
+        return None
+    tickers = basket["tickers"]
+    if "class_min" in basket or "class_max" in basket:
+        universe = shared_universe()
+        asset_classes = [universe.asset_class(ticker) for ticker in tickers]
+    else:
+        asset_classes = ["all"] * len(tickers)
+    return WeightConstraints.for_asset_classes(asset_classes, float(basket.get("min_weight", 0.0)),
+                                               float(basket.get("max_weight", 1.0)), basket.get("class_min"),
+                                               basket.get("class_max"))
+
+
+def run_one(basket, out_dir):
+    # worker entry point: run one basket and write its results, returns (name, error message or None)
+    name = basket["name"]
+    try:
+        result = engine.run_basket(
+            basket["tickers"],
+            dt.date.fromisoformat(basket.get("start", DEFAULT_START_DATE.isoformat())),
+            dt.date.fromisoformat(basket.get("end", dt.date.today().isoformat())),
+            num_portfolios=int(basket.get("num_portfolios", 50000)),
+            method=basket.get("method", engine.MONTE_CARLO),
+            seed=basket.get("seed"),
+            sampler=basket.get("sampler", engine.UNIFORM),
+            tol=basket.get("tol"),
+            workers=int(basket.get("workers", 1)),
+            covariance=basket.get("covariance", engine.SAMPLE),
+            num_factors=int(basket.get("factors", engine.DEFAULT_NUM_FACTORS)),
+            walk_forward_frequency=basket.get("walk_forward"),
+            walk_forward_lookback=int(basket.get("lookback", 1)),
+            risk_confidence=basket.get("risk_confidence"),
+            constraints=basket_constraints(basket),
+            num_resamples=int(basket.get("num_resamples", engine.DEFAULT_NUM_RESAMPLES)),
+            block_size=int(basket.get("block_size", engine.DEFAULT_BLOCK_SIZE)),
+        )
+        with open(os.path.join(out_dir, f"{name}.json"), "w") as f:
+            json.dump(engine.summarise(result), f, indent=2)
+        result["equity_curves"].to_csv(os.path.join(out_dir, f"{name}_equity.csv"), index_label="Date")
+        if "walk_forward_curves" in result:
+            result["walk_forward_curves"].to_csv(os.path.join(out_dir, f"{name}_walk_forward.csv"))
+        return name, None
+    except Exception:
+        return name, traceback.format_exc()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run portfolio optimisations for many baskets in parallel.")
+    parser.add_argument("baskets", help="JSON lines file, one basket per line")
+    parser.add_argument("--out", default="results", help="output directory (default: results)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    baskets = read_baskets(args.baskets)
+    os.makedirs(args.out, exist_ok=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(run_one, basket, args.out) for basket in baskets]
+        for future in as_completed(futures):
+            name, error = future.result()
+            if error is None:
+                print(f"{name}: done")
+            else:
+                failed += 1
+                print(f"{name}: failed\n{error}", file=sys.stderr)
+
+    print(f"{len(baskets) - failed}/{len(baskets)} baskets written to {args.out}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import engine
+from distribution import return_distribution
+from constraints import WeightConstraints
+from risk import HistoricalRisk
+from price_cache import PriceCache
+from price_store import PriceStore
+from benchmarks.synthetic import SyntheticProvider
+
+# PIPELINE BENCHMARK SUITE
+# ----------------------------------------------------------------------------------------------------------------------
+# Times every pipeline stage on synthetic market data (no network) and records its peak allocated memory:
+#
+#   python -m benchmarks.run --out bench.json                  # full sweeps
+#   python -m benchmarks.run --quick --out bench.json          # small sweeps, for a quick check
+#   python -m benchmarks.run --compare old.json --out new.json # print the speed-up against an earlier run
+#
+# Each sweep varies one dimension (number of assets, years of history, number of portfolios) around the base case.
+# Wall time is the best of --repeat runs without tracing, peak memory comes from one extra run under tracemalloc.
+
+BASE_CASE = {"n_assets": 10, "years": 10, "num_portfolios": 100000}
+SWEEPS = {
+    "n_assets": [2, 5, 10, 20, 50, 100, 200, 500],
+    "years": [1, 2, 5, 10, 20, 30],
+    "num_portfolios": [10000, 50000, 100000, 500000, 1000000, 5000000],
+}
+QUICK_SWEEPS = {
+    "n_assets": [2, 10, 50],
+    "years": [1, 10],
+    "num_portfolios": [10000, 100000],
+}
+# cases whose simulated weight matrix would need more memory than this are skipped
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+# resamples of the resampled frontier stage, skipped above this many assets (two QPs per resample)
+BENCH_RESAMPLES = 100
+MAX_RESAMPLED_ASSETS = 100
+
+
+def build_chart(p_sd, p_mean):
+    # the monte carlo chart: density raster and hull, drawn with matplotlib when it is installed
+    from rendering import density_raster, efficient_hull
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        from rendering import plot_portfolio_density
+    except ImportError:
+        density_raster(p_sd, p_mean)
+        efficient_hull(p_sd, p_mean)
+        return
+    fig, ax = plt.subplots(figsize=(10, 6))
+    plot_portfolio_density(ax, p_sd, p_mean)
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def measure(fn, repeat):
+    # (best wall time, all wall times, cpu time of the best run, peak traced bytes, result)
+    walls = []
+    cpus = []
+    result = None
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = fn()
+        cpus.append(time.process_time() - cpu)
+        walls.append(time.perf_counter() - wall)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = int(np.argmin(walls))
+    return {"wall_s": walls[best], "wall_s_all": walls, "cpu_s": cpus[best], "peak_bytes": peak}, result
+
+
+def run_case(n_assets, years, num_portfolios, repeat, seed):
+    provider = SyntheticProvider(n_assets, years, seed)
+    tickers = provider.tickers
+    start = provider.prices.index[0].date()
+    end = provider.prices.index[-1].date() + dt.timedelta(days=1)
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def dataset_cold():
+            # empty disk cache: every ticker goes through the provider
+            for name in os.listdir(cache_dir):
+                for file_name in os.listdir(os.path.join(cache_dir, name)):
+                    os.remove(os.path.join(cache_dir, name, file_name))
+            return engine.get_dataset(PriceStore(PriceCache(provider, cache_dir)), tickers, start, end)
+
+        def dataset_warm():
+            # everything is in the disk cache already
+            return engine.get_dataset(PriceStore(PriceCache(provider, cache_dir)), tickers, start, end)
+
+        stages["dataset_cold"], _ = measure(dataset_cold, repeat)
+        stages["dataset_warm"], dataset = measure(dataset_warm, repeat)
+        store = PriceStore(PriceCache(provider, cache_dir))
+        engine.get_dataset(store, tickers, start, end)
+
+        stages["get_normalised_daily_return"], log_returns = measure(
+            lambda: engine.get_normalised_daily_return(dataset), repeat)
+        stages["return_distribution"], _ = measure(lambda: return_distribution(log_returns), repeat)
+        stages["annualised_mean_covariance"], (mean, cov) = measure(
+            lambda: engine.annualised_mean_covariance(log_returns), repeat)
+        stages["generate_random_portfolios"], (weights, p_mean, p_sd) = measure(
+            lambda: engine.generate_random_portfolios(mean, cov, num_portfolios, seed=seed), repeat)
+        stages["calculate_portfolio_max_sharpe_min_risk"], optimal = measure(
+            lambda w=weights: engine.calculate_portfolio_max_sharpe_min_risk(w, p_mean, p_sd), repeat)
+        # the weight matrix is the largest array of the case, released before the next stages are measured
+        del weights
+        # streaming reduction (only the best portfolios, envelope and reservoir sample are kept), in process and
+        # on a process pool over every core (memory of the workers is not traced)
+        stages["reduce_random_portfolios"], _ = measure(
+            lambda: engine.reduce_random_portfolios(mean, cov, num_portfolios, seed=seed), repeat)
+        # with the historical VaR / CVaR, drawdown and sortino ratio of every portfolio (see risk.py)
+        risk = HistoricalRisk.from_log_returns(log_returns)
+        stages["reduce_random_portfolios_tail_risk"], _ = measure(
+            lambda: engine.reduce_random_portfolios(mean, cov, num_portfolios, seed=seed, risk=risk), repeat)
+        # hit-and-run inside two asset classes whose caps (60% / 40%) pin both class totals once the weights sum to
+        # 100%, a chain that never leaves its start point would give one identical portfolio
+        if n_assets >= 4:
+            constraints = WeightConstraints.for_asset_classes(
+                ["stock"] * (n_assets - n_assets // 2) + ["etf"] * (n_assets // 2),
+                class_upper={"stock": 0.6, "etf": 0.4})
+            stages["reduce_random_portfolios_constrained"], reducer = measure(
+                lambda: engine.reduce_random_portfolios(mean, cov, num_portfolios, seed=seed,
+                                                        constraints=constraints), repeat)
+            if np.ptp(reducer.reservoir_sd) == 0:
+                raise RuntimeError("constrained simulation returned identical portfolios")
+        stages["reduce_random_portfolios_parallel"], _ = measure(
+            lambda: engine.reduce_random_portfolios(mean, cov, num_portfolios, os.cpu_count(), seed=seed), repeat)
+        stages["calculate_portfolio_max_sharpe_min_risk_exact"], _ = measure(
+            lambda: engine.calculate_portfolio_max_sharpe_min_risk_exact(mean, cov), repeat)
+        # bootstrap averaged optimal portfolios (see resampling.py), one QP pair per resample
+        if n_assets <= MAX_RESAMPLED_ASSETS:
+            stages["calculate_resampled_portfolios"], _ = measure(
+                lambda: engine.calculate_resampled_portfolios(log_returns, mean, cov, BENCH_RESAMPLES,
+                                                              workers=os.cpu_count(), seed=seed), repeat)
+        stages["portfolio_df_benchmark_portfolio"], _ = measure(
+            lambda: engine.equity_curve_frame(store, start, end, tickers, optimal[0], optimal[2]), repeat)
+        stages["chart"], _ = measure(lambda: build_chart(p_sd, p_mean), repeat)
+
+    return stages
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    # print old / new wall time of every stage that exists in both runs
+    def index(run):
+        return {(r["sweep"], r["n_assets"], r["years"], r["num_portfolios"], stage): timing["wall_s"]
+                for r in run["results"] for stage, timing in r.get("stages", {}).items()}
+
+    old = index(baseline)
+    print(f"{'sweep':<15}{'assets':>7}{'years':>6}{'portfolios':>11}  {'stage':<48}{'old s':>10}{'new s':>10}"
+          f"{'speed-up':>10}")
+    for key, new_wall in index(results).items():
+        if key in old:
+            sweep, n_assets, years, num_portfolios, stage = key
+            print(f"{sweep:<15}{n_assets:>7}{years:>6}{num_portfolios:>11}  {stage:<48}{old[key]:>10.4f}"
+                  f"{new_wall:>10.4f}{old[key] / max(new_wall, 1e-12):>9.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic market data.")
+    parser.add_argument("--out", default="bench_output.json", help="JSON results file")
+    parser.add_argument("--quick", action="store_true", help="run the small sweeps only")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (best is reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="skip cases whose simulated weight matrix is larger than this")
+    parser.add_argument("--compare", help="earlier JSON results file to compare against")
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {
+            "created": dt.datetime.now().isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "base_case": BASE_CASE,
+        },
+        "results": [],
+    }
+
+    for sweep, values in (QUICK_SWEEPS if args.quick else SWEEPS).items():
+        for value in values:
+            case = dict(BASE_CASE, **{sweep: value})
+            entry = dict(sweep=sweep, **case)
+            if case["num_portfolios"] * case["n_assets"] * 8 > args.max_bytes:
+                entry["skipped"] = "weight matrix larger than --max-bytes"
+            else:
+                entry["stages"] = run_case(case["n_assets"], case["years"], case["num_portfolios"], args.repeat,
+                                           args.seed)
+            results["results"].append(entry)
+            total = sum(stage["wall_s"] for stage in entry.get("stages", {}).values())
+            print(f"{sweep}={value}: {entry.get('skipped', f'{total:.3f} s')}", flush=True)
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from data_providers import DataProvider
+
+# SYNTHETIC MARKET DATA
+# ----------------------------------------------------------------------------------------------------------------------
+# Correlated daily closing prices from a one factor model (market factor + asset specific noise),
+# reproducible from a seed, so every pipeline stage can be benchmarked without network access.
+
+NUM_TRADING_DAYS = 252
+
+
+def synthetic_prices(n_assets, years, seed=0, start="1990-01-02", ticker_prefix="SYN"):
+    # dataframe of n_assets closing price series over `years` years of business days
+    rng = np.random.default_rng(seed)
+    days = int(years * NUM_TRADING_DAYS)
+    index = pd.bdate_range(start, periods=days, name="Date")
+
+    # daily log returns: beta * market + specific noise, annual drift 2-15%, annual volatility 15-60%
+    beta = rng.uniform(0.5, 1.5, n_assets)
+    drift = rng.uniform(0.02, 0.15, n_assets) / NUM_TRADING_DAYS
+    specific_vol = rng.uniform(0.15, 0.6, n_assets) / np.sqrt(NUM_TRADING_DAYS)
+    market = rng.normal(0.0, 0.16 / np.sqrt(NUM_TRADING_DAYS), (days, 1))
+    log_returns = drift + market * beta + rng.normal(size=(days, n_assets)) * specific_vol
+
+    prices = 100 * np.exp(np.cumsum(log_returns, axis=0))
+    columns = [f"{ticker_prefix}{i}" for i in range(n_assets)]
+    return pd.DataFrame(prices, index=index, columns=columns)
+
+
+class SyntheticProvider(DataProvider):
+    # serves synthetic_prices (plus a synthetic benchmark "SPY") through the data provider interface
+
+    def __init__(self, n_assets, years, seed=0, start="1990-01-02"):
+        self.prices = synthetic_prices(n_assets, years, seed, start)
+        self.prices["SPY"] = synthetic_prices(1, years, seed + 1, start).iloc[:, 0]
+
+    @property
+    def tickers(self):
+        return [ticker for ticker in self.prices.columns if ticker != "SPY"]
+
+    def get_close(self, ticker, start, end):
+        close = self.prices[ticker]
+        return close[(close.index >= pd.Timestamp(start)) & (close.index < pd.Timestamp(end))]
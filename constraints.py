@@ -0,0 +1,122 @@
+import numpy as np
+
+# PORTFOLIO WEIGHT CONSTRAINTS
+# ----------------------------------------------------------------------------------------------------------------------
+# Long-only weights that sum to 1 with, in addition:
+#   - per asset bounds:         lower_i <= w_i <= upper_i
+#   - per group (asset class):  group_lower_g <= sum of the weights of the assets in g <= group_upper_g
+# Every asset belongs to exactly one group. The feasible weights form a convex polytope inside the simplex, it is
+# sampled with a hit-and-run walk (see simulation.py) and optimised over with slack variables (see optimise.py),
+# so no sample is ever rejected.
+
+TOL = 1e-9
+
+
+class WeightConstraints:
+
+    def __init__(self, num_assets, lower=0.0, upper=1.0, groups=None, group_lower=None, group_upper=None,
+                 group_names=None):
+        # groups: group index of every asset (0..num_groups-1), group_lower / group_upper: bounds of every group
+        self.lower = np.clip(np.broadcast_to(np.asarray(lower, dtype=np.float64), (num_assets,)).copy(), 0.0, 1.0)
+        self.upper = np.clip(np.broadcast_to(np.asarray(upper, dtype=np.float64), (num_assets,)).copy(), 0.0, 1.0)
+        self.groups = np.zeros(num_assets, dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+        num_groups = int(self.groups.max()) + 1 if num_assets else 0
+        self.group_lower = np.zeros(num_groups) if group_lower is None else np.asarray(group_lower, dtype=np.float64)
+        self.group_upper = np.ones(num_groups) if group_upper is None else np.asarray(group_upper, dtype=np.float64)
+        self.group_names = list(group_names) if group_names is not None else list(range(num_groups))
+        # (groups x assets) membership matrix
+        self.group_matrix = (self.groups[None, :] == np.arange(num_groups)[:, None]).astype(np.float64)
+        self.check()
+
+    @classmethod
+    def for_asset_classes(cls, asset_classes, lower=0.0, upper=1.0, class_lower=None, class_upper=None):
+        # asset_classes: asset class of every asset (e.g. universe.asset_class of every ticker),
+        # class_lower / class_upper: {asset class: bound} for the classes that are limited
+        names = list(dict.fromkeys(asset_classes))
+        groups = [names.index(asset_class) for asset_class in asset_classes]
+        class_lower, class_upper = class_lower or {}, class_upper or {}
+        return cls(len(asset_classes), lower, upper, groups, [class_lower.get(name, 0.0) for name in names],
+                   [class_upper.get(name, 1.0) for name in names], names)
+
+    def __len__(self):
+        return len(self.lower)
+
+    @property
+    def num_groups(self):
+        return len(self.group_lower)
+
+    def _bounded_group_range(self):
+        # total weight of every group allowed by its own bounds: [max(group lower, sum of lower),
+        # min(group upper, sum of upper)]
+        low = np.maximum(self.group_lower, self.group_matrix @ self.lower)
+        high = np.minimum(self.group_upper, self.group_matrix @ self.upper)
+        return low, high
+
+    def _group_range(self):
+        # reachable total weight of every group once the weights sum to 1: the other groups take at most the sum of
+        # their upper bounds and at least the sum of their lower bounds, [max(low_g, 1 - sum of high_h for h != g),
+        # min(high_g, 1 - sum of low_h for h != g)]. E.g. two classes capped at 60% and 40% are both fixed
+        low, high = self._bounded_group_range()
+        return np.maximum(low, 1 - (high.sum() - high)), np.minimum(high, 1 - (low.sum() - low))
+
+    def check(self):
+        # raise ValueError when no weights satisfy the constraints
+        low, high = self._bounded_group_range()
+        if np.any(self.lower > self.upper + TOL) or np.any(low > high + TOL):
+            raise ValueError("Weight constraints are contradictory: a lower bound is above an upper bound")
+        low, high = self._group_range()
+        if np.any(low > high + TOL):
+            raise ValueError("Weight constraints cannot be met by weights that sum to 100%")
+
+    def is_trivial(self):
+        # True for plain long-only weights (the unconstrained simulation and optimiser are used)
+        return bool(np.all(self.lower <= TOL) and np.all(self.upper >= 1 - TOL) and np.all(self.group_lower <= TOL)
+                    and np.all(self.group_upper >= 1 - TOL))
+
+    def feasible_point(self):
+        # weights that satisfy every constraint, as central as the bounds allow: every group total is placed at the
+        # same fraction of its reachable range, and every asset at the same fraction of its bounds within the group
+        low, high = self._group_range()
+        spread = high.sum() - low.sum()
+        totals = low + (high - low) * ((1 - low.sum()) / spread if spread > TOL else 0.0)
+        lower_sum = self.group_matrix @ self.lower
+        upper_sum = self.group_matrix @ self.upper
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(upper_sum - lower_sum > TOL, (totals - lower_sum) / (upper_sum - lower_sum), 0.0)
+        return self.lower + (self.upper - self.lower) * fraction[self.groups]
+
+    def contains(self, w, tol=1e-7):
+        # True for every row of w that satisfies the constraints
+        w = np.atleast_2d(w)
+        group_sums = w @ self.group_matrix.T
+        return (np.all(w >= self.lower - tol, axis=1) & np.all(w <= self.upper + tol, axis=1)
+                & np.all(group_sums >= self.group_lower - tol, axis=1)
+                & np.all(group_sums <= self.group_upper + tol, axis=1) & (np.abs(w.sum(axis=1) - 1) <= tol))
+
+    def free_blocks(self):
+        # block index of every asset for the directions of the hit-and-run walk: assets fixed by their bounds get -1,
+        # the free assets of a group whose total is fixed (by its bounds or by the bounds of the other groups and the
+        # total of 1) form their own block (weight only moves inside the group),
+        # all other free assets form block 0 (weight moves between them with a constant total)
+        free = self.upper - self.lower > TOL
+        low, high = self._group_range()
+        fixed_group = (high - low <= TOL)[self.groups]
+        blocks = np.where(fixed_group, self.groups + 1, 0)
+        return np.where(free, blocks, -1)
+
+    def segment(self, w, d):
+        # (t_min, t_max) for every row such that w + t d satisfies the bounds, for directions d with sum 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            to_lower = (self.lower - w) / d
+            to_upper = (self.upper - w) / d
+            group_w = w @ self.group_matrix.T
+            group_d = d @ self.group_matrix.T
+            to_group_lower = (self.group_lower - group_w) / group_d
+            to_group_upper = (self.group_upper - group_w) / group_d
+        t_max = np.minimum(np.where(d > 0, to_upper, np.where(d < 0, to_lower, np.inf)).min(axis=1),
+                           np.where(group_d > TOL, to_group_upper,
+                                    np.where(group_d < -TOL, to_group_lower, np.inf)).min(axis=1, initial=np.inf))
+        t_min = np.maximum(np.where(d > 0, to_lower, np.where(d < 0, to_upper, -np.inf)).max(axis=1),
+                           np.where(group_d > TOL, to_group_lower,
+                                    np.where(group_d < -TOL, to_group_upper, -np.inf)).max(axis=1, initial=-np.inf))
+        return np.minimum(t_min, 0.0), np.maximum(t_max, 0.0)
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+
+# COVARIANCE ESTIMATORS FOR LARGE BASKETS
+# ----------------------------------------------------------------------------------------------------------------------
+# With hundreds of assets and a few years of daily returns the sample covariance is ill-conditioned (its smallest
+# eigenvalues are far too small, so optimisers pile into spurious "riskless" combinations) and the O(n^2) matrix
+# makes every portfolio variance O(n^2). Two alternative estimators:
+#   - Ledoit-Wolf: the sample covariance shrunk towards a scaled identity matrix, the shrinkage intensity is
+#     estimated from the data (Ledoit & Wolf, "A well-conditioned estimator for large-dimensional covariance
+#     matrices", 2004)
+#   - k-factor model: cov = B B' + diag(d) with loadings B (n x k) from the first k principal components of the
+#     returns and specific variances d (n). Stored as B and d only, the variance of portfolio w is
+#     |w B|^2 + sum(w^2 d), O(n k) instead of O(n^2), the dense n x n matrix is never built for the simulation.
+# Missing returns (tickers listed later / delisted) are treated as returns equal to the mean of the ticker.
+
+SAMPLE = "sample"
+LEDOIT_WOLF = "ledoit_wolf"
+FACTOR = "factor"
+ESTIMATORS = (SAMPLE, LEDOIT_WOLF, FACTOR)
+DEFAULT_NUM_FACTORS = 10
+
+
+def _centred(returns):
+    # demeaned returns (T x n) as a float64 array, missing values set to 0 (the column mean)
+    x = np.asarray(returns, dtype=np.float64)
+    x = x - np.nanmean(x, axis=0)
+    return np.where(np.isfinite(x), x, 0.0)
+
+
+def ledoit_wolf_shrinkage(returns):
+    # shrinkage intensity in [0, 1] of the sample covariance towards mu * I, mu = average variance
+    x = _centred(returns)
+    t, n = x.shape
+    s = x.T @ x / t
+    mu = np.trace(s) / n
+    # distance of the sample covariance to the target
+    d2 = ((s - mu * np.eye(n)) ** 2).sum() / n
+    # estimation error of the sample covariance: mean over t of |x_t x_t' - S|^2, expanded so no n x n matrix
+    # per observation is built: |x_t x_t' - S|^2 = |x_t|^4 - 2 x_t' S x_t + |S|^2
+    row_norms = (x * x).sum(axis=1)
+    b2 = ((row_norms ** 2).sum() / t - (s * s).sum()) / (t * n)
+    if d2 <= 0:
+        return 1.0
+    return float(np.clip(b2 / d2, 0.0, 1.0))
+
+
+def ledoit_wolf(returns):
+    # shrunk covariance (same type as returns.cov() for a dataframe), using the unbiased sample covariance
+    x = _centred(returns)
+    shrinkage = ledoit_wolf_shrinkage(returns)
+    sample = x.T @ x / max(len(x) - 1, 1)
+    mu = np.trace(sample) / sample.shape[0]
+    cov = (1 - shrinkage) * sample
+    cov[np.diag_indices_from(cov)] += shrinkage * mu
+    if isinstance(returns, pd.DataFrame):
+        return pd.DataFrame(cov, index=returns.columns, columns=returns.columns)
+    return cov
+
+
+class FactorCovariance:
+    # covariance matrix B B' + diag(d) stored as loadings B (n x k) and specific variances d (n)
+
+    def __init__(self, loadings, specific_variance, columns=None):
+        self.loadings = np.asarray(loadings)
+        self.specific_variance = np.asarray(specific_variance)
+        self.columns = list(columns) if columns is not None else list(range(len(self.specific_variance)))
+
+    @property
+    def shape(self):
+        n = len(self.specific_variance)
+        return n, n
+
+    @property
+    def dtype(self):
+        return self.loadings.dtype
+
+    @property
+    def nbytes(self):
+        return self.loadings.nbytes + self.specific_variance.nbytes
+
+    def __len__(self):
+        return len(self.specific_variance)
+
+    def astype(self, dtype):
+        return FactorCovariance(self.loadings.astype(dtype, copy=False),
+                                self.specific_variance.astype(dtype, copy=False), self.columns)
+
+    def scaled(self, factor):
+        # covariance * factor (e.g. annualising daily covariance)
+        return FactorCovariance(self.loadings * np.sqrt(factor), self.specific_variance * factor, self.columns)
+
+    def subset(self, columns):
+        # covariance of a subset / reordering of the assets
+        position = {column: row for row, column in enumerate(self.columns)}
+        rows = [position[c] for c in columns]
+        return FactorCovariance(self.loadings[rows], self.specific_variance[rows], columns)
+
+    def portfolio_variance(self, w):
+        # variance of every row of the weight matrix w (or of one weight vector), O(rows * n * k)
+        w = np.asarray(w)
+        return ((w @ self.loadings) ** 2).sum(axis=-1) + (w * w) @ self.specific_variance
+
+    def matvec(self, x):
+        # cov . x without the dense matrix
+        return self.loadings @ (self.loadings.T @ x) + self.specific_variance * x
+
+    def diagonal(self):
+        return (self.loadings ** 2).sum(axis=1) + self.specific_variance
+
+    def dense(self):
+        # the n x n matrix (for the exact optimiser and for display)
+        cov = self.loadings @ self.loadings.T
+        cov[np.diag_indices_from(cov)] += self.specific_variance
+        return cov
+
+    def __array__(self, dtype=None, copy=None):
+        cov = self.dense()
+        return cov if dtype is None else cov.astype(dtype, copy=False)
+
+    def to_frame(self):
+        return pd.DataFrame(self.dense(), index=self.columns, columns=self.columns)
+
+
+def _top_singular(x, k, oversample=10, power_iterations=4):
+    # top k singular values and right singular vectors of x (T x n), with a randomized range finder when k is
+    # small compared to the matrix (O(T n k) instead of a full O(T n min(T, n)) svd)
+    if k + oversample >= min(x.shape) // 2:
+        _, singular_values, vt = np.linalg.svd(x, full_matrices=False)
+        return singular_values[:k], vt[:k]
+    rng = np.random.default_rng(0)
+    q, _ = np.linalg.qr(x @ rng.standard_normal((x.shape[1], k + oversample)))
+    for _ in range(power_iterations):
+        q, _ = np.linalg.qr(x.T @ q)
+        q, _ = np.linalg.qr(x @ q)
+    _, singular_values, vt = np.linalg.svd(q.T @ x, full_matrices=False)
+    return singular_values[:k], vt[:k]
+
+
+def factor_model(returns, num_factors=DEFAULT_NUM_FACTORS):
+    # k-factor (PCA) covariance of the returns: loadings from the top k singular vectors of the demeaned returns,
+    # specific variance = sample variance not explained by the factors (kept strictly positive)
+    x = _centred(returns)
+    t, n = x.shape
+    k = int(max(1, min(num_factors, n - 1, t - 1)))
+    singular_values, vt = _top_singular(x, k)
+    loadings = vt.T * (singular_values / np.sqrt(max(t - 1, 1)))
+    variance = (x * x).sum(axis=0) / max(t - 1, 1)
+    specific = variance - (loadings ** 2).sum(axis=1)
+    floor = 1e-6 * max(float(variance.mean()), np.finfo(np.float64).tiny)
+    specific = np.maximum(specific, floor)
+    columns = returns.columns if isinstance(returns, pd.DataFrame) else None
+    return FactorCovariance(loadings, specific, columns)
+
+
+def estimate_covariance(returns, estimator=SAMPLE, num_factors=DEFAULT_NUM_FACTORS):
+    # daily covariance of the returns with one of ESTIMATORS
+    if estimator == SAMPLE:
+        return returns.cov()
+    if estimator == LEDOIT_WOLF:
+        return ledoit_wolf(returns)
+    if estimator == FACTOR:
+        return factor_model(returns, num_factors)
+    raise ValueError(f"Unknown covariance estimator: {estimator}")
+
+
+def scale_covariance(cov, factor):
+    # cov * factor for a dense matrix / dataframe or a factor model
+    return cov.scaled(factor) if isinstance(cov, FactorCovariance) else cov * factor
+
+
+def select_assets(cov, columns):
+    # covariance of a subset / reordering of the assets for a dataframe or a factor model
+    return cov.subset(columns) if isinstance(cov, FactorCovariance) else cov.loc[columns, columns]
+
+
+def covariance_array(cov, dtype=np.float64):
+    # numeric form used by the simulation: the factor model as is, anything else as a dense array
+    return cov.astype(dtype) if isinstance(cov, FactorCovariance) else np.asarray(cov, dtype=dtype)
@@ -0,0 +1,121 @@
+import abc
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import yfinance as yf
+
+# PRICE DATA PROVIDERS
+# ----------------------------------------------------------------------------------------------------------------------
+# A provider returns the daily closing prices of a ticker for dates in [start, end) as a pandas series.
+#   YahooProvider      - downloads from yahoo finance, one ticker per request
+#   ConcurrentProvider - wraps another provider and runs many requests in a thread pool with retries and backoff,
+#                        so fetching a basket takes as long as the slowest ticker instead of the sum of all of them
+#   LocalProvider      - serves prices from CSV / Parquet fixture files, no network needed
+# fetch_many() takes a list of (ticker, start, end) requests and returns the results in the same order,
+# a request that failed is returned as its exception instead of raising, so one bad ticker does not
+# discard the others.
+
+# environment variable pointing at a directory of fixture files, makes the app run fully offline
+FIXTURE_DIR_ENV = "MPT_PRICE_FIXTURES"
+
+
+class DataProvider(abc.ABC):
+
+    @abc.abstractmethod
+    def get_close(self, ticker, start, end):
+        pass
+
+    def fetch_many(self, requests):
+        results = []
+        for ticker, start, end in requests:
+            try:
+                results.append(self.get_close(ticker, start, end))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class YahooProvider(DataProvider):
+
+    def get_close(self, ticker, start, end):
+        return yf.Ticker(ticker).history(start=start, end=end)['Close']
+
+
+class ConcurrentProvider(DataProvider):
+
+    def __init__(self, provider, max_workers=8, retries=3, backoff=0.5):
+        self.provider = provider
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def get_close(self, ticker, start, end):
+        # retry with exponential backoff (and a little jitter so parallel retries do not line up)
+        for attempt in range(self.retries + 1):
+            try:
+                return self.provider.get_close(ticker, start, end)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    def fetch_many(self, requests):
+        requests = list(requests)
+        if len(requests) <= 1:
+            return super().fetch_many(requests)
+
+        def fetch(request):
+            try:
+                return self.get_close(*request)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests))) as pool:
+            return list(pool.map(fetch, requests))
+
+
+class LocalProvider(DataProvider):
+    # fixture files are <directory>/<TICKER>.csv (columns Date, Close) or <directory>/<TICKER>.parquet
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._loaded = {}
+
+    def _path(self, ticker, extension):
+        return os.path.join(self.directory, ticker + extension)
+
+    def _load(self, ticker):
+        if ticker not in self._loaded:
+            if os.path.exists(self._path(ticker, ".parquet")):
+                # reading parquet needs pyarrow or fastparquet
+                df = pd.read_parquet(self._path(ticker, ".parquet"))
+                df = df.set_index("Date") if "Date" in df.columns else df
+            elif os.path.exists(self._path(ticker, ".csv")):
+                df = pd.read_csv(self._path(ticker, ".csv"), index_col="Date", parse_dates=True)
+            else:
+                raise FileNotFoundError(f"No price fixture for ticker {ticker} in {self.directory}")
+            close = df['Close']
+            close.index = pd.DatetimeIndex(close.index)
+            self._loaded[ticker] = close.sort_index()
+        return self._loaded[ticker]
+
+    def get_close(self, ticker, start, end):
+        close = self._load(ticker)
+        return close[(close.index >= pd.Timestamp(start)) & (close.index < pd.Timestamp(end))]
+
+    def save(self, ticker, close):
+        # write a series of closing prices as a CSV fixture
+        os.makedirs(self.directory, exist_ok=True)
+        close.rename('Close').rename_axis('Date').to_frame().to_csv(self._path(ticker, ".csv"))
+        self._loaded.pop(ticker, None)
+
+
+def default_provider():
+    # local fixtures when MPT_PRICE_FIXTURES is set, otherwise concurrent yahoo finance downloads
+    fixture_dir = os.environ.get(FIXTURE_DIR_ENV)
+    if fixture_dir:
+        return LocalProvider(fixture_dir)
+    return ConcurrentProvider(YahooProvider())
@@ -0,0 +1,119 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# RETURN DISTRIBUTIONS
+# ----------------------------------------------------------------------------------------------------------------------
+# Precomputed, fixed size curves for the distribution chart of the daily log returns, instead of a per asset KDE
+# evaluated at every sample and every raw sample sent to the browser (rug / histogram):
+#   - histogram: num_bins bins per asset, as densities
+#   - binned KDE: the returns of every asset are linearly binned onto a grid of grid_size points, the binned counts
+#     are convolved with a gaussian kernel by FFT, O(T + M log M) per asset instead of O(T * M)
+#   - summary: observations, mean, standard deviation, skew and excess kurtosis per asset
+# Every asset has its own grid over [min - 3h, max + 3h] (h = bandwidth), so a volatile asset does not squash the
+# curve of a quiet one. All assets are processed at once with 2-D arrays. Missing returns are ignored.
+# Chart size depends on the number of assets only, not on the length of the history.
+
+DEFAULT_GRID_SIZE = 512
+DEFAULT_HISTOGRAM_BINS = 60
+# kernel support kept beyond the extreme returns, in bandwidths
+GRID_MARGIN = 3
+
+
+def silverman_bandwidth(x):
+    # gaussian kernel bandwidth per column of x (T x n, NaN for missing), Silverman's rule of thumb
+    # 0.9 * min(sd, IQR / 1.34) * count^(-1/5), falls back to the sd when the IQR is 0
+    count = np.isfinite(x).sum(axis=0)
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        # all missing columns (NaN statistics) get the fallback bandwidth
+        warnings.simplefilter("ignore", RuntimeWarning)
+        sd = np.nanstd(x, axis=0, ddof=1)
+        q75, q25 = np.nanpercentile(x, [75, 25], axis=0)
+        spread = np.where((q75 - q25) > 0, np.minimum(sd, (q75 - q25) / 1.34), sd)
+        bandwidth = 0.9 * spread * count.astype(np.float64) ** -0.2
+    # constant or single return columns still get a visible bump
+    return np.where(np.isfinite(bandwidth) & (bandwidth > 0), bandwidth, 1e-3)
+
+
+def _grids(x, bandwidth, grid_size):
+    # start and step of the evaluation grid of every column
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lo = np.nanmin(x, axis=0) - GRID_MARGIN * bandwidth
+        hi = np.nanmax(x, axis=0) + GRID_MARGIN * bandwidth
+    lo = np.where(np.isfinite(lo), lo, -GRID_MARGIN * bandwidth)
+    hi = np.where(np.isfinite(hi), hi, GRID_MARGIN * bandwidth)
+    return lo, (hi - lo) / (grid_size - 1)
+
+
+def _bin_counts(x, lo, step, size, linear):
+    # (n x size) counts of every column of x on its own grid lo + k * step, linear binning splits every sample
+    # between its two neighbouring grid points, otherwise every sample goes to the bin it falls in
+    n = x.shape[1]
+    rows, cols = np.nonzero(np.isfinite(x))
+    position = (x[rows, cols] - lo[cols]) / step[cols]
+    index = np.clip(np.floor(position).astype(np.int64), 0, size - (2 if linear else 1))
+    flat = cols * size + index
+    if not linear:
+        return np.bincount(flat, minlength=n * size).reshape(n, size).astype(np.float64)
+    upper = np.clip(position - index, 0.0, 1.0)
+    counts = np.bincount(flat, weights=1.0 - upper, minlength=n * size)
+    counts += np.bincount(flat + 1, weights=upper, minlength=n * size)
+    return counts.reshape(n, size)
+
+
+def binned_kde(x, grid_size=DEFAULT_GRID_SIZE, bandwidth=None):
+    # gaussian KDE of every column of x (T x n), returns (grid, density), both (n x grid_size)
+    x = np.asarray(x, dtype=np.float64)
+    bandwidth = silverman_bandwidth(x) if bandwidth is None else np.broadcast_to(bandwidth, x.shape[1:])
+    lo, step = _grids(x, bandwidth, grid_size)
+    counts = _bin_counts(x, lo, step, grid_size, linear=True)
+    counts /= np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+    # circular convolution over 2 * grid_size points: offsets 0..M-1 at the start of the kernel, -(M-1)..-1 at the
+    # end, so the wrapped part never overlaps the grid (offset M is unused)
+    length = 2 * grid_size
+    offsets = np.arange(length)
+    offsets = np.where(offsets < grid_size, offsets, offsets - length).astype(np.float64)
+    scaled = offsets[None, :] * (step / bandwidth)[:, None]
+    kernel = np.exp(-0.5 * scaled ** 2) / (bandwidth[:, None] * np.sqrt(2 * np.pi))
+    kernel[:, grid_size] = 0.0
+    density = np.fft.irfft(np.fft.rfft(counts, length, axis=1) * np.fft.rfft(kernel, axis=1), length, axis=1)
+    density = np.maximum(density[:, :grid_size], 0.0)
+    grid = lo[:, None] + step[:, None] * np.arange(grid_size)[None, :]
+    return grid, density
+
+
+def histogram(x, num_bins=DEFAULT_HISTOGRAM_BINS):
+    # histogram of every column of x (T x n) over its own range, returns (bin centres, densities, bin widths),
+    # centres and densities are (n x num_bins)
+    x = np.asarray(x, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lo, hi = np.nanmin(x, axis=0), np.nanmax(x, axis=0)
+    lo = np.where(np.isfinite(lo), lo, 0.0)
+    hi = np.where(np.isfinite(hi) & (hi > lo), hi, lo + 1e-3)
+    width = (hi - lo) / num_bins
+    counts = _bin_counts(x, lo, width, num_bins, linear=False)
+    density = counts / np.maximum(counts.sum(axis=1, keepdims=True), 1) / width[:, None]
+    centres = lo[:, None] + width[:, None] * (np.arange(num_bins)[None, :] + 0.5)
+    return centres, density, width
+
+
+def distribution_summary(returns):
+    # observations, mean, sd, skew and excess kurtosis (bias corrected, as pandas) of every column
+    return pd.DataFrame({"observations": returns.count(), "mean": returns.mean(), "sd": returns.std(),
+                         "skew": returns.skew(), "excess_kurtosis": returns.kurt()})
+
+
+def return_distribution(returns, grid_size=DEFAULT_GRID_SIZE, num_bins=DEFAULT_HISTOGRAM_BINS):
+    # every curve of the distribution chart for a (T x n) dataframe of returns, as dataframes with one column per
+    # asset (grid_size / num_bins rows), so a subset / reordering of the assets is a column selection
+    columns = returns.columns
+    x = returns.to_numpy(dtype=np.float64)
+    kde_x, kde_y = binned_kde(x, grid_size)
+    hist_x, hist_y, bin_width = histogram(x, num_bins)
+    return {"kde_x": pd.DataFrame(kde_x.T, columns=columns), "kde_y": pd.DataFrame(kde_y.T, columns=columns),
+            "hist_x": pd.DataFrame(hist_x.T, columns=columns), "hist_y": pd.DataFrame(hist_y.T, columns=columns),
+            "bin_width": pd.Series(bin_width, index=columns), "summary": distribution_summary(returns)}
@@ -0,0 +1,376 @@
+import numpy as np
+import pandas as pd
+
+from backtest import equity_curves
+from covariance import SAMPLE, DEFAULT_NUM_FACTORS, covariance_array, estimate_covariance, scale_covariance
+from instrumentation import span
+from moments import MomentStore
+from optimise import optimal_portfolios, efficient_frontier, portfolio_stats
+from parallel_simulation import simulate_portfolios_parallel
+from price_cache import PriceCache
+from price_store import PriceStore
+from reduction import DEFAULT_RESERVOIR_SIZE
+from resampling import DEFAULT_BLOCK_SIZE, DEFAULT_NUM_RESAMPLES, resample_portfolios, weight_bands
+from risk import RISK_PORTFOLIOS, HistoricalRisk
+from simulation import simulate_portfolios, reduce_portfolios, DEFAULT_CHUNK_SIZE, UNIFORM
+from walk_forward import constrained_optimisers, walk_forward
+
+# HEADLESS COMPUTE ENGINE
+# ----------------------------------------------------------------------------------------------------------------------
+# The whole analytics path without streamlit and without module level state:
+#   fetch -> returns -> moments -> simulate / optimise -> backtest
+# Every function takes its inputs as arguments, so it can be used from the streamlit page (online.py),
+# the batch command line tool (batch.py) or any other worker. run_basket() runs the full pipeline for one basket.
+
+NUM_TRADING_DAYS = 252
+START_CAPITAL = 1000
+BENCHMARK = "SPY"
+
+MONTE_CARLO = "monte_carlo"
+EXACT = "exact"
+RESAMPLED = "resampled"
+NUM_FRONTIER_POINTS = 50
+
+
+def make_price_store(provider=None):
+    # a fresh per-run price store on top of the shared disk cache
+    return PriceStore(PriceCache(provider))
+
+
+def get_dataset(store, tickers, start_date, end_date, benchmark=BENCHMARK):
+    # closing prices of the basket, the benchmark is fetched in the same request for the equity curves
+    with span("fetch", assets=len(tickers) + 1) as s:
+        store.load(list(tickers) + [benchmark], start_date, end_date)
+        dataset = store.window(list(tickers), start_date, end_date)
+        s.set(rows=len(dataset))
+    return dataset
+
+
+def set_new_date_for_available_data(dataset):
+    # get the series of dates where NaN value ends:
+    # (series of dates when the stock has just been listed on exchange or equals to start_date variable)
+    # returns (new start date, ticker listed last) or (None, None) if every ticker has data from the first date
+    listing_date = dataset.apply(pd.Series.first_valid_index)
+    if len(dataset) == 0 or listing_date.max() <= dataset.index[0]:
+        return None, None
+
+    # set the new starting date such that there are no NaN values in dataframe
+    newest_ticker = listing_date.idxmax()
+    return listing_date[newest_ticker].date(), newest_ticker
+
+
+def get_normalised_daily_return(dataset):
+    # calculate the normalized daily returns:  r = log(Y(t+1) / Y(t))
+    log_daily_return = np.log(dataset / dataset.shift(1))
+    return log_daily_return[1:]
+
+
+def annualised_mean_covariance(log_daily_return, num_trading_days=NUM_TRADING_DAYS, moment_store=None,
+                               estimator=SAMPLE, num_factors=DEFAULT_NUM_FACTORS):
+    # calculating the annual mean and covariance, estimator is one of covariance.ESTIMATORS: the sample covariance,
+    # Ledoit-Wolf shrinkage or a k-factor model (a covariance.FactorCovariance instead of a dataframe)
+    with span("moments", rows=len(log_daily_return), assets=log_daily_return.shape[1], estimator=estimator):
+        if estimator != SAMPLE:
+            mean_return_annual = log_daily_return.mean() * num_trading_days
+            cov_matrix_annual = scale_covariance(estimate_covariance(log_daily_return, estimator, num_factors),
+                                                 num_trading_days)
+            return mean_return_annual, cov_matrix_annual
+
+        if moment_store is None or log_daily_return.isna().to_numpy().any():
+            # no incremental state, or missing prices (e.g. delisted ticker): pandas skips NaN values pairwise
+            mean_return_annual = log_daily_return.mean() * num_trading_days
+            cov_matrix_annual = log_daily_return.cov() * num_trading_days
+            return mean_return_annual, cov_matrix_annual
+
+        # incremental estimate, only returns added since the last run of this basket are processed
+        return moment_store.update(log_daily_return).annualised(num_trading_days)
+
+
+def generate_random_portfolios(mean_return_annual, cov_matrix_annual, num_portfolios, chunk_size=DEFAULT_CHUNK_SIZE,
+                               dtype=np.float64, seed=None, sampler=UNIFORM, tol=None):
+    # (weights, means, sds) of random long-only portfolios, drawn with one of simulation.SAMPLERS.
+    # With tol set, num_portfolios is an upper bound: the simulation stops once the optimal portfolios converge
+    with span("simulate", portfolios=num_portfolios, assets=len(mean_return_annual), sampler=sampler) as s:
+        p_weights, p_means, p_sds = simulate_portfolios(
+            np.asarray(mean_return_annual), covariance_array(cov_matrix_annual, dtype), num_portfolios,
+            chunk_size=chunk_size, dtype=dtype, seed=seed, sampler=sampler, tol=tol)
+        s.set(portfolios=len(p_means))
+    return p_weights, p_means, p_sds
+
+
+def reduce_random_portfolios(mean_return_annual, cov_matrix_annual, num_portfolios, workers=1,
+                             chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64, seed=None, sampler=UNIFORM, tol=None,
+                             reservoir_size=DEFAULT_RESERVOIR_SIZE, risk=None, constraints=None, progress=None):
+    # streaming simulation (see reduction.py): a PortfolioReducer with the best portfolios (reducer.best()),
+    # the frontier envelope and a reservoir sample for plotting, the weights of every portfolio are not kept.
+    # workers > 1 runs the simulation across a process pool (see parallel_simulation.py).
+    # risk: optional risk.HistoricalRisk, the min CVaR and max return / CVaR portfolios are then kept as well
+    # (reducer.best_risk())
+    # constraints: optional constraints.WeightConstraints, the weights are then drawn by a hit-and-run walk inside them
+    # progress: optional function called with the reducer of the portfolios simulated so far, an exception it raises
+    # stops the simulation (e.g. a cancelled background job, see jobs.py)
+    mean_return_annual = np.asarray(mean_return_annual)
+    cov_matrix_annual = covariance_array(cov_matrix_annual, dtype)
+    with span("simulate", portfolios=num_portfolios, assets=len(mean_return_annual), sampler=sampler,
+              workers=workers) as s:
+        if workers > 1:
+            reducer = simulate_portfolios_parallel(mean_return_annual, cov_matrix_annual, num_portfolios, workers,
+                                                   chunk_size=chunk_size, dtype=dtype, seed=seed, sampler=sampler,
+                                                   tol=tol, reservoir_size=reservoir_size, risk=risk,
+                                                   constraints=constraints, progress=progress)
+        else:
+            reducer = reduce_portfolios(mean_return_annual, cov_matrix_annual, num_portfolios, chunk_size, dtype,
+                                        seed, sampler, tol, reservoir_size=reservoir_size, risk=risk,
+                                        constraints=constraints, progress=progress)
+        s.set(portfolios=reducer.count)
+    return reducer
+
+
+def calculate_portfolio_max_sharpe_min_risk(p_weights, p_mean, p_sd):
+    # weights and statistics arrays ([[mean, sd, sharpe ratio]]) of the best random portfolios:
+    # (max sharpe weights, max sharpe stats, min risk weights, min risk stats)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = p_mean / p_sd
+    b = int(np.nanargmax(sharpe))
+    d = int(np.argmin(p_sd))
+    max_sharpe_stats = np.array([[p_mean[b], p_sd[b], sharpe[b]]])
+    min_risk_stats = np.array([[p_mean[d], p_sd[d], sharpe[d]]])
+    return p_weights[b], max_sharpe_stats, p_weights[d], min_risk_stats
+
+
+def calculate_portfolio_max_sharpe_min_risk_exact(mean_return_annual, cov_matrix_annual, constraints=None):
+    # exact optimum, same arrays as calculate_portfolio_max_sharpe_min_risk
+    with span("optimise", assets=len(mean_return_annual)):
+        return optimal_portfolios(np.asarray(mean_return_annual), np.asarray(cov_matrix_annual), constraints)
+
+
+def calculate_efficient_frontier(mean_return_annual, cov_matrix_annual, num_points=NUM_FRONTIER_POINTS,
+                                 constraints=None):
+    # (weights, stats) of portfolios along the exact efficient frontier
+    with span("efficient_frontier", assets=len(mean_return_annual), portfolios=num_points):
+        return efficient_frontier(np.asarray(mean_return_annual), np.asarray(cov_matrix_annual), num_points,
+                                  constraints)
+
+
+def calculate_resampled_portfolios(log_daily_return, mean_return_annual, cov_matrix_annual,
+                                   num_resamples=DEFAULT_NUM_RESAMPLES, block_size=DEFAULT_BLOCK_SIZE, workers=1,
+                                   seed=None, num_trading_days=NUM_TRADING_DAYS, constraints=None, progress=None):
+    # bootstrap averaged optimal portfolios (see resampling.py): same arrays as calculate_portfolio_max_sharpe_min_risk,
+    # statistics under the full sample mean / covariance, plus the (lower, upper) weight band of both portfolios.
+    # progress: optional function called with the number of optimised resamples
+    with span("resample", resamples=num_resamples, assets=len(mean_return_annual), workers=workers):
+        w_max_sharpe, w_min_risk = resample_portfolios(log_daily_return, num_resamples, block_size, workers, seed,
+                                                       num_trading_days, constraints, progress=progress)
+    mean_return_annual = np.asarray(mean_return_annual)
+    cov_matrix_annual = np.asarray(cov_matrix_annual)
+    out = []
+    for weights in (w_max_sharpe, w_min_risk):
+        w, lower, upper = weight_bands(weights)
+        out.append((w, portfolio_stats(w, mean_return_annual, cov_matrix_annual), (lower, upper)))
+    return out
+
+
+def download_data(store, start_date, end_date, stock_list):
+    # closing prices from the price store, re-indexed onto every calendar day and back filled
+    return store.calendar(stock_list, start_date, end_date)
+
+
+def calculate_return(data):
+    # get % change daily returns
+    daily_return = data / data.shift(1)
+    return daily_return[1:].to_numpy()
+
+
+def portfolio_df(weights, dr, stock_data, columns, start_capital=START_CAPITAL):
+    # equity curves of one or more portfolios (rows of weights), compounded over time with cumulative products
+    # (see backtest.py), the first row is the starting capital:
+    curves = equity_curves(dr, np.atleast_2d(weights), start_capital)
+
+    # taking the date index from stock_data, one column per portfolio:
+    df = pd.DataFrame(curves, index=stock_data.index, columns=columns)
+    df.index.name = "Date"
+    return df
+
+
+def benchmark_portfolio(store, start_date, end_date, benchmark=BENCHMARK, start_capital=START_CAPITAL):
+    # benchmark prices from the price store (already fetched with the basket),
+    # weekend / holiday dates that are skipped are back filled
+    compared_data = store.calendar([benchmark], start_date, end_date)[benchmark]
+
+    # get % change of daily returns
+    compared_data_return = compared_data / compared_data.shift(1)
+    compared_data_return = compared_data_return[1:]
+
+    # compound the starting capital fully invested in the benchmark
+    return pd.DataFrame(equity_curves(compared_data_return.to_numpy(), 1.0, start_capital))
+
+
+def equity_curve_frame(store, start_date, end_date, stock_list, w_max_sharpe, w_min_risk, benchmark=BENCHMARK,
+                       start_capital=START_CAPITAL):
+    # equity curves of the benchmark and the two optimal portfolios on a calendar day index
+    with span("backtest", assets=len(stock_list)) as s:
+        stock_data = download_data(store, start_date, end_date, stock_list)
+        daily_returns = calculate_return(stock_data)
+        daily_returns = np.where(np.isnan(daily_returns), 1, daily_returns)
+
+        # both optimal portfolios are backtested in a single call
+        portfolios = portfolio_df(np.vstack((w_max_sharpe, w_min_risk)), daily_returns, stock_data,
+                                  ['Max Sharpe Ratio Portfolio', 'Min Risk Portfolio'], start_capital)
+        portfolio_df_benchmark = benchmark_portfolio(store, start_date, end_date, benchmark, start_capital)
+        s.set(rows=len(stock_data))
+
+    data = {'100% Snp 500 portfolio': portfolio_df_benchmark.iloc[:, :].values.reshape(-1),
+            'Max Sharpe Ratio Portfolio': portfolios['Max Sharpe Ratio Portfolio'].to_numpy(),
+            'Min Risk Portfolio': portfolios['Min Risk Portfolio'].to_numpy()}
+    return pd.DataFrame(data, index=list(portfolios.index.values.reshape(-1)))
+
+
+def walk_forward_frame(store, prices, start_date, end_date, frequency, lookback_years, benchmark=BENCHMARK,
+                       start_capital=START_CAPITAL, num_trading_days=NUM_TRADING_DAYS, constraints=None, progress=None):
+    # out-of-sample equity curves of the benchmark and the walk-forward portfolios, plus the rebalance weights.
+    # progress: optional function called before every rebalance date (see walk_forward.walk_forward)
+    optimisers = constrained_optimisers(constraints) if constraints is not None else None
+    with span("walk_forward", rows=len(prices), assets=prices.shape[1]):
+        curves, weights = walk_forward(prices, frequency, lookback_years * num_trading_days, optimisers,
+                                       start_capital=start_capital, num_trading_days=num_trading_days,
+                                       progress=progress)
+
+    # benchmark over the same out-of-sample period
+    compared = store.window([benchmark], start_date, end_date)[benchmark]
+    compared = compared.reindex(curves.index).ffill()
+    df = pd.DataFrame({'100% Snp 500 portfolio': compared / compared.iloc[0] * start_capital,
+                       'Max Sharpe Ratio Portfolio': curves['Max Sharpe Ratio'],
+                       'Min Risk Portfolio': curves['Min Risk']})
+    return df, weights
+
+
+def run_basket(tickers, start_date, end_date, num_portfolios=50000, method=MONTE_CARLO, seed=None,
+               sampler=UNIFORM, tol=None, workers=1, covariance=SAMPLE, num_factors=DEFAULT_NUM_FACTORS,
+               chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64,
+               num_frontier_points=NUM_FRONTIER_POINTS, walk_forward_frequency=None, walk_forward_lookback=1,
+               risk_confidence=None, constraints=None, num_resamples=DEFAULT_NUM_RESAMPLES,
+               block_size=DEFAULT_BLOCK_SIZE, store=None, moment_store=None,
+               benchmark=BENCHMARK, start_capital=START_CAPITAL, num_trading_days=NUM_TRADING_DAYS):
+    # run the whole pipeline for one basket and return a dict of results.
+    # risk_confidence (e.g. 0.95): historical VaR / CVaR confidence, adds the tail risk of the optimal portfolios and
+    # (monte carlo) the min CVaR and max return / CVaR portfolios of the simulation, see risk.py
+    # constraints: optional constraints.WeightConstraints in the order of tickers, applied to every optimal portfolio
+    # method RESAMPLED: the optimal portfolios are averaged over num_resamples block bootstrap resamples of the
+    # returns (blocks of block_size days) on workers processes, with a 5% - 95% band of every weight
+    tickers = list(tickers)
+    if len(tickers) <= 1:
+        raise ValueError("Please enter 2 or more assets!")
+    if constraints is not None and len(constraints) != len(tickers):
+        raise ValueError("Weight constraints do not match the number of assets")
+    if store is None:
+        store = make_price_store()
+    if moment_store is None:
+        moment_store = MomentStore()
+
+    dataset = get_dataset(store, tickers, start_date, end_date, benchmark)
+    new_start, newest_ticker = set_new_date_for_available_data(dataset)
+    if new_start is not None:
+        start_date = new_start
+        dataset = get_dataset(store, tickers, start_date, end_date, benchmark)
+    dataset = dataset.bfill()
+
+    log_daily_return = get_normalised_daily_return(dataset)
+    mean_return_annual, cov_matrix_annual = annualised_mean_covariance(log_daily_return, num_trading_days,
+                                                                       moment_store, covariance, num_factors)
+    if mean_return_annual.isna().any():
+        raise ValueError("Ticker may have been delisted.")
+
+    result = {"tickers": tickers, "start_date": start_date, "end_date": end_date, "newest_ticker": newest_ticker,
+              "method": method, "num_portfolios": num_portfolios, "seed": seed, "sampler": sampler,
+              "covariance": covariance,
+              "prices": dataset, "log_daily_return": log_daily_return, "mean_return_annual": mean_return_annual,
+              "cov_matrix_annual": cov_matrix_annual}
+
+    risk = None
+    if risk_confidence is not None:
+        risk = HistoricalRisk.from_log_returns(log_daily_return, (risk_confidence,), num_trading_days, dtype=dtype)
+        result["risk_confidence"] = risk_confidence
+
+    if method in (EXACT, RESAMPLED):
+        if method == EXACT:
+            w_max_sharpe, max_sharpe_stats, w_min_risk, min_risk_stats = \
+                calculate_portfolio_max_sharpe_min_risk_exact(mean_return_annual, cov_matrix_annual, constraints)
+        else:
+            max_sharpe_pick, min_risk_pick = calculate_resampled_portfolios(
+                log_daily_return, mean_return_annual, cov_matrix_annual, num_resamples, block_size, workers, seed,
+                num_trading_days, constraints)
+            w_max_sharpe, max_sharpe_stats, result["max_sharpe_band"] = max_sharpe_pick
+            w_min_risk, min_risk_stats, result["min_risk_band"] = min_risk_pick
+            result["num_resamples"] = num_resamples
+        # the exact frontier of the full sample estimate is drawn in both modes
+        result["frontier_weights"], result["frontier_stats"] = \
+            calculate_efficient_frontier(mean_return_annual, cov_matrix_annual, num_frontier_points, constraints)
+    else:
+        reducer = reduce_random_portfolios(mean_return_annual, cov_matrix_annual, num_portfolios, workers, chunk_size,
+                                           dtype, seed, sampler, tol, risk=risk, constraints=constraints)
+        w_max_sharpe, max_sharpe_stats, w_min_risk, min_risk_stats = reducer.best()
+        for name, (weights, stats, _) in reducer.best_risk().items():
+            result[f"{name}_weights"], result[f"{name}_stats"] = np.asarray(weights), stats
+        # reservoir sample of the simulated portfolios and the best portfolio of every volatility bin
+        result["p_means"], result["p_stdDevs"] = reducer.sample()
+        result["frontier_envelope"] = reducer.envelope()
+        result["portfolios_simulated"] = reducer.count
+
+    result.update({"max_sharpe_weights": np.asarray(w_max_sharpe), "max_sharpe_stats": max_sharpe_stats,
+                   "min_risk_weights": np.asarray(w_min_risk), "min_risk_stats": min_risk_stats})
+    if risk is not None:
+        with span("tail_risk", rows=len(log_daily_return), assets=len(tickers)):
+            result["tail_risk"] = {name: risk.describe(result[f"{name}_weights"])
+                                   for name in ("max_sharpe", "min_risk") + RISK_PORTFOLIOS
+                                   if f"{name}_weights" in result}
+
+    result["equity_curves"] = equity_curve_frame(store, start_date, end_date, tickers, w_max_sharpe, w_min_risk,
+                                                 benchmark, start_capital)
+    if walk_forward_frequency:
+        result["walk_forward_curves"], result["walk_forward_weights"] = \
+            walk_forward_frame(store, dataset, start_date, end_date, walk_forward_frequency, walk_forward_lookback,
+                               benchmark, start_capital, num_trading_days, constraints)
+    return result
+
+
+def summarise(result):
+    # json serialisable summary of run_basket results (weights and statistics of the optimal portfolios)
+    def portfolio(weights, stats):
+        mean, sd, sharpe = np.asarray(stats).reshape(-1)[:3]
+        return {"weights": dict(zip(result["tickers"], map(float, weights))),
+                "mean": float(mean), "sd": float(sd), "sharpe": float(sharpe)}
+
+    curves = result["equity_curves"]
+    summary = {
+        "tickers": result["tickers"],
+        "start_date": str(result["start_date"]),
+        "end_date": str(result["end_date"]),
+        "newest_ticker": result["newest_ticker"],
+        "method": result["method"],
+        "num_portfolios": result["num_portfolios"],
+        "seed": result["seed"],
+        "sampler": result["sampler"],
+        "covariance": result["covariance"],
+        # fewer than num_portfolios when the simulation converged early
+        "portfolios_simulated": result.get("portfolios_simulated", 0),
+        "mean_return_annual": {k: float(v) for k, v in result["mean_return_annual"].items()},
+        "max_sharpe": portfolio(result["max_sharpe_weights"], result["max_sharpe_stats"]),
+        "min_risk": portfolio(result["min_risk_weights"], result["min_risk_stats"]),
+        "final_equity": {k: float(v) for k, v in curves.ffill().iloc[-1].items()},
+    }
+    # tail risk runs: historical VaR / CVaR confidence, min CVaR and max return / CVaR portfolios, tail risk of each
+    if "risk_confidence" in result:
+        summary["risk_confidence"] = result["risk_confidence"]
+    for name in RISK_PORTFOLIOS:
+        if f"{name}_weights" in result:
+            summary[name] = portfolio(result[f"{name}_weights"], result[f"{name}_stats"])
+    for name, metrics in result.get("tail_risk", {}).items():
+        summary[name]["tail_risk"] = metrics
+    # resampled runs: 5% - 95% band of every weight over the bootstrap resamples
+    if "num_resamples" in result:
+        summary["num_resamples"] = result["num_resamples"]
+        for name in ("max_sharpe", "min_risk"):
+            lower, upper = result[f"{name}_band"]
+            summary[name]["weight_band"] = {ticker: [float(lo), float(hi)]
+                                            for ticker, lo, hi in zip(result["tickers"], lower, upper)}
+    return summary
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+import engine
+from instrumentation import span
+
+# INCREMENTAL BASKET
+# ----------------------------------------------------------------------------------------------------------------------
+# Users edit the basket one ticker at a time. The aligned prices, log returns and daily sample mean / covariance of
+# the previous basket are kept, and the next basket over the same date range is derived from them:
+#   - added tickers: only their prices are fetched (the price store keeps the others), only their covariance rows /
+#     columns against the cached aligned returns are computed, O(T * n) per added ticker instead of O(T * n^2)
+#   - removed tickers: their rows and columns are dropped
+# The listing date of every ticker is cached, the start date alignment (set_new_date_for_available_data) is redone
+# only when the change moves the aligned start date. A full rebuild from the price store is done when:
+#   - the date range changed, or the aligned start date moves (a newer listing is added, the newest one is removed)
+#   - an added ticker trades on dates none of the cached tickers traded on (e.g. crypto on weekends), or a removed
+#     ticker was the only one trading on some dates, which changes the calendar of every other ticker
+# The covariance rows use pairwise complete observations like pandas .cov(), so both paths give the same estimate.
+
+FULL = "full"
+INCREMENTAL = "incremental"
+UNCHANGED = "unchanged"
+
+
+def _aligned_start(listing, requested_start):
+    # (start date of the aligned prices, ticker listed last or None), same rule as set_new_date_for_available_data
+    if listing.max() <= listing.min():
+        return pd.Timestamp(requested_start), None
+    return listing.max(), listing.idxmax()
+
+
+def _pairwise_covariance(x, y):
+    # (x columns x y columns) covariance over the rows where both returns are present, NaN below 2 observations.
+    # Columns are centred on their own mean first (the estimate does not depend on it, the sums stay small)
+    x = x - np.nanmean(x, axis=0)
+    y = y - np.nanmean(y, axis=0)
+    x_mask, y_mask = np.isfinite(x).astype(np.float64), np.isfinite(y).astype(np.float64)
+    x, y = np.where(x_mask > 0, x, 0.0), np.where(y_mask > 0, y, 0.0)
+    count = x_mask.T @ y_mask
+    sum_x, sum_y = x.T @ y_mask, x_mask.T @ y
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = (x.T @ y - sum_x * sum_y / count) / (count - 1)
+    return np.where(count >= 2, cov, np.nan)
+
+
+class IncrementalBasket:
+
+    def __init__(self, store, moment_store=None):
+        # store: PriceStore that outlives a single run, moment_store: optional MomentStore of the full rebuilds
+        self.store = store
+        self.moment_store = moment_store
+        self.range = None
+        self.tickers = []
+        self.listing = None
+        self.window = None
+        self.start_date = None
+        self.newest_ticker = None
+        self.prices = None
+        self.returns = None
+        self.mean = None
+        self.cov = None
+        self.last_update = None
+
+    def update(self, tickers, start_date, end_date, benchmark=engine.BENCHMARK):
+        # bring the cached basket to tickers over [start_date, end_date), returns self
+        tickers = list(dict.fromkeys(tickers))
+        with span("basket_update", assets=len(tickers)) as s:
+            if self.range != (str(start_date), str(end_date)) or not self._update_tickers(tickers, benchmark):
+                self._rebuild(tickers, start_date, end_date, benchmark)
+            s.set(update=self.last_update, rows=len(self.prices))
+        return self
+
+    def _rebuild(self, tickers, start_date, end_date, benchmark):
+        dataset = engine.get_dataset(self.store, tickers, start_date, end_date, benchmark)
+        self.listing = dataset.apply(pd.Series.first_valid_index)
+        self.start_date, self.newest_ticker = _aligned_start(self.listing, start_date)
+        if self.newest_ticker is not None:
+            dataset = engine.get_dataset(self.store, tickers, self.start_date.date(), end_date, benchmark)
+        self.range = (str(start_date), str(end_date))
+        self.tickers = tickers
+        self.window = dataset
+        self.prices = dataset.bfill()
+        self.returns = engine.get_normalised_daily_return(self.prices)
+        self.mean, self.cov = engine.annualised_mean_covariance(self.returns, 1, self.moment_store)
+        self.last_update = FULL
+
+    def _update_tickers(self, tickers, benchmark):
+        # derive the new basket from the cached one, False when a full rebuild is needed
+        removed = [t for t in self.tickers if t not in tickers]
+        added = [t for t in tickers if t not in self.tickers]
+        start_date, end_date = self.range
+        listing = self.listing.drop(removed)
+        if added:
+            self.store.load(added + [benchmark], start_date, end_date)
+            listing = pd.concat([listing, self.store.window(added, start_date, end_date)
+                                .apply(pd.Series.first_valid_index)])
+        if listing.isna().any() or _aligned_start(listing, start_date)[0] != self.start_date:
+            return False
+
+        window = self.window.drop(columns=removed)
+        if window.isna().all(axis=1).any():
+            return False
+        if added:
+            new = self.store.window(added, self.start_date, end_date)
+            if not new.index.isin(window.index).all():
+                return False
+            window = window.join(new.reindex(window.index))
+
+        kept = [t for t in self.tickers if t not in removed]
+        returns = self.returns[kept]
+        cov = self.cov.loc[kept, kept]
+        mean = self.mean[kept]
+        if added:
+            new_returns = engine.get_normalised_daily_return(window[added].bfill())
+            returns = returns.join(new_returns)
+            # new rows / columns only: added tickers against every ticker of the basket
+            block = _pairwise_covariance(returns.to_numpy(dtype=np.float64), new_returns.to_numpy(dtype=np.float64))
+            cov = cov.reindex(index=returns.columns, columns=returns.columns)
+            cov.loc[:, added] = block
+            cov.loc[added, :] = block.T
+            mean = pd.concat([mean, new_returns.mean()])
+
+        self.listing = listing[tickers]
+        self.newest_ticker = _aligned_start(self.listing, start_date)[1]
+        self.tickers = tickers
+        self.window = window[tickers]
+        self.prices = self.window.bfill()
+        self.returns = returns[tickers]
+        self.mean = mean[tickers]
+        self.cov = cov.loc[tickers, tickers]
+        self.last_update = INCREMENTAL if removed or added else UNCHANGED
+        return True
+
+    def annualised(self, num_trading_days=engine.NUM_TRADING_DAYS):
+        # (mean series, sample covariance dataframe), both annualised, in the order of the basket
+        return self.mean * num_trading_days, self.cov * num_trading_days
@@ -0,0 +1,257 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import tracemalloc
+import weakref
+
+# PIPELINE INSTRUMENTATION
+# ----------------------------------------------------------------------------------------------------------------------
+# Every pipeline stage runs inside a named span:
+#
+#   with span("simulation", portfolios=NUM_PORTFOLIOS) as s:
+#       ...
+#       s.set(assets=len(STOCK_LIST))
+#
+# A span records wall time, cpu time, peak allocated memory (tracemalloc) and any counts passed to it.
+# Finished spans are appended to a JSON lines log and summed into a Prometheus text format file.
+# When the tracer is disabled span() returns one shared no-op object, so instrumented code costs nothing.
+# Enable with the MPT_INSTRUMENTATION environment variable or TRACER.enable() for the whole process, or for one run
+# of the page with TRACER.start_run(): streamlit serves every session from one process, so a run only records the
+# spans of its own context (the script thread and the jobs it submits, see jobs.py) and keeps its own list of spans.
+# tracemalloc only runs while the process wide tracer or a run needs it. Memory peaks are process wide: every reset
+# of the peak counter first folds it into every open span (of any thread), so concurrent spans keep their peaks.
+
+ENABLE_ENV = "MPT_INSTRUMENTATION"
+METRICS_DIR_ENV = "MPT_METRICS_DIR"
+DEFAULT_METRICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".metrics")
+
+
+class _NoopSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **counts):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+# the run of the current context (script thread of one page run and its jobs), None outside of a run
+_RUN = contextvars.ContextVar("mpt_run", default=None)
+# open spans that trace memory, of every thread
+_MEMORY_SPANS = []
+_MEMORY_LOCK = threading.Lock()
+
+
+def _fold_peak():
+    # fold the process wide peak into every open span and start a new peak (with _MEMORY_LOCK held)
+    current, peak = tracemalloc.get_traced_memory()
+    for open_span in _MEMORY_SPANS:
+        open_span._peak_absolute = max(open_span._peak_absolute, peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+class Span:
+
+    def __init__(self, tracer, name, counts):
+        self.tracer = tracer
+        self.name = name
+        self.counts = dict(counts)
+        self.parent = None
+        self.depth = 0
+        self.started = None
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_bytes = None
+        self._peak_absolute = 0
+        self._trace_memory = False
+
+    def set(self, **counts):
+        # attach row / asset / portfolio counts known only once the stage has run
+        self.counts.update(counts)
+
+    def __enter__(self):
+        self.parent, self.depth = self.tracer._push(self)
+        self.started = time.time()
+        with _MEMORY_LOCK:
+            self._trace_memory = tracemalloc.is_tracing()
+            if self._trace_memory:
+                self._start_bytes = self._peak_absolute = _fold_peak()
+                _MEMORY_SPANS.append(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall_s = time.perf_counter() - self._wall
+        self.cpu_s = time.process_time() - self._cpu
+        if self._trace_memory:
+            with _MEMORY_LOCK:
+                # tracemalloc may have been stopped by the last run that needed it in the meantime
+                if tracemalloc.is_tracing():
+                    _fold_peak()
+                    self.peak_bytes = self._peak_absolute - self._start_bytes
+                _MEMORY_SPANS.remove(self)
+        self.tracer._pop(self, failed=exc_type is not None)
+        return False
+
+    def record(self):
+        return {"stage": self.name, "parent": self.parent.name if self.parent is not None else None,
+                "depth": self.depth, "started": self.started, "wall_s": self.wall_s, "cpu_s": self.cpu_s,
+                "peak_bytes": self.peak_bytes, **self.counts}
+
+
+class Run:
+    # the spans of one run of the page, recorded in the context that started it
+
+    def __init__(self, tracer, trace_memory):
+        self.spans = []
+        if trace_memory:
+            tracer._acquire_memory()
+            # a run that is never ended (e.g. a page run stopped half way) releases tracemalloc once it is dropped
+            self._release = weakref.finalize(self, tracer._release_memory)
+        else:
+            self._release = lambda: None
+
+    def end(self):
+        self._release()
+
+
+class Tracer:
+
+    def __init__(self, enabled=False, trace_memory=True, metrics_dir=DEFAULT_METRICS_DIR):
+        self.enabled = False
+        self.trace_memory = False
+        self.metrics_dir = metrics_dir
+        self._totals = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # number of users of tracemalloc (the process wide tracer and every run), started by the first one
+        self._memory_users = 0
+        self._started_tracemalloc = False
+        if enabled:
+            self.enable(trace_memory)
+
+    def _acquire_memory(self):
+        with self._lock:
+            self._memory_users += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+
+    def _release_memory(self):
+        with self._lock:
+            self._memory_users -= 1
+            if self._memory_users == 0 and self._started_tracemalloc:
+                with _MEMORY_LOCK:
+                    tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    def enable(self, trace_memory=True):
+        # record the spans of every context of the process
+        if self.enabled:
+            return
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory:
+            self._acquire_memory()
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.trace_memory:
+            self._release_memory()
+        self.trace_memory = False
+
+    def start_run(self, trace_memory=True):
+        # record the spans of the current context (and of the jobs submitted from it) in a new Run, even when the
+        # tracer is disabled. The prometheus totals keep accumulating over every run
+        run = Run(self, trace_memory)
+        _RUN.set(run)
+        return run
+
+    def end_run(self, run=None):
+        # stop recording the spans of the current context in run (by default the run of the current context)
+        current = _RUN.get()
+        run = current if run is None else run
+        if current is run:
+            _RUN.set(None)
+        if run is not None:
+            run.end()
+
+    def span(self, name, **counts):
+        if not self.enabled and _RUN.get() is None:
+            return NOOP_SPAN
+        return Span(self, name, counts)
+
+    def _push(self, span):
+        stack = self._local.__dict__.setdefault("stack", [])
+        parent = stack[-1] if stack else None
+        stack.append(span)
+        return parent, len(stack) - 1
+
+    def _pop(self, span, failed):
+        self._local.stack.pop()
+        record = span.record()
+        record["failed"] = failed
+        run = _RUN.get()
+        with self._lock:
+            if run is not None:
+                run.spans.append(record)
+            total = self._totals.setdefault(span.name, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_bytes": 0})
+            total["count"] += 1
+            total["wall_s"] += span.wall_s
+            total["cpu_s"] += span.cpu_s
+            total["peak_bytes"] = max(total["peak_bytes"], span.peak_bytes or 0)
+        self._write_json(record)
+
+    def _write_json(self, record):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        with open(os.path.join(self.metrics_dir, "spans.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP mpt_stage_wall_seconds Wall time spent in a pipeline stage.",
+            "# TYPE mpt_stage_wall_seconds summary",
+        ]
+        with self._lock:
+            totals = {name: dict(total) for name, total in self._totals.items()}
+        for name, total in sorted(totals.items()):
+            lines.append(f'mpt_stage_wall_seconds_sum{{stage="{name}"}} {total["wall_s"]:.6f}')
+            lines.append(f'mpt_stage_wall_seconds_count{{stage="{name}"}} {total["count"]}')
+        lines += ["# HELP mpt_stage_cpu_seconds_total CPU time spent in a pipeline stage.",
+                  "# TYPE mpt_stage_cpu_seconds_total counter"]
+        for name, total in sorted(totals.items()):
+            lines.append(f'mpt_stage_cpu_seconds_total{{stage="{name}"}} {total["cpu_s"]:.6f}')
+        lines += ["# HELP mpt_stage_peak_bytes Largest peak of allocated memory seen in a pipeline stage.",
+                  "# TYPE mpt_stage_peak_bytes gauge"]
+        for name, total in sorted(totals.items()):
+            lines.append(f'mpt_stage_peak_bytes{{stage="{name}"}} {total["peak_bytes"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        # write metrics.prom atomically (e.g. for the node exporter textfile collector)
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, "metrics.prom")
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+
+TRACER = Tracer(enabled=bool(os.environ.get(ENABLE_ENV)),
+                metrics_dir=os.environ.get(METRICS_DIR_ENV) or DEFAULT_METRICS_DIR)
+
+
+def span(name, **counts):
+    # span on the process wide tracer
+    return TRACER.span(name, **counts)
@@ -0,0 +1,129 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# BACKGROUND JOBS
+# ----------------------------------------------------------------------------------------------------------------------
+# Heavy stages of the page (simulation / optimisation, walk-forward backtest) run as jobs on a thread pool instead of
+# the streamlit script thread, so the page keeps drawing while they run and shows their partial results:
+#   - a job is submitted under a stage name with a key (the inputs of the stage). Submitting a stage whose running
+#     job has another key cancels that stale job, the same key re-attaches to it (e.g. a re-run of the page)
+#   - cancellation is cooperative: the job function receives its Job and calls job.check() between chunks of work
+#     (e.g. from the progress callback of the simulation), which raises JobCancelled once the job is cancelled
+#   - the job publishes partial results with job.publish(value), the script thread follows the job and redraws
+#     whenever a new value was published (follow)
+# numpy releases the GIL in the heavy loops, so a job runs alongside the script thread. The pool is shared by every
+# session of the process, every session has its own JobBoard. A job runs in a copy of the context of the thread that
+# submitted it, so its spans are recorded in the run of that session (see instrumentation.py).
+
+JOB_WORKERS = int(os.environ.get("MPT_JOB_WORKERS", 4))
+# seconds between two checks of a followed job, and minimum seconds between two published partial results
+POLL_INTERVAL = 0.25
+PUBLISH_INTERVAL = 0.5
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def executor():
+    # the thread pool of every job, created on first use
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="mpt-job")
+        return _EXECUTOR
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, key, fn):
+        # runs fn(job) on the thread pool
+        self.key = key
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._version = 0
+        self._latest = None
+        self._last_publish = 0.0
+        self.future = executor().submit(contextvars.copy_context().run, fn, self)
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        # a job that has not started yet never runs, a running job stops at its next check()
+        self._cancelled.set()
+        self.future.cancel()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def due(self, interval=PUBLISH_INTERVAL):
+        # True at most once per interval seconds, to throttle the partial results of a fast loop
+        now = time.monotonic()
+        if now - self._last_publish < interval:
+            return False
+        self._last_publish = now
+        return True
+
+    def publish(self, value):
+        with self._lock:
+            self._latest = value
+            self._version += 1
+
+    def latest(self):
+        # (number of values published so far, last published value)
+        with self._lock:
+            return self._version, self._latest
+
+    def done(self):
+        return self.future.done()
+
+    def failed(self):
+        return self.future.done() and not self.future.cancelled() and self.future.exception() is not None
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+class JobBoard:
+    # the current job of every stage of one session
+
+    def __init__(self):
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, key, fn):
+        # the job of stage name for key: the running or finished job with the same key, otherwise a new job
+        # (a job of the stage with another key is cancelled). Failed and cancelled jobs are not reused
+        with self._lock:
+            job = self.jobs.get(name)
+            if job is not None and job.key == key and not job.cancelled and not job.failed():
+                return job
+            if job is not None:
+                job.cancel()
+            job = self.jobs[name] = Job(key, fn)
+            return job
+
+    def cancel_all(self):
+        with self._lock:
+            for job in self.jobs.values():
+                job.cancel()
+            self.jobs.clear()
+
+
+def follow(job, on_poll=None, poll_interval=POLL_INTERVAL):
+    # wait for the result of job, calling on_poll(version, latest value) every poll_interval seconds while it runs
+    # (in the script thread, so every streamlit call it makes is also a point where a stale page run stops)
+    while not job.done():
+        if on_poll is not None:
+            on_poll(*job.latest())
+        wait([job.future], timeout=poll_interval)
+    return job.result()
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# STREAMING MEAN / COVARIANCE ESTIMATOR
+# ----------------------------------------------------------------------------------------------------------------------
+# Keeps the compact state (count, mean vector, co-moment matrix) of a basket's daily log returns.
+# New returns are merged in and old returns removed with the parallel / Welford update formulas, so refreshing the
+# estimate with one new bar costs O(n_assets^2) instead of recomputing over the whole history:
+#   merge a block b into state a:   delta = mean_b - mean_a,  n = n_a + n_b
+#                                    mean = mean_a + delta * n_b / n
+#                                    M    = M_a + M_b + delta delta' * n_a * n_b / n
+# removing a block applies the same formulas in reverse. covariance = M / (count - 1) like pandas .cov()
+
+DEFAULT_STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".moment_state")
+# state files kept on disk, the least recently updated ones are removed first
+DEFAULT_MAX_STATES = 256
+
+
+def _checksum(returns):
+    # sha1 of the raw bytes of a returns block, detects revised history (e.g. re-adjusted closes after a split)
+    return hashlib.sha1(np.ascontiguousarray(returns, dtype=np.float64).tobytes()).hexdigest()
+
+
+def _block_moments(block):
+    block = np.asarray(block, dtype=np.float64)
+    if block.ndim == 1:
+        block = block[None, :]
+    if not np.all(np.isfinite(block)):
+        raise ValueError("Returns passed to the moment estimator must not contain NaN or inf values")
+    mean = block.mean(axis=0)
+    centred = block - mean
+    return len(block), mean, centred.T @ centred
+
+
+class MomentEstimator:
+
+    def __init__(self, columns, window=None):
+        # columns: asset names (index of the mean series / covariance frame)
+        # window: if set, only the latest `window` returns are kept, older ones are evicted as new ones arrive
+        self.columns = list(columns)
+        n = len(self.columns)
+        self.count = 0
+        self.mean = np.zeros(n)
+        self.comoment = np.zeros((n, n))
+        self.window = window
+        self._buffer = deque() if window is not None else None
+
+    @classmethod
+    def from_returns(cls, returns, window=None):
+        # build the state from a dataframe of returns (rows = dates, cols = assets)
+        estimator = cls(returns.columns, window)
+        estimator.add(returns.to_numpy())
+        return estimator
+
+    def _merge(self, n_b, mean_b, m_b, sign):
+        n_a = self.count
+        if sign > 0:
+            n = n_a + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * (n_b / n)
+            self.comoment = self.comoment + m_b + np.outer(delta, delta) * (n_a * n_b / n)
+            self.count = n
+        else:
+            n = n_a - n_b
+            if n < 0:
+                raise ValueError("Cannot remove more returns than the estimator holds")
+            if n == 0:
+                self.count = 0
+                self.mean = np.zeros_like(self.mean)
+                self.comoment = np.zeros_like(self.comoment)
+                return
+            mean_rest = (n_a * self.mean - n_b * mean_b) / n
+            delta = mean_b - mean_rest
+            self.comoment = self.comoment - m_b - np.outer(delta, delta) * (n * n_b / n_a)
+            self.mean = mean_rest
+            self.count = n
+
+    def add(self, returns):
+        # append one row (n_assets,) or a block (rows x n_assets) of returns
+        block = np.atleast_2d(np.asarray(returns, dtype=np.float64))
+        if len(block) == 0:
+            return
+        self._merge(*_block_moments(block), sign=1)
+        if self._buffer is not None:
+            self._buffer.extend(block)
+            # evict the oldest returns that fell out of the rolling window
+            excess = len(self._buffer) - self.window
+            if excess > 0:
+                self.remove(np.array([self._buffer.popleft() for _ in range(excess)]), _from_buffer=True)
+
+    def remove(self, returns, _from_buffer=False):
+        # evict one row or a block of returns that were added before
+        block = np.atleast_2d(np.asarray(returns, dtype=np.float64))
+        if len(block) == 0:
+            return
+        if self._buffer is not None and not _from_buffer:
+            # explicit removal from a windowed estimator must remove the oldest rows
+            for _ in range(len(block)):
+                self._buffer.popleft()
+        self._merge(*_block_moments(block), sign=-1)
+
+    def covariance(self, ddof=1):
+        if self.count <= ddof:
+            return np.full_like(self.comoment, np.nan)
+        return self.comoment / (self.count - ddof)
+
+    def annualised(self, num_trading_days):
+        # same output as annualised_mean_covariance: (mean series, covariance dataframe), both annualised
+        mean = pd.Series(self.mean * num_trading_days, index=self.columns)
+        cov = pd.DataFrame(self.covariance() * num_trading_days, index=self.columns, columns=self.columns)
+        return mean, cov
+
+    def state(self):
+        # compact state: count, mean vector and co-moment matrix
+        return {"columns": self.columns, "count": self.count, "mean": self.mean.copy(),
+                "comoment": self.comoment.copy()}
+
+    @classmethod
+    def from_state(cls, state):
+        estimator = cls(state["columns"])
+        estimator.count = int(state["count"])
+        estimator.mean = np.asarray(state["mean"], dtype=np.float64)
+        estimator.comoment = np.asarray(state["comoment"], dtype=np.float64)
+        return estimator
+
+
+class MomentStore:
+    # persists one estimator state per basket (tickers + first return date) on disk, so a daily re-run only
+    # merges the returns that arrived since the previous run. A state also keeps a checksum of the returns it was
+    # built from: when the provider revised them, the state is rebuilt instead of reused. At most max_states files
+    # are kept
+
+    def __init__(self, state_dir=DEFAULT_STATE_DIR, max_states=DEFAULT_MAX_STATES):
+        self.state_dir = state_dir
+        self.max_states = max_states
+
+    def _path(self, columns, first_date):
+        key = json.dumps([list(map(str, columns)), str(first_date)])
+        return os.path.join(self.state_dir, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+    def update(self, returns):
+        # returns: dataframe of log returns (rows = dates, cols = assets). Returns an estimator for all its rows.
+        if len(returns) == 0:
+            return MomentEstimator(returns.columns)
+        path = self._path(returns.columns, returns.index[0])
+        estimator = None
+        last_date = None
+        checksum = None
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                estimator = MomentEstimator.from_state({"columns": list(returns.columns), "count": f["count"],
+                                                        "mean": f["mean"], "comoment": f["comoment"]})
+                last_date = pd.Timestamp(str(f["last_date"]))
+                checksum = str(f["checksum"])
+        except (OSError, KeyError, ValueError):
+            pass
+
+        values = returns.to_numpy()
+        if estimator is not None and last_date in returns.index \
+                and returns.index.get_loc(last_date) + 1 == estimator.count \
+                and _checksum(values[:estimator.count]) == checksum:
+            # history unchanged: only merge the new rows
+            estimator.add(values[estimator.count:])
+        else:
+            estimator = MomentEstimator.from_returns(returns)
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp, count=estimator.count, mean=estimator.mean, comoment=estimator.comoment,
+                 last_date=str(returns.index[-1]), checksum=_checksum(values))
+        os.replace(tmp, path)
+        self._evict()
+        return estimator
+
+    def _evict(self):
+        # remove the least recently updated states beyond max_states
+        try:
+            names = [name for name in os.listdir(self.state_dir) if name.endswith(".npz") and ".tmp" not in name]
+        except OSError:
+            return
+        if len(names) <= self.max_states:
+            return
+        paths = [os.path.join(self.state_dir, name) for name in names]
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                pass
+        for path in sorted(mtimes, key=mtimes.get)[:len(mtimes) - self.max_states]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,30 +1,105 @@
+import os
+import time
 import numpy as np
 import streamlit as st
 import datetime as dt
 import pandas as pd
-import yfinance as yf
 import matplotlib.pyplot as plt
 import seaborn as sns
-import plotly.figure_factory as ff
+import plotly.graph_objects as go
+from plotly.colors import DEFAULT_PLOTLY_COLORS
 from PIL import Image
+from moments import MomentStore
+from incremental import IncrementalBasket
+from walk_forward import REBALANCE_FREQUENCIES
+import engine
+from universe import shared_universe
+from rendering import plot_portfolio_density
+from result_cache import DEFAULT_CACHE as RESULT_CACHE, basket_key
+from instrumentation import TRACER, span
+from covariance import SAMPLE, FactorCovariance, select_assets
+from distribution import return_distribution
+from risk import MAX_RETURN_CVAR, MIN_CVAR, RISK_PORTFOLIOS, HistoricalRisk
+from constraints import WeightConstraints
+from jobs import Job, JobBoard, JobCancelled, follow
 
 st.set_page_config(layout="wide")
 
-df_excel_stock = pd.read_csv('US STOCK TICKERS.csv')
-df_excel_etf = pd.read_csv('US ETF TICKERS.csv')
-df_excel_crypto = pd.read_csv('TOP 100 CRYPTO TICKERS csv.csv')
-df_concat = pd.concat((df_excel_stock, df_excel_etf, df_excel_crypto), ignore_index=True)
-df_concat.drop(columns=df_concat.iloc[:, 2:], inplace=True, axis=1)
-# st.write(df_concat)
+# stocks, ETFs and crypto tickers from the three ticker CSVs, loaded from a prebuilt binary index (see universe.py)
+# once per process and shared by every session
+UNIVERSE = shared_universe()
 default_list1 = ["AAPL | Apple Inc. Common Stock", "DB | Deutsche Bank AG Common Stock",
                  "WMT | Walmart Inc. Common Stock", "TSLA | Tesla Inc. Common Stock"]
 default_list2 = ["GLD | SPDR Gold Trust", "SPY | SPDR S&P 500"]
 default_list3 = []
 # "BTC-USD | Bitcoin"
-NUM_TRADING_DAYS = 252
-START_CAPITAL = 1000
+NUM_TRADING_DAYS = engine.NUM_TRADING_DAYS
+START_CAPITAL = engine.START_CAPITAL
 DEFAULT_START_DATE = dt.date(2015, 1, 1)
-compared_stock = "SPY"
+compared_stock = engine.BENCHMARK
+# monte carlo engine settings: chunk size bounds memory, float32 halves it, a fixed seed makes runs reproducible
+SIMULATION_CHUNK_SIZE = 65536
+SIMULATION_DTYPE = np.float64
+SIMULATION_SEED = None
+# how random weights are drawn (see simulation.py), the corner-biased sampler reaches the efficient frontier with far
+# fewer portfolios than the original normalised uniform draws
+SAMPLERS = {"Sparse / corner-biased": "sparse", "Flat Dirichlet": "dirichlet",
+            "Scrambled Sobol (quasi-random)": "sobol", "Normalised uniform (original)": "uniform"}
+# with early stopping the slider is an upper bound: the simulation stops once the best sharpe ratio and the
+# minimum volatility change by less than this (relative) between batches
+CONVERGENCE_TOL = 1e-3
+# large simulations run on a process pool (see parallel_simulation.py), set MPT_SIMULATION_WORKERS=1 to disable
+SIMULATION_WORKERS = int(os.environ.get("MPT_SIMULATION_WORKERS", os.cpu_count()))
+PARALLEL_MIN_PORTFOLIOS = 200000
+# covariance estimators offered in the form (see covariance.py), shrinkage / factor model for large baskets
+COVARIANCE_ESTIMATORS = {"Sample covariance": "sample", "Ledoit-Wolf shrinkage": "ledoit_wolf",
+                         "Factor model (principal components)": "factor"}
+NUM_FACTORS = 10
+# confidence of the historical VaR / CVaR measured for every simulated portfolio (see risk.py), off by default: the
+# tail risk of a portfolio is computed over every day of history instead of from the covariance matrix
+TAIL_RISK_LEVELS = {"Off": None, "90%": 0.9, "95%": 0.95, "99%": 0.99}
+RISK_PORTFOLIO_NAMES = {"max_sharpe": "Max Sharpe Ratio", "min_risk": "Min Risk", MIN_CVAR: "Min CVaR",
+                        MAX_RETURN_CVAR: "Max Return / CVaR"}
+# weight constraints (see constraints.py): bounds on every asset and caps on the total weight of every asset class.
+# With constraints the random weights are drawn by a hit-and-run walk inside them instead of the selected sampler
+WEIGHT_CONSTRAINT_CLASSES = {"stock": "stocks", "etf": "ETFs", "crypto": "cryptocurrencies"}
+# larger covariance matrices are not printed as a table, larger correlation heatmaps are drawn without the values
+# and pie charts group the smallest weights into one "Other" slice
+MAX_TABLE_ASSETS = 25
+# larger correlation matrices are not drawn at all
+MAX_HEATMAP_ASSETS = 150
+OTHER_ASSETS = "Other"
+# optimisation methods offered in the form
+MONTE_CARLO_METHOD = "Monte Carlo estimate (brute force)"
+EXACT_METHOD = "Exact efficient frontier (quadratic programming)"
+RESAMPLED_METHOD = "Resampled efficient frontier (exact portfolios averaged over bootstrap resamples)"
+# the exact and resampled modes only simulate a small sample of random portfolios, for the background of the scatter
+# plot and the min CVaR portfolios
+BACKGROUND_PORTFOLIOS = 20000
+# resampled mode (see resampling.py): block bootstrap resamples of the daily returns, blocks of one trading month,
+# run on the simulation process pool
+NUM_RESAMPLES = engine.DEFAULT_NUM_RESAMPLES
+RESAMPLE_BLOCK_SIZE = engine.DEFAULT_BLOCK_SIZE
+NUM_FRONTIER_POINTS = engine.NUM_FRONTIER_POINTS
+WALK_FORWARD_OFF = "Off"
+# colour of each cell of the monte carlo density plot: "max" or "mean" sharpe ratio of the portfolios in it
+SCATTER_STATISTIC = "max"
+# daily closes are cached on disk, only dates that are not cached yet are downloaded from yahoo finance
+# (concurrently, or from local fixture files when the MPT_PRICE_FIXTURES environment variable is set).
+# prices are fetched once per session (basket + benchmark) and every stage reads slices of this store.
+# The basket of the previous submit (aligned prices, returns, sample covariance) is kept in the session as well, so
+# adding or removing one ticker only fetches and computes that ticker (see incremental.py)
+if "basket" not in st.session_state:
+    # running mean / covariance state per basket, a re-run with new bars only merges the new returns
+    st.session_state.basket = IncrementalBasket(engine.make_price_store(), MomentStore())
+BASKET = st.session_state.basket
+PRICE_STORE = BASKET.store
+MOMENT_STORE = BASKET.moment_store
+# the simulation / optimisation and the walk-forward backtest run as background jobs (see jobs.py) while the page
+# draws the other charts, a re-submit with other inputs cancels the stale jobs of the session
+if "jobs" not in st.session_state:
+    st.session_state.jobs = JobBoard()
+JOBS = st.session_state.jobs
 sel = []
 STOCK_LIST = []
 
@@ -57,41 +132,16 @@ with st.container():
 st.warning("###### Disclaimer: All information displayed are for data visualisation purposes only."
            " Nothing contained in this web application should be taken as financial or investment advice!")
 
-def get_dataset():
-    # get data from yahoo finance and store it in a pandas dataframe
-    stock_data = {}
+def current_basket():
+    # the basket of the previous submit brought to the submitted tickers and date range: only added tickers are
+    # fetched from yahoo finance (or the local price cache), the benchmark is fetched with them for the equity curves
+    return BASKET.update(STOCK_LIST, SELECTED_START_DATE, END_DATE, compared_stock)
 
-    for stock in STOCK_LIST:
-        stock_data[stock] = yf.Ticker(stock).history(stock, start=START_DATE, end=END_DATE)['Close']
 
-    return pd.DataFrame(stock_data)
-
-
-def set_new_date_for_available_data():
-    # st.write(dataset)
-    # get the series of dates where NaN value ends:
-    # (series of dates when the stock has just been listed on exchange or equals to start_date variable)
-    listing_date = dataset.apply(pd.Series.first_valid_index)
-
-    # debug:
-    # st.write(f"Initial listing date:\n{listing_date}")
-
-    global START_DATE
-    if listing_date.eq(START_DATE).all():
-        pass
-
-    else:
-        # get the series containing info containing the latest listed ticker and its latest available date
-        latest_listed_stock_date = listing_date.nlargest(1)
-        # print(latest_listed_stock_date.index[0])
-
-        # set the new starting date such that there are no NaN values in dataframe
-        START_DATE = latest_listed_stock_date[0].date()
-
-        st.warning(f"Yahoo Finance data not available for ticker \"{latest_listed_stock_date.index[0]}\" "
-                   f"before {START_DATE},"f" new start date is set to {START_DATE}")
-
-        return latest_listed_stock_date.index[0]
+def get_aligned_dataset():
+    # prices of the basket from the listing date of the most recently listed ticker onwards, back filled
+    basket = current_basket()
+    return basket.prices, basket.start_date.date(), basket.newest_ticker
 
 
 def plot_dataset(dataset_):
@@ -102,15 +152,32 @@ def plot_dataset(dataset_):
     st.write("***")
 
 
+def distribution_figure(distribution):
+    # overlaid histogram bars and KDE line of every asset, one colour and legend entry per asset
+    fig = go.Figure()
+    for i, ticker in enumerate(STOCK_LIST):
+        colour = DEFAULT_PLOTLY_COLORS[i % len(DEFAULT_PLOTLY_COLORS)]
+        fig.add_trace(go.Bar(x=distribution["hist_x"][ticker], y=distribution["hist_y"][ticker],
+                             width=distribution["bin_width"][ticker], marker_color=colour, opacity=0.5, name=ticker,
+                             legendgroup=ticker, showlegend=False))
+        fig.add_trace(go.Scatter(x=distribution["kde_x"][ticker], y=distribution["kde_y"][ticker], mode="lines",
+                                 line=dict(color=colour), name=ticker, legendgroup=ticker))
+    fig.update_layout(barmode="overlay", bargap=0)
+    return fig
+
+
 def get_normalised_daily_return(dataset_):
     # calculate the normalized daily returns:  r = log(Y(t+1) / Y(t))
     # need to measure all returns in comparable metrics
-    log_daily_return_ = np.log(dataset_/dataset_.shift(1))
-
-    # fill nan for distribution graph
-    log_daily_return_filled = log_daily_return_.fillna(0)
-    fig = ff.create_distplot([log_daily_return_filled[c] for c in log_daily_return_filled.columns],
-                             log_daily_return_filled.columns)
+    log_daily_return_ = RESULT_CACHE.get_or_compute("log_returns", RUN_KEY,
+                                                    lambda: current_basket().returns)
+    log_daily_return_ = log_daily_return_[STOCK_LIST]
+
+    # histograms and binned KDE curves of fixed size (see distribution.py), missing returns are ignored
+    with span("return_distribution", rows=len(log_daily_return_), assets=len(STOCK_LIST)):
+        distribution = RESULT_CACHE.get_or_compute("return_distribution", RUN_KEY,
+                                                   lambda: return_distribution(log_daily_return_))
+    fig = distribution_figure(distribution)
     fig.update_layout(
         autosize=False,
         width=800,
@@ -131,17 +198,28 @@ def get_normalised_daily_return(dataset_):
     st.write("+ In Modern Portfolio Theory, it is **assumed that asset returns are normally distributed variables**.")
     st.write("+ However, **actual returns do not follow normal distributions** as their distributions may be skewed"
              " or have heavy tails (high kurtosis) due to frequent price spikes.")
+    summary = distribution["summary"].loc[STOCK_LIST, ["skew", "excess_kurtosis"]]
+    st.write("+ Skew and excess kurtosis of the logged daily returns (both are 0 for a normal distribution):")
+    st.table(summary.rename(columns={"skew": "Skew", "excess_kurtosis": "Excess kurtosis"})
+             .applymap(lambda x: "%.2f" % x))
 
     st.write("***")
 
-    return log_daily_return_[1:]
+    return log_daily_return_
 
 
 def annualised_mean_covariance(log_daily_return_):
-    # calculating the annual mean and covariance
-    mean_return_annual_ = log_daily_return_.mean() * NUM_TRADING_DAYS
-    cov_matrix_annual_ = log_daily_return_.cov() * NUM_TRADING_DAYS
-    return mean_return_annual_, cov_matrix_annual_
+    # calculating the annual mean and covariance: the sample covariance is kept up to date by the basket (only the rows
+    # of added tickers are computed, see incremental.py), shrinkage and factor models are estimated on the whole basket
+    estimator = COVARIANCE_ESTIMATORS[COVARIANCE_ESTIMATOR]
+    if estimator == SAMPLE:
+        compute = lambda: current_basket().annualised(NUM_TRADING_DAYS)
+    else:
+        compute = lambda: engine.annualised_mean_covariance(log_daily_return_, NUM_TRADING_DAYS, MOMENT_STORE,
+                                                            estimator, NUM_FACTORS)
+    mean_return_annual_, cov_matrix_annual_ = RESULT_CACHE.get_or_compute("moments", RUN_KEY + (estimator, NUM_FACTORS),
+                                                                          compute)
+    return mean_return_annual_[STOCK_LIST], select_assets(cov_matrix_annual_, STOCK_LIST)
 
 
 def display_mean_covariance_table():
@@ -160,7 +238,14 @@ def display_mean_covariance_table():
     with col2:
 
         st.subheader("Covariance matrix of annual returns:")
-        st.table(cov_matrix_annual)
+        if len(STOCK_LIST) > MAX_TABLE_ASSETS:
+            st.write(f"{len(STOCK_LIST)} x {len(STOCK_LIST)} matrix, too large to display.")
+        elif isinstance(cov_matrix_annual, FactorCovariance):
+            st.table(cov_matrix_annual.to_frame())
+        else:
+            st.table(cov_matrix_annual)
+        if COVARIANCE_ESTIMATOR != "Sample covariance":
+            st.caption(f"Estimated with: {COVARIANCE_ESTIMATOR}")
 
     st.write("##### Note:")
     st.write("+ Modern Portfolio Theory **assumes that correlation between assets are fixed over time**,"
@@ -192,12 +277,16 @@ def display_mean_covariance_table():
 def correlation_heatmap(log_daily_return_):
     st.subheader("")
     st.subheader("Correlation matrix of underlying assets")
-    correlation_matrix = log_daily_return_.corr()
-
-    fig, ax = plt.subplots()
-    sns.heatmap(correlation_matrix, annot=True, cmap=sns.color_palette("Blues", 100), fmt='.2f')
-
     col_display, text_col = st.columns(2)
+    num_assets = log_daily_return_.shape[1]
+    if num_assets > MAX_HEATMAP_ASSETS:
+        fig = None
+        col_display.write(f"{num_assets} x {num_assets} matrix, too large to display.")
+    else:
+        correlation_matrix = log_daily_return_.corr()
+        fig, ax = plt.subplots()
+        sns.heatmap(correlation_matrix, annot=num_assets <= MAX_TABLE_ASSETS, cmap=sns.color_palette("Blues", 100),
+                    fmt='.2f')
 
     text_col.write("##### Positive vs Negative Correlation:")
     text_col.write("Correlation describes the relationship that exists between two assets and their"
@@ -217,76 +306,251 @@ def correlation_heatmap(log_daily_return_):
              " **reducing unsystematic risk.**")
     text_col.write("")
 
-    col_display.pyplot(fig)
+    if fig is not None:
+        col_display.pyplot(fig)
 
     st.write("***")
 
 
-def generate_random_portfolios():
-    # generate n sets of random variables, index in array corresponds to the nth random portfolio generated.
-    portfolio_mean = []
-    portfolio_sd = []
-    portfolio_weights = []
+def simulated_portfolios():
+    # number of random portfolios to simulate: the slider in Monte Carlo mode, a small sample otherwise
+    if OPTIMISATION_METHOD == MONTE_CARLO_METHOD:
+        return NUM_PORTFOLIOS
+    return min(NUM_PORTFOLIOS, BACKGROUND_PORTFOLIOS)
+
+
+def use_parallel_simulation():
+    # a process pool only pays off for large simulations
+    return SIMULATION_WORKERS > 1 and simulated_portfolios() >= PARALLEL_MIN_PORTFOLIOS
+
+
+def generate_random_portfolios(progress=None):
+    # generate n sets of random weights in (chunk x n_assets) matrices, every portfolio's mean and standard deviation
+    # is computed with matrix operations (see simulation.py) and the chunks are streamed through a reducer that only
+    # keeps the optimal portfolios, the upper envelope and a fixed size sample for the plot (see reduction.py)
+    workers = SIMULATION_WORKERS if use_parallel_simulation() else 1
+    return engine.reduce_random_portfolios(mean_return_annual, cov_matrix_annual, simulated_portfolios(), workers,
+                                           SIMULATION_CHUNK_SIZE, SIMULATION_DTYPE, SIMULATION_SEED,
+                                           SAMPLERS[SAMPLER], CONVERGENCE_TOL if EARLY_STOP else None,
+                                           risk=tail_risk_model(), constraints=CONSTRAINTS, progress=progress)
 
-    for _ in range(NUM_PORTFOLIOS):
-        # generate random weights which sum = 1 for each portfolio:
-        w = np.random.random(len(STOCK_LIST))
-        w = w / np.sum(w)
-        portfolio_weights.append(w)
-        # portfolio mean:
-        # summation of the product of (weights and mean annual return of individual asset)
-        portfolio_mean.append(np.sum(w * mean_return_annual))
-        # portfolio standard deviation:
-        # square root of ( dot product of transposed weight matrix, (covariance matrix, weight matrix) )
-        portfolio_sd.append(np.sqrt(np.dot(w.T, np.dot(cov_matrix_annual, w))))
 
-    return np.array(portfolio_weights), np.array(portfolio_mean), np.array(portfolio_sd)
+def simulation_progress(job):
+    # progress callback of the simulation job: stops a cancelled job, and publishes the portfolios simulated so far
+    # (plot sample, envelope and current optimal portfolios) at most every jobs.PUBLISH_INTERVAL seconds
+    def progress(reducer):
+        job.check()
+        if job.due():
+            p_means_, p_stdDevs_ = reducer.sample()
+            _, max_sharpe_stats_, _, min_risk_stats_ = reducer.best()
+            job.publish({"status": f"Simulated {reducer.count:,} of up to {simulated_portfolios():,} portfolios",
+                         "p_means": p_means_, "p_stdDevs": p_stdDevs_, "envelope": reducer.envelope(),
+                         "max_sharpe_stats": max_sharpe_stats_, "min_risk_stats": min_risk_stats_})
+    return progress
 
 
-def calculate_portfolio_max_sharpe_min_risk(p_mean, p_stddev):
+def resampling_progress(job):
+    # progress callback of the resampling step of the optimisation job
+    def progress(done):
+        job.check()
+        job.publish({"status": f"Optimised {done} of {NUM_RESAMPLES} bootstrap resamples"})
+    return progress
+
+
+def weight_constraints():
+    # WeightConstraints of the form in the order of STOCK_LIST, None for plain long-only weights.
+    # Raises ValueError when no weights satisfy them
+    constraints = WeightConstraints.for_asset_classes(
+        [UNIVERSE.asset_class(ticker) for ticker in STOCK_LIST], MIN_WEIGHT / 100, MAX_WEIGHT / 100,
+        class_upper={asset_class: cap / 100 for asset_class, cap in CLASS_MAX.items()})
+    return None if constraints.is_trivial() else constraints
+
+
+def tail_risk_model():
+    # historical VaR / CVaR, drawdown and sortino ratio over the daily returns of the basket, None when turned off
+    if TAIL_RISK_LEVELS[TAIL_RISK] is None:
+        return None
+    return HistoricalRisk.from_log_returns(log_daily_return, (TAIL_RISK_LEVELS[TAIL_RISK],), NUM_TRADING_DAYS,
+                                           dtype=SIMULATION_DTYPE)
+
+
+def calculate_portfolio_max_sharpe_min_risk(reducer):
     # This is a function that retrieves the statistics array and weight array of the 2 optimal portfolios
-    # Create a new dataframe with columns p_mean, p_stddev and p_sharpeRatio:
-    df = pd.DataFrame({'p_means': p_mean, 'p_stdDevs': p_stddev})
-    df['Sharpe_ratio'] = df['p_means'] / df['p_stdDevs']
-
-    # debug print:
-    # print(df)
-
-    # Extracting the dataframe row containing index of portfolio with max sharpe ratio
-    df_max_sharpe = df[df['Sharpe_ratio'] == df['Sharpe_ratio'].max()]
-    # retrieve the index from single row df_max_sharpe to get corresponding row of the 2D weights array
-    index = df_max_sharpe.index
-    q = []
-    for index in index:
-        q.append(index)
-    b = q[0]
-    max_sharpe_weights = p_weights[int(b)]
-
-    # Extracting the dataframe row containing index of portfolio with lowest risk (SD)
-    df_min_risk = df[df['p_stdDevs'] == df['p_stdDevs'].min()]
-    # retrieve the index from single row df_min_risk to get corresponding row of the 2D weights array
-    index = df_min_risk.index
-    c = []
-    for index in index:
-        c.append(index)
-    d = c[0]
-    min_risk_weights = p_weights[int(d)]
-
-    return max_sharpe_weights, np.array(df_max_sharpe), min_risk_weights, np.array(df_min_risk)
-
-
-def scatter_plot_optimal_portfolios(p_mean, p_sd):
+    return reducer.best()
+
+
+def calculate_portfolio_max_sharpe_min_risk_exact():
+    # Solve for the 2 optimal portfolios directly from the annual mean and covariance (see optimise.py),
+    # returns the same weight and statistics arrays as calculate_portfolio_max_sharpe_min_risk
+    return engine.calculate_portfolio_max_sharpe_min_risk_exact(mean_return_annual, cov_matrix_annual, CONSTRAINTS)
+
+
+def calculate_resampled_portfolios(progress=None):
+    # optimal portfolios averaged over bootstrap resamples of the returns, plus the 5% - 95% band of every weight:
+    # ((weights, stats, (lower, upper)) of the max sharpe portfolio, same for the min risk portfolio)
+    return engine.calculate_resampled_portfolios(log_daily_return, mean_return_annual, cov_matrix_annual,
+                                                 NUM_RESAMPLES, RESAMPLE_BLOCK_SIZE, SIMULATION_WORKERS,
+                                                 SIMULATION_SEED, NUM_TRADING_DAYS, CONSTRAINTS, progress)
+
+
+def calculate_efficient_frontier():
+    # statistics array (mean, sd, sharpe ratio) of portfolios along the exact efficient frontier
+    frontier_weights, frontier_stats = engine.calculate_efficient_frontier(mean_return_annual, cov_matrix_annual,
+                                                                           NUM_FRONTIER_POINTS, CONSTRAINTS)
+    return frontier_stats
+
+
+def run_optimisation(job=None):
+    # simulation summary and optimal portfolios, weights are kept as series so a cached result
+    # can be re-ordered for the same basket selected in a different order.
+    # job: the background job running it (see jobs.py), which receives the partial results
+    # exact and resampled modes: the random portfolios are only a small sample for the scatter plot
+    reducer = generate_random_portfolios(simulation_progress(job) if job is not None else None)
+    frontier_stats_ = None
+    bands = {}
+    if OPTIMISATION_METHOD == MONTE_CARLO_METHOD:
+        w_max_sharpe, max_sharpe_stats_, w_min_risk, min_risk_stats_ = calculate_portfolio_max_sharpe_min_risk(reducer)
+    elif OPTIMISATION_METHOD == EXACT_METHOD:
+        w_max_sharpe, max_sharpe_stats_, w_min_risk, min_risk_stats_ = calculate_portfolio_max_sharpe_min_risk_exact()
+        frontier_stats_ = calculate_efficient_frontier()
+    elif OPTIMISATION_METHOD == RESAMPLED_METHOD:
+        max_sharpe_pick, min_risk_pick = calculate_resampled_portfolios(resampling_progress(job) if job is not None
+                                                                        else None)
+        w_max_sharpe, max_sharpe_stats_, bands["max_sharpe"] = max_sharpe_pick
+        w_min_risk, min_risk_stats_, bands["min_risk"] = min_risk_pick
+        frontier_stats_ = calculate_efficient_frontier()
+    p_means_, p_stdDevs_ = reducer.sample()
+    optimisation = {"p_means": p_means_, "p_stdDevs": p_stdDevs_, "envelope": reducer.envelope(),
+                    "count": reducer.count, "frontier_stats": frontier_stats_,
+                    "max_sharpe_weights": pd.Series(w_max_sharpe, index=STOCK_LIST),
+                    "max_sharpe_stats": max_sharpe_stats_,
+                    "min_risk_weights": pd.Series(w_min_risk, index=STOCK_LIST), "min_risk_stats": min_risk_stats_}
+    for name, (lower, upper) in bands.items():
+        optimisation[f"{name}_band"] = pd.DataFrame({"lower": lower, "upper": upper}, index=STOCK_LIST)
+
+    # min CVaR and max return / CVaR portfolios of the simulation, and the tail risk of every optimal portfolio
+    risk = tail_risk_model()
+    if risk is not None:
+        for name, (weights, stats, _) in reducer.best_risk().items():
+            optimisation[f"{name}_weights"] = pd.Series(weights, index=STOCK_LIST)
+            optimisation[f"{name}_stats"] = stats
+        optimisation["tail_risk"] = {name: risk.describe(optimisation[f"{name}_weights"].to_numpy())
+                                     for name in RISK_PORTFOLIO_NAMES if f"{name}_weights" in optimisation}
+    return optimisation
+
+
+def submit_stage(stage, key, compute):
+    # cached result of a stage, or the background job computing it (see jobs.py): compute(job) runs on the job pool
+    # and its result is cached as soon as it is done, even when the page run that submitted it has stopped.
+    # Jobs of other sessions for the same stage and key wait for one computation (single-flight, see result_cache.py),
+    # a waiting job still stops once it is cancelled and only computes the stage itself when the computing job was
+    # cancelled
+    cached = RESULT_CACHE.get(stage, key)
+    if cached is not None:
+        return cached
+    return JOBS.submit(stage, key, lambda job: RESULT_CACHE.get_or_compute(stage, key, lambda: compute(job),
+                                                                           job.check, (JobCancelled,)))
+
+
+def collect_stage(pending, on_poll=None):
+    # result of submit_stage, waits for its job (on_poll: see jobs.follow)
+    return follow(pending, on_poll) if isinstance(pending, Job) else pending
+
+
+def simulation_preview():
+    # on_poll callback of the optimisation job: the density of the portfolios simulated so far and the current
+    # optimal portfolios, redrawn whenever the job publishes a new snapshot, and the progress of the job
+    status_slot, chart_slot = st.empty(), st.empty()
+    started = time.monotonic()
+    drawn = {"version": 0}
+
+    def on_poll(version, snapshot):
+        status = snapshot["status"] if snapshot is not None else "Running the simulation"
+        status_slot.info(f"{status} ... ({time.monotonic() - started:.0f} s)")
+        if snapshot is None or "p_means" not in snapshot or version == drawn["version"]:
+            return
+        drawn["version"] = version
+        fig, ax = plt.subplots(figsize=(10, 6))
+        image = plot_portfolio_density(ax, snapshot["p_stdDevs"], snapshot["p_means"], statistic=SCATTER_STATISTIC,
+                                       envelope=snapshot["envelope"])
+        fig.colorbar(image, ax=ax, label=f'Sharpe Ratio ({SCATTER_STATISTIC} per cell)')
+        for stats, colour in ((snapshot["max_sharpe_stats"], "gold"), (snapshot["min_risk_stats"], "violet")):
+            ax.plot(stats[0][1], stats[0][0], marker="*", markersize=30, markeredgecolor="black",
+                    markerfacecolor=colour)
+        ax.grid(True)
+        ax.set_xlabel("Expected Volatility (SD)")
+        ax.set_ylabel("Expected Return (Mean)")
+        chart_slot.pyplot(fig)
+        plt.close(fig)
+
+    def clear():
+        status_slot.empty()
+        chart_slot.empty()
+    return on_poll, clear
+
+
+def display_tail_risk(optimisation):
+    # historical tail risk of the optimal portfolios, and the weights of the two tail risk portfolios
+    confidence = TAIL_RISK_LEVELS[TAIL_RISK]
+    st.subheader(f"Tail risk of the optimal portfolios (historical, {confidence:.0%} confidence)")
+    rows = {}
+    for name, metrics in optimisation["tail_risk"].items():
+        mean, sd, sharpe = optimisation[f"{name}_stats"].reshape(-1)[:3]
+        rows[RISK_PORTFOLIO_NAMES[name]] = {
+            "Expected return": "%.2f%%" % (mean * 100), "Volatility": "%.2f%%" % (sd * 100),
+            "Sharpe ratio": "%.2f" % sharpe,
+            "Daily VaR": "%.2f%%" % (metrics[f"var_{confidence:g}"] * 100),
+            "Daily CVaR": "%.2f%%" % (metrics[f"cvar_{confidence:g}"] * 100),
+            "Max drawdown": "%.2f%%" % (metrics["max_drawdown"] * 100), "Sortino ratio": "%.2f" % metrics["sortino"]}
+    st.table(pd.DataFrame(rows).T)
+
+    picks = {RISK_PORTFOLIO_NAMES[name]: optimisation[f"{name}_weights"][STOCK_LIST]
+             for name in RISK_PORTFOLIOS if f"{name}_weights" in optimisation}
+    if picks:
+        st.write("Asset ratios of the simulated portfolios with the lowest CVaR and the highest return per unit of "
+                 "CVaR:")
+        st.table(pd.DataFrame(picks).applymap(lambda x: "%.2f%%" % (x * 100)))
+    st.write("+ VaR: the daily loss exceeded on the worst days of the history, CVaR: the average loss on those days. "
+             "Unlike the volatility, both capture skewed and heavy tailed returns.")
+    st.write("***")
+
+
+def display_weight_bands(optimisation):
+    # averaged weights of the resampled portfolios with the range of the weight over 90% of the resamples
+    st.subheader(f"Stability of the asset ratios over {NUM_RESAMPLES} bootstrap resamples")
+    columns = {}
+    for name in ("max_sharpe", "min_risk"):
+        weights = optimisation[f"{name}_weights"][STOCK_LIST]
+        band = optimisation[f"{name}_band"].loc[STOCK_LIST]
+        columns[RISK_PORTFOLIO_NAMES[name]] = ["%.2f%% (%.2f%% - %.2f%%)" % (w * 100, lower * 100, upper * 100)
+                                               for w, lower, upper in zip(weights, band["lower"], band["upper"])]
+    st.table(pd.DataFrame(columns, index=STOCK_LIST))
+    st.write(f"+ Averaged asset ratio (5% - 95% range over the resamples). The returns are resampled in blocks of "
+             f"{RESAMPLE_BLOCK_SIZE} trading days, a wide range means the optimal ratio of that asset mostly reflects "
+             f"estimation noise.")
+    st.write("***")
+
+
+def scatter_plot_optimal_portfolios(p_mean, p_sd, frontier_stats_=None, envelope_=None, count_=None):
     st.subheader('Monte Carlo Simulation')
     st.set_option('deprecation.showPyplotGlobalUse', False)
     # Function the does a scatter plot of the randomly generated portfolios, including the two optimal portfolios.
     # x-axis = portfolio SD and y-axis = portfolio mean
+    # the portfolios are binned into a fixed size density raster (see rendering.py), so drawing time and image size
+    # do not grow with NUM_PORTFOLIOS
     plt.figure(figsize=(10, 6))
-    plt.scatter(p_sd, p_mean, c=p_mean/p_sd, cmap='Spectral', marker='o', edgecolors='k')
     plt.style.use('seaborn')
+    # p_mean / p_sd are a fixed size sample of the simulation, the upper boundary is drawn from the best portfolio
+    # of every volatility bin over the whole simulation (envelope_)
+    image = plot_portfolio_density(plt.gca(), p_sd, p_mean, statistic=SCATTER_STATISTIC, envelope=envelope_)
     plt.grid(True)
     plt.xlabel("Expected Volatility (SD)")
     plt.ylabel("Expected Return (Mean)")
-    plt.colorbar(label='Sharpe Ratio')
+    plt.colorbar(image, label=f'Sharpe Ratio ({SCATTER_STATISTIC} per cell)')
+    if frontier_stats_ is not None:
+        # exact efficient frontier drawn over the random portfolios
+        plt.plot(frontier_stats_[:, 1], frontier_stats_[:, 0], color="black", linewidth=2, label="Efficient Frontier")
+    plt.legend(loc="lower right")
     plt.plot(max_sharpe_stats[0][1], max_sharpe_stats[0][0], marker="*", markersize=30, markeredgecolor="black",
              markerfacecolor="gold")
     plt.plot(min_risk_stats[0][1], min_risk_stats[0][0], marker="*", markersize=30, markeredgecolor="black",
@@ -295,12 +559,12 @@ def scatter_plot_optimal_portfolios(p_mean, p_sd):
     col_plot, col_word = st.columns(2)
 
     with col_plot:
-        plt.title(f"Scatter plot of {NUM_PORTFOLIOS} randomly generated portfolios with varying ratio of assets")
+        plt.title(f"Scatter plot of {count_ or len(p_mean)} randomly generated portfolios with varying ratio of assets")
         st.pyplot()
 
     with col_word:
-        st.write("##### Each dot in the scatter plot graph"
-                 " represents a single portfolio with randomly generated asset weights.")
+        st.write("##### Each coloured cell in the scatter plot graph"
+                 " contains portfolios with randomly generated asset weights, coloured by their Sharpe Ratio.")
 
         st.caption("")
         st.write("###### Maximising our returns for a fixed level of risk (volatility):")
@@ -325,13 +589,34 @@ def scatter_plot_optimal_portfolios(p_mean, p_sd):
         st.latex("portfolio\:standard\:deviation=\sigma_p")
 
     st.write("##### Note:")
-    st.write("+ This \"brute force\" method of solving an optimisation problem is"
-             " not ideal, but it provides a good estimate of optimal portfolio ratios. ")
+    if frontier_stats_ is None:
+        st.write("+ This \"brute force\" method of solving an optimisation problem is"
+                 " not ideal, but it provides a good estimate of optimal portfolio ratios. ")
+    else:
+        st.write("+ The two stars and the black line are solved exactly with quadratic programming,"
+                 " the random portfolios are only shown for comparison.")
 
     st.write("***")
 
 
+def group_small_weights(weights_a, weights_b, tickers, max_slices=MAX_TABLE_ASSETS):
+    # weights of two portfolios over the same labels with at most max_slices labels: the assets with the largest
+    # combined weight keep their own label, the rest are summed into OTHER_ASSETS
+    weights_a, weights_b = np.asarray(weights_a, dtype=np.float64), np.asarray(weights_b, dtype=np.float64)
+    if len(tickers) <= max_slices:
+        return list(weights_a), list(weights_b), list(tickers)
+    keep = np.sort(np.argsort(-(weights_a + weights_b), kind="stable")[:max_slices - 1])
+    rest = np.ones(len(tickers), dtype=bool)
+    rest[keep] = False
+    return (list(weights_a[keep]) + [weights_a[rest].sum()], list(weights_b[keep]) + [weights_b[rest].sum()],
+            [tickers[i] for i in keep] + [OTHER_ASSETS])
+
+
 def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_risk_):
+    # large baskets: the smallest weights of both portfolios are shown as one slice (and one row of the tables)
+    optimal_ratio_max_sharpe_, optimal_ratio_min_risk_, stock_list_ = group_small_weights(
+        optimal_ratio_max_sharpe_, optimal_ratio_min_risk_, stock_list_)
+
     col_header1, col_header2 = st.columns(2)
 
     col_header1.subheader('Portfolio with Max Sharpe Ratio')
@@ -361,8 +646,6 @@ def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_ri
     # extract the sorted arrays from tuples
     tuples = zip(*sorted_pairs_between)
     optimal_ratio_max_sharpe_, stock_list_sorted1 = [list(t) for t in tuples]
-    print(optimal_ratio_max_sharpe_)
-    print(stock_list_)
 
     # pie chart of the portfolio with highest return for a given level of risk
     # col = ['#b7ffdf', '#3adaa2', '#6cd7dc', '#3d85c6', '#b0afe6', '#d8c8e9', '#ffdbe4', '#fcbbbb', '#faa17a',
@@ -372,7 +655,7 @@ def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_ri
            "#fc9eff", "#d0a3ff", "#a8abff", "#8ae6ff", "#85ffb8", "#aaff75", "#d2ff61", "#edff61", "#ffe46b", "#ff998a",
            "#fc9eff", "#d0a3ff", "#a8abff", "#8ae6ff", "#85ffb8", "#aaff75", "#d2ff61", "#edff61", "#ffe46b", "#ff998a"]
     explode_array = []
-    for index in range(len(STOCK_LIST)):
+    for index in range(len(stock_list_)):
         explode_array.append(0.01)
 
     plt.figure(figsize=(5, 5), dpi=100)
@@ -416,11 +699,9 @@ def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_ri
     # extract the sorted arrays from tuples
     tuples = zip(*sorted_pairs_between)
     optimal_ratio_min_risk_, stock_list_sorted2 = [list(t) for t in tuples]
-    print(optimal_ratio_min_risk_)
-    print(stock_list_)
 
-    # Find the colour array that corresponds to sorted_stick_list1
-    col_corr_array = col[0:len(STOCK_LIST)]
+    # Find the colour array that corresponds to sorted_stick_list1 (the colours repeat for more slices)
+    col_corr_array = [col[index % len(col)] for index in range(len(stock_list_sorted1))]
     # st.write(col_corr_array)
     colour_dict = dict(zip(stock_list_sorted1, col_corr_array))
     # st.write(colour_dict)
@@ -430,7 +711,7 @@ def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_ri
     # st.write(sorted_colour_array)
 
     explode_array = []
-    for index in range(len(STOCK_LIST)):
+    for index in range(len(stock_list_)):
         explode_array.append(0.01)
 
     plt.figure(figsize=(5, 5), dpi=100)
@@ -460,7 +741,10 @@ def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_ri
     col11.metric("Annual Volatility\n(Std Dev)", f"{round(min_risk_stats.reshape(-1)[1] * 100, 2)} %")
     col12.metric("Sharpe Ratio", round(min_risk_stats.reshape(-1)[2], 2))
 
-    if NUM_PORTFOLIOS <= 100000:
+    if OPTIMISATION_METHOD == MONTE_CARLO_METHOD and portfolio_count < NUM_PORTFOLIOS:
+        st.info(f"The optimal portfolios converged after {portfolio_count} of at most {NUM_PORTFOLIOS} random "
+                f"portfolios.")
+    elif OPTIMISATION_METHOD == MONTE_CARLO_METHOD and NUM_PORTFOLIOS <= 100000:
         st.warning("Number of random portfolios may not enough to estimate optimal asset ratios accurately. For more "
                    "exact ratios, increase the slider and re-submit the form again.")
     st.write("***")
@@ -469,154 +753,12 @@ def plot_pie_charts(optimal_ratio_max_sharpe_, stock_list_, optimal_ratio_min_ri
 # COMPOUNDING RETURNS / EQUITY CURVE PLOTTING FUNCTIONS
 # ----------------------------------------------------------------------------------------------------------------------
 
-def download_data(start_date, end_date, stock_list):
-    # get data from yahoo finance
-    stock_data_ = {}
-
-    for stock in stock_list:
-        # closing prices
-        ticker = yf.Ticker(stock)
-        stock_data_[stock] = ticker.history(start=start_date, end=end_date)['Close']
-
-    stock_dataframe  = pd.DataFrame(stock_data_)
-    stock_dataframe = stock_dataframe.reindex(pd.date_range(start_date, end_date), fill_value=None)
-    # back fill NaN values
-    stock_dataframe = stock_dataframe.backfill()
-
-    return stock_dataframe
-
-
-def calculate_return(data):
-    # get % change daily returns
-    daily_return = data / data.shift(1)
-    return daily_return[1:].to_numpy()
-
-
-def weighted_capital(weights):
-    # divide starting capital by portfolio weights
-    weighted_starting_capital = []
-    for w in weights:
-        weighted_starting_capital.append(START_CAPITAL * w)
-    return np.array(weighted_starting_capital)
-
-
-def portfolio_df(wsc, dr, stock_data, stock_list):
-    # create an array containing the price of assets owned, compounded over time:
-    array = []
-
-    g = 0
-    while g < len(wsc):
-        i = 0
-        x = wsc[g]
-        while i < len(dr):
-            x = x * dr[i][g]
-            array.append(x)
-            i += 1
-        g += 1
-
-    array = np.array(array)
-
-    # shape the array into 2D array
-    array = array.reshape(len(wsc), len(dr))
-
-    # make the array into a dataframe, transpose it such that the cols are prices of individual assets over time:
-    df = pd.DataFrame(array).transpose()
-
-    # insert weighted starting capital at first row of dataframe:
-    df = pd.concat([pd.DataFrame(wsc).transpose(), df])
-
-    # insert new column which is the sum of all prices horizontally in a single row (axis = 1):
-    df["Portfolio Value"] = df.iloc[:, :].sum(axis=1)
-
-    # taking the date index from stock_data, replace row index of new dataframe:
-    df["Date"] = pd.DataFrame(stock_data.index)
-    df.set_index("Date", inplace=True)
-    print(df)
-
-    # create dataframe with only the portfolio data:
-    df = df.drop([i for i in range(len(stock_list))], axis=1)
-    return df
-
-
-def benchmark_portfolio(start_date, end_date):
-    # get data from yahoo finance and store it in a pandas dataframe
-    compared_data = yf.download(compared_stock, start_date, end_date)['Close']
-    # fill the weekend / holiday dates that are skipped with NaN values
-    compared_data = compared_data.reindex(pd.date_range(start_date, end_date), fill_value=None)
-    # back fill NaN values
-    compared_data = compared_data.backfill()
-
-
-    # get % change of daily returns
-    compared_data_return = compared_data / compared_data.shift(1)
-    compared_data_return = compared_data_return[1:]
-
-    print(compared_data_return)
-    print(type(compared_data_return))
-
-    capital = START_CAPITAL
-    capital_array = [START_CAPITAL]
-    for i in compared_data_return[:]:
-        capital = capital * i
-        capital_array.append(capital)
-
-    print(pd.DataFrame(capital_array))
-    capital_dataframe = pd.DataFrame(capital_array)
-
-    #
-    # # taking the date index from compared_data, replace row index of capital_dataframe:
-    # capital_dataframe["Date"] = pd.DataFrame(compared_data.index)
-    # capital_dataframe.set_index("Date", inplace=True)
-    # print(capital_dataframe)
-    #
-    # capital_dataframe.columns = [compared_stock]
-    # print(capital_dataframe)
-
-    return capital_dataframe
-
-
 def plot_equity_curve(start_date, end_date, stock_list, w_max_sharpe, w_min_risk):
 
-    stock_data = download_data(start_date, end_date, stock_list)
-    print(stock_data)
-
-    daily_returns = calculate_return(stock_data)
-    print("aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa")
-    print(daily_returns)
-    daily_returns[np.isnan(daily_returns)] = 1
-    print(daily_returns)
-
-    weights = w_max_sharpe
-    weighted_start_capital_max_sharpe = weighted_capital(weights)
-    weights = w_min_risk
-    weighted_start_capital_min_risk = weighted_capital(weights)
-    print(weighted_start_capital_max_sharpe)
-    print(weighted_start_capital_min_risk)
-
-    weighted_start_capital = weighted_start_capital_max_sharpe
-    portfolio_df_max_sharpe = portfolio_df(weighted_start_capital, daily_returns, stock_data, stock_list)
-    print(portfolio_df_max_sharpe)
-
-    weighted_start_capital = weighted_start_capital_min_risk
-    portfolio_df_min_risk = portfolio_df(weighted_start_capital, daily_returns, stock_data, stock_list)
-    print(portfolio_df_min_risk)
-
-    portfolio_df_benchmark = benchmark_portfolio(start_date, end_date)
-
-    # debug:
-    # a,b,c,d,e = st.columns((1,1,1,1,1))
-    # a.write(portfolio_df_benchmark.values.reshape(-1))
-    # b.write(portfolio_df_max_sharpe.to_numpy().reshape(-1))
-    # c.write(portfolio_df_min_risk.to_numpy().reshape(-1))
-    # d.write(portfolio_df_min_risk.to_numpy().reshape(-1))
-    # e.write(list(portfolio_df_max_sharpe.index.values.reshape(-1)))
-
-    data = {'100% Snp 500 portfolio': portfolio_df_benchmark.iloc[:, :].values.reshape(-1),
-            'Max Sharpe Ratio Portfolio': portfolio_df_max_sharpe.to_numpy().reshape(-1),
-            'Min Risk Portfolio': portfolio_df_min_risk.to_numpy().reshape(-1)}
-
-    df = pd.DataFrame(data, index=list(portfolio_df_max_sharpe.index.values.reshape(-1)))
-    # st.write(df)
+    df = RESULT_CACHE.get_or_compute(
+        "equity_curves", SIMULATION_KEY,
+        lambda: engine.equity_curve_frame(PRICE_STORE, start_date, end_date, stock_list, w_max_sharpe, w_min_risk,
+                                          compared_stock, START_CAPITAL))
 
     pd.options.plotting.backend = "plotly"
 
@@ -654,6 +796,87 @@ def plot_equity_curve(start_date, end_date, stock_list, w_max_sharpe, w_min_risk
     st.plotly_chart(fig)
 
 
+def submit_walk_forward(prices, frequency, lookback_years):
+    # start the walk-forward backtest in the background (see submit_stage), it runs while the page draws the rest
+    # and stops at the next rebalance date once the job is cancelled
+    return submit_stage(
+        "walk_forward", RUN_KEY + (frequency, lookback_years, CONSTRAINTS_KEY),
+        lambda job: engine.walk_forward_frame(PRICE_STORE, prices, START_DATE, END_DATE, frequency, lookback_years,
+                                              compared_stock, START_CAPITAL, NUM_TRADING_DAYS, CONSTRAINTS,
+                                              walk_forward_progress(job)))
+
+
+def walk_forward_progress(job):
+    # progress callback of the walk-forward job: stops a cancelled job between two rebalance dates
+    def progress(done, total):
+        job.check()
+    return progress
+
+
+def plot_walk_forward(pending, frequency, lookback_years):
+    # out-of-sample equity curves: weights re-estimated on a trailing window at every rebalance date
+    try:
+        with st.spinner("Running the walk-forward backtest ..."):
+            df, weights = collect_stage(pending)
+    except ValueError as e:
+        st.warning(f"Walk-forward backtest skipped: {e}")
+        return
+
+    pd.options.plotting.backend = "plotly"
+    fig = df.plot(template="seaborn", labels=dict(index="Date", value="Equity / USD", variable="Portfolios"))
+    fig['data'][0]['line']['color'] = "#000000"
+    fig['data'][1]['line']['color'] = "#A020F0"
+    fig['data'][2]['line']['color'] = "#FFD700"
+    fig.update_xaxes(showgrid=True, linecolor='black')
+    fig.update_yaxes(showgrid=True, linecolor='black')
+    fig.update_yaxes(tickprefix="$ ")
+    fig.update_layout(
+        autosize=False,
+        width=1100,
+        height=400)
+    fig['layout'].update(margin=dict(l=0, r=0, b=0, t=0))
+    st.subheader(f"Walk-forward equity curves ({frequency.lower()} rebalancing, {lookback_years} year lookback)")
+    st.plotly_chart(fig)
+
+    with st.expander("What is a walk-forward backtest?"):
+        st.write("+ The equity curves above replay weights estimated over the **same** period they are tested on"
+                 " (in-sample), which flatters the optimal portfolios.")
+        st.write("+ In a walk-forward backtest, at every rebalance date the mean and covariance are estimated from the"
+                 " trailing lookback window only, the portfolio is re-optimised and held until the next rebalance"
+                 " date, so every return shown is **out-of-sample**.")
+        st.write("Latest rebalance weights:")
+        latest_weights = pd.DataFrame({name: w.iloc[-1] for name, w in weights.items()})
+        st.table(latest_weights.applymap(lambda x: "%.2f%%" % (x * 100)))
+
+
+# PERFORMANCE PANEL
+# ----------------------------------------------------------------------------------------------------------------------
+
+def display_performance_panel():
+    # timing and memory of every stage of this run (see instrumentation.py), nested stages are indented.
+    # Stages served from the result cache only show the time it took to draw them.
+    spans = pd.DataFrame(PERFORMANCE_RUN.spans)
+    if spans.empty:
+        return
+    # spans are recorded when they finish, list them in the order they started
+    spans = spans.sort_values("started", kind="stable")
+    table = pd.DataFrame({"Stage": ["\u2003" * depth + stage for stage, depth in zip(spans["stage"], spans["depth"])],
+                          "Wall / ms": spans["wall_s"] * 1000,
+                          "CPU / ms": spans["cpu_s"] * 1000})
+    if spans["peak_bytes"].notna().any():
+        table["Peak memory / MB"] = spans["peak_bytes"] / 1024 ** 2
+    for column in ("rows", "assets", "portfolios"):
+        if column in spans.columns:
+            table[column.capitalize()] = spans[column].astype("Int64")
+
+    with st.expander("Performance"):
+        total = spans.loc[spans["depth"] == 0, "wall_s"].sum()
+        st.write(f"Total time of all stages: {total:.2f} s")
+        st.dataframe(table.style.format(precision=1, na_rep=""))
+        st.caption(f"Spans are appended to {TRACER.metrics_dir}/spans.jsonl and stage totals are written to "
+                   f"{TRACER.metrics_dir}/metrics.prom")
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 
 if __name__ == '__main__':
@@ -662,11 +885,11 @@ if __name__ == '__main__':
     with st.form(key='form1'):
         sel = []
         st.subheader("1. Select Stocks / ETF(gold, bonds, stocks) / Cryptocurrencies:")
-        stock_input = st.multiselect("Select Stocks (NYSE/NASDAQ/AMEX)", df_excel_stock["Ticker + Name"], key=1,
+        stock_input = st.multiselect("Select Stocks (NYSE/NASDAQ/AMEX)", UNIVERSE.labels_for("stock"), key=1,
                                      default=default_list1)
-        etf_input = st.multiselect("Select ETFs (NYSE/NASDAQ/AMEX)", df_excel_etf["Ticker + Name"], key=2,
+        etf_input = st.multiselect("Select ETFs (NYSE/NASDAQ/AMEX)", UNIVERSE.labels_for("etf"), key=2,
                                    default=default_list2)
-        crypto_input = st.multiselect("Select Cryptocurrencies (Top 100 only)", df_excel_crypto["Ticker + Name"], key=3,
+        crypto_input = st.multiselect("Select Cryptocurrencies (Top 100 only)", UNIVERSE.labels_for("crypto"), key=3,
                                       default=default_list3)
 
         def append_ticker(x):
@@ -695,55 +918,129 @@ if __name__ == '__main__':
         NUM_PORTFOLIOS = st.slider(" ", min_value=10000, max_value=500000, value=50000)
 
         st.write("+ 50000 for faster results, increase slider to improve estimate of optimal asset weights")
+        c5, c6 = st.columns(2)
+        with c5:
+            SAMPLER = st.selectbox("Sampling of random weights", list(SAMPLERS))
+        with c6:
+            EARLY_STOP = st.checkbox("Stop early once the optimal portfolios have converged "
+                                     "(the slider becomes an upper bound)", value=True)
+
+        st.write("###")
+        st.subheader("4. Select optimisation method:")
+        OPTIMISATION_METHOD = st.radio("", (MONTE_CARLO_METHOD, EXACT_METHOD, RESAMPLED_METHOD))
+        COVARIANCE_ESTIMATOR = st.selectbox("Covariance estimator (shrinkage or a factor model for large baskets)",
+                                            list(COVARIANCE_ESTIMATORS))
+        TAIL_RISK = st.selectbox("Tail risk: historical VaR / CVaR confidence (slower, measured for every simulated "
+                                 "portfolio)", list(TAIL_RISK_LEVELS))
+        st.write("Weight constraints (optional, apply to the simulation and the exact optimisation):")
+        c7, c8 = st.columns(2)
+        with c7:
+            MIN_WEIGHT = st.slider("Minimum weight of every asset (%)", min_value=0, max_value=50, value=0)
+        with c8:
+            MAX_WEIGHT = st.slider("Maximum weight of every asset (%)", min_value=1, max_value=100, value=100)
+        CLASS_MAX = {}
+        for column, (asset_class, label) in zip(st.columns(len(WEIGHT_CONSTRAINT_CLASSES)),
+                                                WEIGHT_CONSTRAINT_CLASSES.items()):
+            with column:
+                CLASS_MAX[asset_class] = st.slider(f"Maximum total weight of {label} (%)", min_value=0,
+                                                   max_value=100, value=100)
+
+        st.write("###")
+        st.subheader("5. Walk-forward backtest (optional):")
+        c3, c4 = st.columns(2)
+        with c3:
+            WALK_FORWARD_FREQUENCY = st.selectbox("Rebalance frequency",
+                                                  [WALK_FORWARD_OFF] + list(REBALANCE_FREQUENCIES))
+        with c4:
+            WALK_FORWARD_LOOKBACK = st.slider("Lookback window (years)", min_value=1, max_value=5, value=1)
+
+        st.write("###")
+        SHOW_PERFORMANCE = st.checkbox("Show performance panel (time and memory of every stage)",
+                                       value=TRACER.enabled)
 
         submitted = st.form_submit_button(label='Enter')
 
     if submitted:
-        ticker_index = []
-
+        # hash lookup from each selected label to its ticker
         for i in sel:
-            a = df_concat.loc[df_concat["Ticker + Name"] == str(i)]
-            ticker_index.append(str(a.index[0]))
-        for i in ticker_index:
-            STOCK_LIST.append(df_concat.iloc[int(i), 0])
+            STOCK_LIST.append(UNIVERSE.ticker(str(i)))
 
         if len(STOCK_LIST) <= 1:
             st.error("Please enter 2 or more assets!")
             st.stop()
         else:
             pass
+        try:
+            CONSTRAINTS = weight_constraints()
+        except ValueError as e:
+            st.error(f"{e}, please relax the weight constraints.")
+            st.stop()
         # debug:
         # st.write(STOCK_LIST)
     else:
         st.stop()
 
-    dataset = get_dataset()
-
-    newest_ticker = set_new_date_for_available_data()
-
-    dataset_correct_date = get_dataset()
-
-    dataset_final = dataset_correct_date.backfill()
+    # stages only record timings when the panel is shown (for this session only) or MPT_INSTRUMENTATION is set,
+    # otherwise span() is a no-op. A page run stopped half way may have left its run in this thread
+    TRACER.end_run()
+    PERFORMANCE_RUN = TRACER.start_run() if SHOW_PERFORMANCE else None
+
+    # every stage below is memoized by basket, date range and simulation parameters (see result_cache.py),
+    # re-submitting the same form only re-draws the page
+    RUN_KEY = basket_key(STOCK_LIST, START_DATE, END_DATE)
+    # START_DATE becomes the aligned start date below, the basket is always updated for the date the user picked
+    SELECTED_START_DATE = START_DATE
+    # the constraints only depend on the form and the asset class of every ticker, not on the order of the basket
+    CONSTRAINTS_KEY = None if CONSTRAINTS is None else (MIN_WEIGHT, MAX_WEIGHT, tuple(sorted(CLASS_MAX.items())))
+    SIMULATION_KEY = RUN_KEY + (simulated_portfolios(), SIMULATION_SEED, OPTIMISATION_METHOD,
+                                np.dtype(SIMULATION_DTYPE).name, SAMPLERS[SAMPLER], EARLY_STOP,
+                                use_parallel_simulation(), COVARIANCE_ESTIMATORS[COVARIANCE_ESTIMATOR], NUM_FACTORS,
+                                TAIL_RISK_LEVELS[TAIL_RISK], CONSTRAINTS_KEY)
+
+    with span("dataset", assets=len(STOCK_LIST)) as stage, st.spinner("Fetching prices ..."):
+        dataset_final, START_DATE, newest_ticker = RESULT_CACHE.get_or_compute("dataset", RUN_KEY,
+                                                                               get_aligned_dataset)
+        dataset_final = dataset_final[STOCK_LIST]
+        stage.set(rows=len(dataset_final))
+
+    if newest_ticker is not None:
+        st.warning(f"Yahoo Finance data not available for ticker \"{newest_ticker}\" "
+                   f"before {START_DATE},"f" new start date is set to {START_DATE}")
 
-    plot_dataset(dataset_final)
+    with span("plot_prices", rows=len(dataset_final)):
+        plot_dataset(dataset_final)
 
-    log_daily_return = get_normalised_daily_return(dataset_final)
+    with span("returns_distribution", rows=len(dataset_final), assets=len(STOCK_LIST)):
+        log_daily_return = get_normalised_daily_return(dataset_final)
 
     # debug
     # st.write(dataset)
 
-    mean_return_annual, cov_matrix_annual = annualised_mean_covariance(log_daily_return)
+    with span("mean_covariance", rows=len(log_daily_return), assets=len(STOCK_LIST)):
+        mean_return_annual, cov_matrix_annual = annualised_mean_covariance(log_daily_return)
 
-    display_mean_covariance_table()
+    # the heavy stages start in the background now, the tables and charts below are drawn while they run
+    pending_optimisation = submit_stage("optimisation", SIMULATION_KEY, run_optimisation)
+    if WALK_FORWARD_FREQUENCY != WALK_FORWARD_OFF:
+        pending_walk_forward = submit_walk_forward(dataset_final, WALK_FORWARD_FREQUENCY, WALK_FORWARD_LOOKBACK)
 
-    st.spinner(text='In progress...')
+    with span("mean_covariance_table", assets=len(STOCK_LIST)):
+        display_mean_covariance_table()
 
-    correlation_heatmap(log_daily_return)
+    with span("correlation_heatmap", assets=len(STOCK_LIST)):
+        correlation_heatmap(log_daily_return)
 
-    p_weights, p_means, p_stdDevs = generate_random_portfolios()
-
-    optimal_ratio_max_sharpe, max_sharpe_stats, optimal_ratio_min_risk, min_risk_stats\
-        = calculate_portfolio_max_sharpe_min_risk(p_means, p_stdDevs)
+    with span("optimisation", portfolios=NUM_PORTFOLIOS, assets=len(STOCK_LIST)):
+        # partial results stream in while the job runs, replaced by the full charts below once it is done
+        on_poll, clear_preview = simulation_preview()
+        optimisation = collect_stage(pending_optimisation, on_poll)
+        clear_preview()
+    p_means, p_stdDevs = optimisation["p_means"], optimisation["p_stdDevs"]
+    envelope, portfolio_count = optimisation["envelope"], optimisation["count"]
+    frontier_stats = optimisation["frontier_stats"]
+    optimal_ratio_max_sharpe = optimisation["max_sharpe_weights"][STOCK_LIST].to_numpy()
+    optimal_ratio_min_risk = optimisation["min_risk_weights"][STOCK_LIST].to_numpy()
+    max_sharpe_stats, min_risk_stats = optimisation["max_sharpe_stats"], optimisation["min_risk_stats"]
 
     # debug
     # st.write("")
@@ -754,8 +1051,29 @@ if __name__ == '__main__':
     # st.write(f"Its expected return (mean), volatility (SD) and sharpe ratio are {min_risk_stats.reshape(-1)}")
     # st.write("")
 
-    scatter_plot_optimal_portfolios(p_means, p_stdDevs)
+    with span("portfolio_scatter", portfolios=len(p_means)):
+        scatter_plot_optimal_portfolios(p_means, p_stdDevs, frontier_stats, envelope, portfolio_count)
+
+    with span("pie_charts", assets=len(STOCK_LIST)):
+        plot_pie_charts(optimal_ratio_max_sharpe, STOCK_LIST, optimal_ratio_min_risk)
+
+    if "max_sharpe_band" in optimisation:
+        with span("weight_bands", assets=len(STOCK_LIST)):
+            display_weight_bands(optimisation)
+
+    if "tail_risk" in optimisation:
+        with span("tail_risk_table", assets=len(STOCK_LIST)):
+            display_tail_risk(optimisation)
+
+    with span("equity_curves", assets=len(STOCK_LIST)):
+        plot_equity_curve(START_DATE, END_DATE, STOCK_LIST, optimal_ratio_max_sharpe, optimal_ratio_min_risk)
 
-    plot_pie_charts(optimal_ratio_max_sharpe, STOCK_LIST, optimal_ratio_min_risk)
+    if WALK_FORWARD_FREQUENCY != WALK_FORWARD_OFF:
+        with span("walk_forward_curves", assets=len(STOCK_LIST)):
+            plot_walk_forward(pending_walk_forward, WALK_FORWARD_FREQUENCY, WALK_FORWARD_LOOKBACK)
 
-    plot_equity_curve(START_DATE, END_DATE, STOCK_LIST, optimal_ratio_max_sharpe, optimal_ratio_min_risk)
\ No newline at end of file
+    if TRACER.enabled or SHOW_PERFORMANCE:
+        TRACER.write_prometheus()
+    if SHOW_PERFORMANCE:
+        display_performance_panel()
+        TRACER.end_run(PERFORMANCE_RUN)
\ No newline at end of file
@@ -0,0 +1,290 @@
+import numpy as np
+
+# EXACT MEAN-VARIANCE OPTIMISATION
+# ----------------------------------------------------------------------------------------------------------------------
+# Instead of picking the best of millions of random portfolios, the optimal portfolios are solved for directly:
+#   - global minimum variance: closed form, falling back to a long-only QP when the closed form shorts an asset
+#   - tangency (max sharpe, risk free rate = 0): long-only QP on the homogenised problem
+#   - efficient frontier: a QP per target return, each warm started from the previous solution
+# All QPs are solved with a small primal active-set method, which is exact for the few dozen assets used here.
+# With weight constraints (constraints.py) the per asset bounds are the box of the QP and every asset class bound is
+# an equality with a bounded slack variable. The tangency portfolio is then found on the constrained frontier: the
+# sharpe ratio is unimodal along it, a coarse frontier brackets the best point and a golden section search on the
+# target return refines it.
+
+QP_TOL = 1e-10
+RIDGE = 1e-12
+# constrained tangency: frontier points that bracket the best sharpe ratio, golden section steps
+SHARPE_SEARCH_POINTS = 21
+SHARPE_SEARCH_STEPS = 40
+GOLDEN = (np.sqrt(5) - 1) / 2
+
+
+def _kkt_step(Q, g, A, free):
+    # solve the equality constrained sub-problem on the free variables:
+    # min 0.5 p'Qp + g'p  s.t.  A p = 0,  p_fixed = 0
+    # returns the step p and the multipliers nu of the equality constraints
+    n = len(g)
+    m = A.shape[0]
+    idx = np.flatnonzero(free)
+    k = len(idx)
+    kkt = np.zeros((k + m, k + m))
+    kkt[:k, :k] = Q[np.ix_(idx, idx)]
+    kkt[:k, k:] = A[:, idx].T
+    kkt[k:, :k] = A[:, idx]
+    rhs = np.concatenate((-g[idx], np.zeros(m)))
+    try:
+        sol = np.linalg.solve(kkt, rhs)
+    except np.linalg.LinAlgError:
+        # rank deficient working set (e.g. fewer free variables than equality constraints)
+        sol = np.linalg.lstsq(kkt, rhs, rcond=None)[0]
+    p = np.zeros(n)
+    p[idx] = sol[:k]
+    return p, sol[k:]
+
+
+def solve_qp(Q, c, A, b, lb, ub, x0, max_iter=None, tol=QP_TOL):
+    # primal active-set method for:
+    #   min 0.5 x'Qx + c'x   s.t.   A x = b,   lb <= x <= ub
+    # x0 must be feasible. Returns the optimal x.
+    # (b is only used through the feasibility of x0, every step keeps A x constant)
+    Q = np.asarray(Q, dtype=np.float64)
+    c = np.asarray(c, dtype=np.float64)
+    A = np.atleast_2d(np.asarray(A, dtype=np.float64))
+    n = len(c)
+    lb = np.broadcast_to(np.asarray(lb, dtype=np.float64), (n,))
+    ub = np.broadcast_to(np.asarray(ub, dtype=np.float64), (n,))
+    x = np.clip(np.asarray(x0, dtype=np.float64), lb, ub)
+    # a tiny ridge keeps the reduced hessian invertible when the covariance matrix is singular
+    Q = Q + RIDGE * np.trace(Q) / max(n, 1) * np.eye(n)
+    if max_iter is None:
+        max_iter = 50 * n + 100
+
+    # working set: -1 = fixed at lower bound, +1 = fixed at upper bound, 0 = free
+    at = np.zeros(n, dtype=np.int8)
+    at[x >= ub - tol] = 1
+    at[x <= lb + tol] = -1
+
+    for _ in range(max_iter):
+        g = Q @ x + c
+        p, nu = _kkt_step(Q, g, A, at == 0)
+
+        if np.max(np.abs(p), initial=0) <= tol * max(1.0, np.max(np.abs(x))):
+            # stationary on the working set: check the sign of the bound multipliers
+            lam = g + A.T @ nu
+            violation = np.where(at == -1, -lam, np.where(at == 1, lam, 0.0))
+            i = int(np.argmax(violation))
+            if violation[i] <= tol * max(1.0, np.max(np.abs(g))):
+                return x
+            # release the bound with the most negative multiplier
+            at[i] = 0
+            continue
+
+        # step as far as possible towards the sub-problem minimum without leaving the box
+        alpha = 1.0
+        blocking = -1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            to_lower = np.where((at == 0) & (p < -tol), (lb - x) / p, np.inf)
+            to_upper = np.where((at == 0) & (p > tol), (ub - x) / p, np.inf)
+        steps = np.minimum(to_lower, to_upper)
+        j = int(np.argmin(steps))
+        if steps[j] < alpha:
+            alpha = max(steps[j], 0.0)
+            blocking = j
+
+        x = x + alpha * p
+        if blocking >= 0:
+            if to_lower[blocking] <= to_upper[blocking]:
+                x[blocking] = lb[blocking]
+                at[blocking] = -1
+            else:
+                x[blocking] = ub[blocking]
+                at[blocking] = 1
+
+    return x
+
+
+def portfolio_stats(w, mean_return, cov_matrix):
+    # statistics array in the same layout as the monte carlo results: [[mean, sd, sharpe ratio]]
+    w = np.asarray(w, dtype=np.float64)
+    p_mean = float(w @ mean_return)
+    p_sd = float(np.sqrt(max(w @ cov_matrix @ w, 0.0)))
+    sharpe = p_mean / p_sd if p_sd > 0 else np.nan
+    return np.array([[p_mean, p_sd, sharpe]])
+
+
+def _clean_weights(w):
+    # remove round-off noise so that weights are non-negative and sum to exactly 1
+    w = np.where(np.abs(w) < 1e-12, 0.0, w)
+    return w / w.sum()
+
+
+def _active(constraints):
+    # the constraints when they restrict the long-only weights, None otherwise
+    return None if constraints is None or constraints.is_trivial() else constraints
+
+
+def _constrained_qp(cov_matrix, constraints, x0, mean_return=None, target=None):
+    # min w'cov w  s.t.  the weight constraints (and mean'w = target when given), x0 must satisfy them.
+    # Variables [w, s]: 1'w = 1,  G w + s = group upper,  lower <= w <= upper,  0 <= s <= group upper - group lower
+    n, m = len(cov_matrix), constraints.num_groups
+    Q = np.zeros((n + m, n + m))
+    Q[:n, :n] = cov_matrix
+    A = [np.concatenate((np.ones(n), np.zeros(m)))[None, :], np.hstack((constraints.group_matrix, np.eye(m)))]
+    if target is not None:
+        A.append(np.concatenate((mean_return, np.zeros(m)))[None, :])
+    lb = np.concatenate((constraints.lower, np.zeros(m)))
+    ub = np.concatenate((constraints.upper, np.maximum(constraints.group_upper - constraints.group_lower, 0.0)))
+    x0 = np.concatenate((x0, constraints.group_upper - constraints.group_matrix @ x0))
+    x = solve_qp(Q, np.zeros(n + m), np.vstack(A), None, lb, ub, x0)
+    return _clean_weights(np.maximum(x[:n], 0.0))
+
+
+def global_minimum_variance(cov_matrix, long_only=True, constraints=None):
+    # closed form minimum variance portfolio: w = inv(cov) . 1 / (1' . inv(cov) . 1)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    n = len(cov_matrix)
+    if _active(constraints) is not None:
+        return _constrained_qp(cov_matrix, constraints, constraints.feasible_point())
+    ones = np.ones(n)
+    try:
+        x = np.linalg.solve(cov_matrix, ones)
+        w = x / x.sum()
+    except np.linalg.LinAlgError:
+        w = None
+
+    if w is not None and np.all(np.isfinite(w)) and (not long_only or np.all(w >= -QP_TOL)):
+        return _clean_weights(np.maximum(w, 0.0)) if long_only else w
+
+    # the closed form shorts at least one asset, solve the long-only problem instead
+    w = solve_qp(cov_matrix, np.zeros(n), ones[None, :], [1.0], 0.0, 1.0, ones / n)
+    return _clean_weights(w)
+
+
+def max_return_portfolio(mean_return, constraints=None):
+    # long-only portfolio with the highest expected return: 100% in the best asset
+    if _active(constraints) is not None:
+        return _constrained_max_return(np.asarray(mean_return, dtype=np.float64), constraints)
+    w = np.zeros(len(mean_return))
+    w[int(np.argmax(mean_return))] = 1.0
+    return w
+
+
+def _constrained_max_return(mean_return, constraints):
+    # greedy fill, exact for bounds on disjoint groups: every asset at its lower bound, every asset class raised to
+    # its lower bound with its best assets, then the rest of the budget to the best assets up to their bound and
+    # the bound of their class
+    w = constraints.lower.copy()
+    group_total = constraints.group_matrix @ w
+    order = np.argsort(-mean_return, kind="stable")
+    for phase in ("group_lower", "budget"):
+        for i in order:
+            g = constraints.groups[i]
+            if phase == "group_lower":
+                room = constraints.group_lower[g] - group_total[g]
+            else:
+                room = min(constraints.group_upper[g] - group_total[g], 1.0 - group_total.sum())
+            add = max(min(constraints.upper[i] - w[i], room), 0.0)
+            w[i] += add
+            group_total[g] += add
+    return w
+
+
+def _constrained_max_sharpe(mean_return, cov_matrix, constraints):
+    # tangency portfolio under the weight constraints: the best point of a coarse frontier, refined by a golden
+    # section search on the target return between its two neighbours (sharpe is unimodal along the frontier)
+    weights, stats = efficient_frontier(mean_return, cov_matrix, SHARPE_SEARCH_POINTS, constraints)
+    sharpe = np.where(np.isfinite(stats[:, 2]), stats[:, 2], -np.inf)
+    k = int(np.argmax(sharpe))
+    lo, hi = weights[max(k - 1, 0)], weights[min(k + 1, len(weights) - 1)]
+    r_lo, r_hi = float(lo @ mean_return), float(hi @ mean_return)
+    if r_hi - r_lo <= QP_TOL:
+        return weights[k]
+
+    def solve(target):
+        # frontier portfolio at target, warm started from the feasible mix of the two neighbours
+        t = (target - r_lo) / (r_hi - r_lo)
+        w = _constrained_qp(cov_matrix, constraints, (1 - t) * lo + t * hi, mean_return, target)
+        return w, portfolio_stats(w, mean_return, cov_matrix)[0, 2]
+
+    a, b = r_lo, r_hi
+    c, d = b - GOLDEN * (b - a), a + GOLDEN * (b - a)
+    (w_c, s_c), (w_d, s_d) = solve(c), solve(d)
+    for _ in range(SHARPE_SEARCH_STEPS):
+        if s_c >= s_d:
+            b, d, w_d, s_d = d, c, w_c, s_c
+            c = b - GOLDEN * (b - a)
+            w_c, s_c = solve(c)
+        else:
+            a, c, w_c, s_c = c, d, w_d, s_d
+            d = a + GOLDEN * (b - a)
+            w_d, s_d = solve(d)
+    w, s = (w_c, s_c) if s_c >= s_d else (w_d, s_d)
+    return w if np.isfinite(s) and s >= sharpe[k] else weights[k]
+
+
+def max_sharpe(mean_return, cov_matrix, constraints=None):
+    # long-only tangency portfolio (risk free rate = 0).
+    # substitute y = w / (mu'w): min y'cov y  s.t.  mu'y = 1, y >= 0, then w = y / sum(y)
+    mean_return = np.asarray(mean_return, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    if _active(constraints) is not None:
+        return _constrained_max_sharpe(mean_return, cov_matrix, constraints)
+    n = len(mean_return)
+    best = int(np.argmax(mean_return))
+
+    if mean_return[best] <= 0:
+        # no portfolio has a positive return, the homogenised problem is infeasible:
+        # take the frontier portfolio with the highest (least negative) sharpe ratio instead
+        weights, stats = efficient_frontier(mean_return, cov_matrix)
+        return weights[int(np.nanargmax(stats[:, 2]))]
+
+    y0 = np.zeros(n)
+    y0[best] = 1.0 / mean_return[best]
+    y = solve_qp(cov_matrix, np.zeros(n), mean_return[None, :], [1.0], 0.0, np.inf, y0)
+    return _clean_weights(np.maximum(y, 0.0))
+
+
+def efficient_frontier(mean_return, cov_matrix, num_points=50, constraints=None):
+    # trace the long-only efficient frontier at num_points target returns between the minimum variance
+    # portfolio and the maximum return portfolio. Returns (weights (K x n), stats (K x 3)).
+    mean_return = np.asarray(mean_return, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    n = len(mean_return)
+    A = np.vstack((np.ones(n), mean_return))
+    constraints = _active(constraints)
+
+    w_min = global_minimum_variance(cov_matrix, constraints=constraints)
+    w_top = max_return_portfolio(mean_return, constraints)
+    r_min = float(w_min @ mean_return)
+    r_max = float(w_top @ mean_return)
+
+    weights = np.empty((num_points, n))
+    stats = np.empty((num_points, 3))
+    w_prev = w_min
+    for k, target in enumerate(np.linspace(r_min, r_max, num_points)):
+        # warm start: move from the previous solution towards the max return portfolio until the
+        # target return is reached, this point is feasible and already close to the new optimum
+        r_prev = float(w_prev @ mean_return)
+        t = 0.0 if r_max - r_prev <= QP_TOL else np.clip((target - r_prev) / (r_max - r_prev), 0.0, 1.0)
+        x0 = (1 - t) * w_prev + t * w_top
+        if constraints is None:
+            w = _clean_weights(np.maximum(solve_qp(cov_matrix, np.zeros(n), A, [1.0, target], 0.0, 1.0, x0), 0.0))
+        else:
+            w = _constrained_qp(cov_matrix, constraints, x0, mean_return, target)
+        weights[k] = w
+        stats[k] = portfolio_stats(w, mean_return, cov_matrix)[0]
+        w_prev = w
+
+    return weights, stats
+
+
+def optimal_portfolios(mean_return, cov_matrix, constraints=None):
+    # exact counterpart of the monte carlo search, returns the same arrays that the pie charts and metrics use:
+    # (max sharpe weights, max sharpe stats, min risk weights, min risk stats)
+    mean_return = np.asarray(mean_return, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    w_max_sharpe = max_sharpe(mean_return, cov_matrix, constraints)
+    w_min_risk = global_minimum_variance(cov_matrix, constraints=constraints)
+    return (w_max_sharpe, portfolio_stats(w_max_sharpe, mean_return, cov_matrix),
+            w_min_risk, portfolio_stats(w_min_risk, mean_return, cov_matrix))
@@ -0,0 +1,193 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+from covariance import FactorCovariance
+from risk import HistoricalRisk
+from reduction import DEFAULT_RESERVOIR_SIZE, DEFAULT_TOP_K, PortfolioReducer
+from simulation import DEFAULT_CHUNK_SIZE, UNIFORM, ConvergenceMonitor, iter_random_portfolios
+
+# PARALLEL MONTE CARLO SIMULATION
+# ----------------------------------------------------------------------------------------------------------------------
+# The simulation is split into fixed size tasks that run on a process pool:
+#   - the mean vector and covariance matrix are placed in shared memory once, workers attach to them by name
+#     instead of receiving a pickled copy with every task
+#   - every task has its own random stream spawned from one SeedSequence, tasks have a fixed size, so the result
+#     for a seed does not depend on the number of workers or on the order in which tasks finish
+#   - every task reduces its portfolios locally with a PortfolioReducer (top_k best sharpe ratio and lowest
+#     volatility candidates, frontier envelope, reservoir sample, see reduction.py), only these small reducers are
+#     sent back and merged. Weights of the other portfolios are never stored
+#   - with a risk.HistoricalRisk model its (days x n) returns are shared like the inputs, every task measures the
+#     tail risk of its own portfolios
+# With tol set, tasks are checked for convergence in submission order and the remaining tasks are cancelled. The
+# remaining tasks are cancelled as well when the progress callback raises (e.g. a cancelled background job).
+# The pool is created once per number of workers and reused by every run of the process (the page submits runs from
+# background threads of the streamlit server, see jobs.py). Its workers are started with forkserver / spawn: forking
+# a process with running threads can deadlock the child. Every task names the shared blocks it needs, a worker
+# attaches to them on first use.
+
+TASK_SIZE = DEFAULT_CHUNK_SIZE
+
+# arrays attached by the current task of the worker: {key: (shared memory block, array)}
+_SHARED = {}
+
+# number of workers -> process pool, shared by every run of the process
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _start_method():
+    # forkserver where available (fast start of the workers), spawn otherwise
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def worker_pool(workers):
+    # the process pool with this number of workers, created on first use
+    with _POOLS_LOCK:
+        pool = _POOLS.get(workers)
+        if pool is None:
+            pool = _POOLS[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context(_start_method()),
+                initializer=_init_worker)
+        return pool
+
+
+def discard_pool(workers, pool):
+    # drop a broken pool (e.g. a worker was killed), the next run starts a new one
+    with _POOLS_LOCK:
+        if _POOLS.get(workers) is pool:
+            del _POOLS[workers]
+    pool.shutdown(wait=False)
+
+
+def run_tasks(workers, fn, tasks, on_result):
+    # run fn(*task) for every task on the shared pool and call on_result with the results in submission order until
+    # it returns True. Tasks that have not started are dropped once on_result returns True or raises, the running
+    # ones are waited for (the shared blocks they use are released afterwards)
+    pool = worker_pool(workers)
+    futures = [pool.submit(fn, *task) for task in tasks]
+    try:
+        for future in futures:
+            if on_result(future.result()):
+                break
+    except BrokenProcessPool:
+        discard_pool(workers, pool)
+        raise
+    finally:
+        for pending in futures:
+            pending.cancel()
+        wait(futures)
+
+
+def _attach(spec):
+    # (name, shape, dtype) -> array backed by an existing shared memory block
+    name, shape, dtype = spec
+    # the parent owns (and unlinks) every block, workers of the pool share its resource tracker
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _init_worker():
+    # pool initializer
+    if threadpool_limits is not None:
+        # one BLAS thread per worker, the pool already uses every core
+        threadpool_limits(1)
+
+
+def _use_shared(specs):
+    # worker: attach the shared inputs of a task, blocks of earlier runs are released (a worker runs one task at a
+    # time and the runs of the process share the pool)
+    for key, (block, _) in list(_SHARED.items()):
+        if specs.get(key, (None,))[0] != block.name:
+            del _SHARED[key]
+            block.close()
+    for key, spec in specs.items():
+        if key not in _SHARED:
+            _SHARED[key] = _attach(spec)
+
+
+def _simulate_task(specs, rows, seed_sequence, chunk_size, dtype, sampler, top_k, reservoir_size, risk_params,
+                   constraints):
+    # worker: simulate one task and reduce it locally (see reduction.py)
+    _use_shared(specs)
+    _, mean_return = _SHARED["mean"]
+    if "loadings" in _SHARED:
+        cov_matrix = FactorCovariance(_SHARED["loadings"][1], _SHARED["specific_variance"][1])
+    else:
+        _, cov_matrix = _SHARED["cov"]
+    risk = HistoricalRisk(_SHARED["risk_returns"][1], **risk_params) if risk_params is not None else None
+    rng = np.random.default_rng(seed_sequence)
+    reducer = PortfolioReducer(len(mean_return), top_k, reservoir_size, seed=rng, dtype=dtype)
+    for w, p_mean, p_sd in iter_random_portfolios(mean_return, cov_matrix, rows, chunk_size, dtype, rng, sampler,
+                                                  constraints=constraints):
+        reducer.update(w, p_mean, p_sd, risk.metrics(w) if risk is not None else None)
+    return reducer
+
+
+def _share(array, blocks):
+    # copy an array into a new shared memory block, returns its (name, shape, dtype) spec
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block.name, array.shape, array.dtype.str
+
+
+def simulate_portfolios_parallel(mean_return, cov_matrix, num_portfolios, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                                 dtype=np.float64, seed=None, sampler=UNIFORM, tol=None, top_k=DEFAULT_TOP_K,
+                                 reservoir_size=DEFAULT_RESERVOIR_SIZE, task_size=TASK_SIZE, risk=None,
+                                 constraints=None, progress=None):
+    # merged PortfolioReducer of every task (best portfolios, frontier envelope, reservoir sample),
+    # reducer.count is smaller than num_portfolios when the simulation converged early.
+    # progress: optional function called with the merged reducer after every task
+    dtype = np.dtype(dtype)
+    workers = workers or os.cpu_count()
+    mean_return = np.ascontiguousarray(mean_return, dtype=dtype)
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    sizes = [min(task_size, num_portfolios - start) for start in range(0, num_portfolios, task_size)]
+    task_seeds = seed_sequence.spawn(len(sizes))
+    blocks = []
+    try:
+        specs = {"mean": _share(mean_return, blocks)}
+        if isinstance(cov_matrix, FactorCovariance):
+            # factor model: only the loadings and specific variances are shared, O(n * k) instead of O(n^2)
+            specs["loadings"] = _share(np.ascontiguousarray(cov_matrix.loadings, dtype=dtype), blocks)
+            specs["specific_variance"] = _share(np.ascontiguousarray(cov_matrix.specific_variance, dtype=dtype),
+                                                blocks)
+        else:
+            specs["cov"] = _share(np.ascontiguousarray(cov_matrix, dtype=dtype), blocks)
+        if risk is not None:
+            specs["risk_returns"] = _share(risk.returns, blocks)
+        risk_params = risk.params() if risk is not None else None
+
+        reducer = PortfolioReducer(len(mean_return), top_k, reservoir_size, dtype=dtype)
+        monitor = ConvergenceMonitor(tol) if tol is not None else None
+
+        def merge(task):
+            # merged in submission order, so an early stop always happens after the same task for a given seed
+            reducer.merge(task)
+            if progress is not None:
+                progress(reducer)
+            # the candidates of a task hold its best sharpe ratio and its minimum volatility
+            return monitor is not None and monitor.update(
+                np.concatenate((task.max_sharpe["mean"], task.min_risk["mean"])),
+                np.concatenate((task.max_sharpe["sd"], task.min_risk["sd"])), task.count)
+
+        run_tasks(workers, _simulate_task, [(specs, size, task_seed, chunk_size, dtype, sampler, top_k, reservoir_size,
+                                             risk_params, constraints) for size, task_seed in zip(sizes, task_seeds)],
+                  merge)
+        return reducer
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,202 @@
+import datetime as dt
+import json
+import os
+import threading
+import time
+import warnings
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+
+from data_providers import default_provider
+
+# PERSISTENT LOCAL PRICE CACHE
+# ----------------------------------------------------------------------------------------------------------------------
+# Daily closes are stored on disk, one directory per ticker:
+#   dates.npy  - int64 nanosecond timestamps (sorted)
+#   close.npy  - float64 closing prices
+#   meta.json  - the date range that has already been requested from yahoo and when it was last fetched
+# Cached arrays are memory-mapped and sliced without copying, only the missing part of a requested
+# date range is downloaded. Date ranges are half open [start, end) like yahoo finance. The covered range is kept
+# contiguous: a request that does not touch it also downloads the gap in between.
+# Updates of a ticker hold a process-wide lock of its directory: when several sessions of the app request the same
+# ticker at once, one downloads it and the others read it from the cache afterwards (and never write the same files
+# concurrently).
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".price_cache")
+# the latest bar of a ticker is re-downloaded once it is older than this (seconds)
+DEFAULT_TTL = 6 * 60 * 60
+
+
+# ticker directory -> lock of its updates, shared by every PriceCache of the process
+_TICKER_LOCKS = {}
+_TICKER_LOCKS_GUARD = threading.Lock()
+
+
+def _ticker_lock(path):
+    with _TICKER_LOCKS_GUARD:
+        return _TICKER_LOCKS.setdefault(path, threading.Lock())
+
+
+def _to_date(d):
+    return pd.Timestamp(d).date()
+
+
+def _naive_dates(index):
+    # yahoo may return timezone aware timestamps, the cache stores naive calendar dates
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.normalize()
+
+
+class PriceCache:
+
+    def __init__(self, provider=None, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL):
+        # missing dates are downloaded through the provider (see data_providers.py)
+        self.provider = provider if provider is not None else default_provider()
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _ticker_dir(self, ticker):
+        # tickers such as "BRK/A" or "^GSPC" are made safe for file names
+        safe = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in ticker)
+        return os.path.join(self.cache_dir, safe)
+
+    def _read(self, ticker):
+        # returns (dates, closes, meta) with memory-mapped arrays, or None if the ticker is not cached
+        path = self._ticker_dir(ticker)
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+            dates = np.load(os.path.join(path, "dates.npy"), mmap_mode='r')
+            closes = np.load(os.path.join(path, "close.npy"), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        return dates, closes, meta
+
+    def _write(self, ticker, dates, closes, meta):
+        # write to temporary files first so that a crash never leaves a half written cache entry. The temporary
+        # names are unique per process and thread: the ticker locks do not reach the worker processes of batch.py,
+        # which share the cache directory
+        path = self._ticker_dir(ticker)
+        os.makedirs(path, exist_ok=True)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        for name, value in (("dates.npy", dates), ("close.npy", closes)):
+            tmp = os.path.join(path, name + suffix)
+            with open(tmp, "wb") as f:
+                np.save(f, value)
+            os.replace(tmp, os.path.join(path, name))
+        tmp = os.path.join(path, "meta.json" + suffix)
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, "meta.json"))
+
+    def _missing_ranges(self, meta, start, end, now):
+        # date ranges within [start, end) that are not in the cache yet, widened to reach the covered range so that
+        # it stays contiguous
+        if meta is None:
+            return [(start, end)]
+
+        cov_start = _to_date(meta["start"])
+        cov_end = _to_date(meta["end"])
+        ranges = []
+        if start < cov_start:
+            ranges.append((start, cov_start))
+        if end > cov_end:
+            # the latest cached bar is only re-downloaded once the ttl has expired
+            fresh = now - meta["fetched_at"] < self.ttl
+            if not (fresh and cov_end >= _to_date(dt.datetime.fromtimestamp(meta["fetched_at"]))):
+                ranges.append((cov_end, end))
+        return ranges
+
+    def _merge(self, ticker, cached, start, end, pieces, now):
+        # merge newly downloaded pieces into the cache entry of ticker and return the updated entry
+        meta = cached[2] if cached is not None else None
+        if cached is not None:
+            old = pd.Series(np.asarray(cached[1]), index=pd.DatetimeIndex(np.asarray(cached[0])))
+            pieces = [old] + pieces
+        series = pd.concat([pd.Series(p.to_numpy(dtype=np.float64), index=_naive_dates(p.index)) for p in pieces])
+        # newer downloads replace overlapping cached bars
+        series = series[~series.index.duplicated(keep='last')].sort_index()
+
+        # data later than today can not have been downloaded, so the covered range ends today at most
+        today = _to_date(dt.datetime.fromtimestamp(now))
+        cov_start = start if meta is None else min(start, _to_date(meta["start"]))
+        cov_end = min(end, today) if meta is None else max(min(end, today), _to_date(meta["end"]))
+        meta = {"start": cov_start.isoformat(), "end": cov_end.isoformat(), "fetched_at": now}
+
+        self._write(ticker, series.index.to_numpy(dtype="datetime64[ns]").view(np.int64),
+                    series.to_numpy(dtype=np.float64), meta)
+        return self._read(ticker)
+
+    def _update_many(self, tickers, start, end):
+        # bring every ticker up to date for [start, end), all missing ranges are fetched in one bulk provider call.
+        # The locks are taken in a fixed order, so two overlapping requests can not wait on each other
+        with ExitStack() as stack:
+            for path in sorted({self._ticker_dir(ticker) for ticker in tickers}):
+                stack.enter_context(_ticker_lock(path))
+            return self._update_locked(tickers, start, end)
+
+    def _update_locked(self, tickers, start, end):
+        now = time.time()
+        cached = {ticker: self._read(ticker) for ticker in tickers}
+        requests = []
+        for ticker in tickers:
+            meta = cached[ticker][2] if cached[ticker] is not None else None
+            for range_start, range_end in self._missing_ranges(meta, start, end, now):
+                requests.append((ticker, range_start, range_end))
+        if not requests:
+            return cached
+
+        pieces = {}
+        failed = {}
+        for (ticker, _, _), result in zip(requests, self.provider.fetch_many(requests)):
+            if isinstance(result, Exception):
+                failed[ticker] = result
+            else:
+                pieces.setdefault(ticker, []).append(result)
+
+        for ticker in dict.fromkeys(ticker for ticker, _, _ in requests):
+            if ticker in failed:
+                if cached[ticker] is None:
+                    raise failed[ticker]
+                # offline: serve whatever is already cached
+                warnings.warn(f"Could not refresh cached prices for {ticker}: {failed[ticker]}")
+            else:
+                cached[ticker] = self._merge(ticker, cached[ticker], start, end, pieces[ticker], now)
+        return cached
+
+    def _slice(self, ticker, cached, start, end):
+        dates, closes = cached[0], cached[1]
+        lo = np.searchsorted(dates, pd.Timestamp(start).value, side='left')
+        hi = np.searchsorted(dates, pd.Timestamp(end).value, side='left')
+        # slices of the memory-mapped arrays are views, no data is copied
+        index = pd.DatetimeIndex(np.asarray(dates[lo:hi]).view("datetime64[ns]"), name="Date")
+        return pd.Series(closes[lo:hi], index=index, name=ticker, copy=False)
+
+    def get_close(self, ticker, start, end):
+        # closing prices of ticker for dates in [start, end), downloading only what is not cached yet
+        return self.get_closes([ticker], start, end)[ticker]
+
+    def get_closes(self, tickers, start, end):
+        # closing prices of several tickers as a dict of series, missing data is downloaded concurrently
+        start = _to_date(start)
+        end = _to_date(end)
+        tickers = list(dict.fromkeys(tickers))
+        cached = self._update_many(tickers, start, end)
+        return {ticker: self._slice(ticker, cached[ticker], start, end) for ticker in tickers}
+
+    def get_dataset(self, tickers, start, end):
+        # closing prices of several tickers as a dataframe, one column per ticker
+        return pd.DataFrame(self.get_closes(tickers, start, end))
+
+    def clear(self, ticker):
+        # remove a ticker from the cache
+        path = self._ticker_dir(ticker)
+        for name in ("dates.npy", "close.npy", "meta.json"):
+            try:
+                os.remove(os.path.join(path, name))
+            except FileNotFoundError:
+                pass
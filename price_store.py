@@ -0,0 +1,72 @@
+import threading
+
+import pandas as pd
+
+# IN-MEMORY PRICE STORE FOR ONE PIPELINE RUN
+# ----------------------------------------------------------------------------------------------------------------------
+# The first fetch of a run loads the closing prices of every ticker the run needs (basket + benchmark) in one bulk
+# request. Every later stage (listing date trimming, the equity curve calendar, the benchmark) reads slices of the
+# same frame instead of downloading again. Tickers or dates that were not loaded are fetched on demand and added.
+# A store may be read by the page script and its background jobs at once (see jobs.py): loads and reads hold a lock,
+# so no thread sees a half updated date range or frame.
+
+
+def _to_timestamp(d):
+    return pd.Timestamp(d)
+
+
+class PriceStore:
+
+    def __init__(self, source):
+        # source is anything with get_dataset(tickers, start, end), e.g. a PriceCache
+        self.source = source
+        self.prices = pd.DataFrame()
+        self.start = None
+        self.end = None
+        self._lock = threading.RLock()
+
+    def load(self, tickers, start, end):
+        # make sure the store holds tickers for [start, end), fetching only what is missing
+        with self._lock:
+            self._load(tickers, start, end)
+
+    def _load(self, tickers, start, end):
+        tickers = list(dict.fromkeys(tickers))
+        start = _to_timestamp(start)
+        end = _to_timestamp(end)
+
+        if self.start is None or start < self.start or end > self.end:
+            # the date range grew: reload everything held so far over the union of both ranges
+            held = list(self.prices.columns)
+            self.start = start if self.start is None else min(start, self.start)
+            self.end = end if self.end is None else max(end, self.end)
+            self.prices = self.source.get_dataset(list(dict.fromkeys(held + tickers)), self.start.date(),
+                                                  self.end.date())
+            return
+
+        missing = [ticker for ticker in tickers if ticker not in self.prices.columns]
+        if missing:
+            new = self.source.get_dataset(missing, self.start.date(), self.end.date())
+            self.prices = self.prices.join(new, how='outer')
+
+    def window(self, tickers, start, end):
+        # closing prices of tickers for dates in [start, end), same layout as a fresh download
+        with self._lock:
+            self._load(tickers, start, end)
+            prices = self.prices
+        rows = (prices.index >= _to_timestamp(start)) & (prices.index < _to_timestamp(end))
+        # drop dates where none of the requested tickers traded (they only exist for other tickers in the store)
+        return prices.loc[rows, list(tickers)].dropna(how='all')
+
+    def close(self, ticker, start, end):
+        # closing prices of a single ticker for dates in [start, end)
+        return self.window([ticker], start, end)[ticker]
+
+    def listing_dates(self, tickers, start, end):
+        # first date with a price for every ticker within [start, end)
+        return self.window(tickers, start, end).apply(pd.Series.first_valid_index)
+
+    def calendar(self, tickers, start, end):
+        # prices re-indexed onto every calendar day from start to end, weekends / holidays back filled
+        prices = self.window(tickers, start, end)
+        return prices.reindex(pd.date_range(start, end), fill_value=None).bfill()
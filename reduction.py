@@ -0,0 +1,158 @@
+import numpy as np
+
+from risk import MAX_RETURN_CVAR, MIN_CVAR, RISK_PORTFOLIOS
+
+# STREAMING REDUCTION OF SIMULATED PORTFOLIOS
+# ----------------------------------------------------------------------------------------------------------------------
+# Consumes the simulation chunk by chunk and keeps only what the page needs, memory is O(bins + reservoir + top_k)
+# whatever the number of portfolios:
+#   - the top_k max sharpe ratio and min volatility portfolios (with their weights), best first
+#   - the upper envelope of the cloud: the best return per volatility bin (bins are log spaced, each
+#     `resolution` wide in relative terms), an approximation of the simulated efficient frontier
+#   - a uniform reservoir sample of (mean, sd) for plotting: every portfolio gets a random key and the
+#     reservoir_size smallest keys are kept, so two reducers (e.g. of two workers) merge into a uniform sample
+#     of the union
+#   - with tail risk metrics passed to update() (see risk.py): the top_k min CVaR and max return / CVaR portfolios
+# Reducers of different chunks / workers are combined with merge().
+
+DEFAULT_TOP_K = 16
+DEFAULT_RESERVOIR_SIZE = 100000
+DEFAULT_RESOLUTION = 0.002
+
+
+def _smallest(keys, k):
+    # indices of the k smallest keys, sorted
+    if len(keys) > k:
+        index = np.argpartition(keys, k)[:k]
+    else:
+        index = np.arange(len(keys))
+    return index[np.argsort(keys[index], kind='stable')]
+
+
+def _candidate_keys(name):
+    # sort key of every kind of candidate (smallest first) from the joined candidate fields
+    if name == "max_sharpe":
+        return lambda c: -_sharpe(c["mean"], c["sd"])
+    if name == "min_risk":
+        return lambda c: c["sd"]
+    if name == MIN_CVAR:
+        return lambda c: np.where(np.isnan(c["cvar"][:, 0]), np.inf, c["cvar"][:, 0])
+    if name == MAX_RETURN_CVAR:
+        return lambda c: np.where(np.isnan(c["return_cvar"]), np.inf, -c["return_cvar"])
+    raise ValueError(f"Unknown candidate: {name}")
+
+
+def _sharpe(p_mean, p_sd):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = p_mean / p_sd
+    return np.where(np.isnan(sharpe), -np.inf, sharpe)
+
+
+class PortfolioReducer:
+
+    def __init__(self, num_assets, top_k=DEFAULT_TOP_K, reservoir_size=DEFAULT_RESERVOIR_SIZE,
+                 resolution=DEFAULT_RESOLUTION, seed=None, dtype=np.float64):
+        self.top_k = top_k
+        self.reservoir_size = reservoir_size
+        self.log_step = np.log1p(resolution)
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        empty = {"weights": np.empty((0, num_assets), dtype=dtype), "mean": np.empty(0, dtype=dtype),
+                 "sd": np.empty(0, dtype=dtype)}
+        self.max_sharpe = dict(empty)
+        self.min_risk = dict(empty)
+        # {MIN_CVAR: candidates, MAX_RETURN_CVAR: candidates} once tail risk metrics are passed to update()
+        self.risk = {}
+        self.envelope_bin = np.empty(0, dtype=np.int64)
+        self.envelope_mean = np.empty(0, dtype=dtype)
+        self.envelope_sd = np.empty(0, dtype=dtype)
+        self.reservoir_key = np.empty(0)
+        self.reservoir_mean = np.empty(0, dtype=dtype)
+        self.reservoir_sd = np.empty(0, dtype=dtype)
+
+    def _keep_candidates(self, current, new, name):
+        # best top_k of the current and new candidates (dicts of arrays with one row per portfolio)
+        joined = new if current is None else {field: np.concatenate((current[field], new[field])) for field in new}
+        index = _smallest(_candidate_keys(name)(joined), self.top_k)
+        return {field: values[index] for field, values in joined.items()}
+
+    def _keep_envelope(self, bins, p_mean, p_sd):
+        bins = np.concatenate((self.envelope_bin, bins))
+        p_mean = np.concatenate((self.envelope_mean, p_mean))
+        p_sd = np.concatenate((self.envelope_sd, p_sd))
+        # sort by bin, best return first within a bin, and keep the first row of every bin
+        order = np.lexsort((-p_mean, bins))
+        bins = bins[order]
+        first = np.ones(len(bins), dtype=bool)
+        first[1:] = bins[1:] != bins[:-1]
+        keep = order[first]
+        self.envelope_bin, self.envelope_mean, self.envelope_sd = bins[first], p_mean[keep], p_sd[keep]
+
+    def _keep_reservoir(self, keys, p_mean, p_sd):
+        keys = np.concatenate((self.reservoir_key, keys))
+        index = _smallest(keys, self.reservoir_size)
+        index.sort()
+        self.reservoir_key = keys[index]
+        self.reservoir_mean = np.concatenate((self.reservoir_mean, p_mean))[index]
+        self.reservoir_sd = np.concatenate((self.reservoir_sd, p_sd))[index]
+
+    def update(self, w, p_mean, p_sd, risk_metrics=None):
+        # add one chunk of simulated portfolios (weights, means, sds), optionally with their tail risk metrics
+        # (HistoricalRisk.metrics of the chunk)
+        if len(p_mean) == 0:
+            return self
+        self.count += len(p_mean)
+        chunk = {"weights": w, "mean": p_mean, "sd": p_sd}
+        self.max_sharpe = self._keep_candidates(self.max_sharpe, chunk, "max_sharpe")
+        self.min_risk = self._keep_candidates(self.min_risk, chunk, "min_risk")
+        if risk_metrics is not None:
+            chunk.update(risk_metrics)
+            for name in RISK_PORTFOLIOS:
+                self.risk[name] = self._keep_candidates(self.risk.get(name), chunk, name)
+        with np.errstate(divide='ignore'):
+            bins = np.floor(np.log(p_sd) / self.log_step)
+        bins = np.nan_to_num(bins, nan=0.0, neginf=np.iinfo(np.int32).min).astype(np.int64)
+        self._keep_envelope(bins, p_mean, p_sd)
+        self._keep_reservoir(self.rng.random(len(p_mean)), p_mean, p_sd)
+        return self
+
+    def merge(self, other):
+        # combine with the reducer of another chunk / worker (same resolution and reservoir size)
+        if other.count == 0:
+            return self
+        self.count += other.count
+        self.max_sharpe = self._keep_candidates(self.max_sharpe, other.max_sharpe, "max_sharpe")
+        self.min_risk = self._keep_candidates(self.min_risk, other.min_risk, "min_risk")
+        for name, candidates in other.risk.items():
+            self.risk[name] = self._keep_candidates(self.risk.get(name), candidates, name)
+        self._keep_envelope(other.envelope_bin, other.envelope_mean, other.envelope_sd)
+        self._keep_reservoir(other.reservoir_key, other.reservoir_mean, other.reservoir_sd)
+        return self
+
+    def best(self):
+        # (max sharpe weights, max sharpe stats, min risk weights, min risk stats), stats = [[mean, sd, sharpe]]
+        def stats(candidates):
+            mean, sd = candidates["mean"][0], candidates["sd"][0]
+            return np.array([[mean, sd, _sharpe(mean, sd)]])
+
+        return (self.max_sharpe["weights"][0], stats(self.max_sharpe),
+                self.min_risk["weights"][0], stats(self.min_risk))
+
+    def best_risk(self):
+        # {MIN_CVAR / MAX_RETURN_CVAR: (weights, stats [[mean, sd, sharpe]], tail risk metrics of the portfolio)},
+        # empty without tail risk metrics
+        out = {}
+        for name, candidates in self.risk.items():
+            mean, sd = candidates["mean"][0], candidates["sd"][0]
+            metrics = {field: values[0] for field, values in candidates.items()
+                       if field not in ("weights", "mean", "sd")}
+            out[name] = (candidates["weights"][0], np.array([[mean, sd, _sharpe(mean, sd)]]), metrics)
+        return out
+
+    def envelope(self):
+        # (sd, mean) of the best portfolio of every volatility bin, by increasing volatility
+        return self.envelope_sd, self.envelope_mean
+
+    def sample(self):
+        # (means, sds) of the reservoir sample
+        return self.reservoir_mean, self.reservoir_sd
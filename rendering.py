@@ -0,0 +1,81 @@
+import numpy as np
+
+# SCALABLE MONTE CARLO SCATTER RENDERING
+# ----------------------------------------------------------------------------------------------------------------------
+# Drawing every simulated portfolio as a marker makes the chart slower than the simulation itself. Instead the
+# portfolios are aggregated into a fixed size raster (2-D histogram over volatility x return), each bin coloured by
+# the max or mean sharpe ratio of the portfolios that fall in it, and the upper-left hull of the cloud (the sampled
+# efficient frontier) is drawn on top. Drawing cost and image size no longer depend on the number of portfolios.
+
+DEFAULT_BINS = (320, 200)
+
+
+def density_raster(p_sd, p_mean, bins=DEFAULT_BINS, statistic="max"):
+    # returns (grid (ny x nx) of the sharpe ratio statistic per bin, NaN for empty bins, extent (x0, x1, y0, y1))
+    p_sd = np.asarray(p_sd, dtype=np.float64)
+    p_mean = np.asarray(p_mean, dtype=np.float64)
+    nx, ny = bins
+    x0, x1 = float(p_sd.min()), float(p_sd.max())
+    y0, y1 = float(p_mean.min()), float(p_mean.max())
+    # avoid zero width ranges when every portfolio has the same value
+    x1 = x1 if x1 > x0 else x0 + 1e-12
+    y1 = y1 if y1 > y0 else y0 + 1e-12
+
+    ix = np.minimum(((p_sd - x0) / (x1 - x0) * nx).astype(np.int64), nx - 1)
+    iy = np.minimum(((p_mean - y0) / (y1 - y0) * ny).astype(np.int64), ny - 1)
+    flat = iy * nx + ix
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = p_mean / p_sd
+
+    if statistic == "mean":
+        counts = np.bincount(flat, minlength=nx * ny)
+        totals = np.bincount(flat, weights=sharpe, minlength=nx * ny)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grid = totals / counts
+    elif statistic == "max":
+        grid = np.full(nx * ny, -np.inf)
+        np.maximum.at(grid, flat, sharpe)
+        grid[np.isneginf(grid)] = np.nan
+    else:
+        raise ValueError(f"Unknown statistic: {statistic}")
+
+    return grid.reshape(ny, nx), (x0, x1, y0, y1)
+
+
+def efficient_hull(p_sd, p_mean):
+    # vertices (sd, mean) of the upper-left convex hull of the simulated portfolios, from the minimum volatility
+    # portfolio to the maximum return portfolio.
+    # Only portfolios that are not beaten by a less volatile one can be on that hull, a running maximum over the
+    # portfolios sorted by volatility finds them, so the python hull loop only sees a few hundred points.
+    p_sd = np.asarray(p_sd, dtype=np.float64)
+    p_mean = np.asarray(p_mean, dtype=np.float64)
+    order = np.argsort(p_sd, kind='stable')
+    mean_sorted = p_mean[order]
+    best_before = np.maximum.accumulate(np.concatenate(([-np.inf], mean_sorted[:-1])))
+    candidates = order[mean_sorted > best_before]
+    xs = p_sd[candidates].tolist()
+    ys = p_mean[candidates].tolist()
+
+    # monotone chain, keep only right turns (upper hull)
+    hull = []
+    for point in zip(xs, ys):
+        while len(hull) >= 2:
+            (ax, ay), (bx, by) = hull[-2], hull[-1]
+            if (bx - ax) * (point[1] - ay) - (by - ay) * (point[0] - ax) >= 0:
+                hull.pop()
+            else:
+                break
+        hull.append(point)
+    hull = np.array(hull)
+    return hull[:, 0], hull[:, 1]
+
+
+def plot_portfolio_density(ax, p_sd, p_mean, bins=DEFAULT_BINS, statistic="max", cmap="Spectral", envelope=None):
+    # draw the raster and the hull on a matplotlib axis, returns the image (for the colour bar).
+    # envelope: optional (sd, mean) of the best portfolio per volatility bin of the whole simulation (see
+    # reduction.py) when p_sd / p_mean are only a sample of it, the hull is then taken over the envelope
+    grid, extent = density_raster(p_sd, p_mean, bins, statistic)
+    image = ax.imshow(grid, origin="lower", extent=extent, aspect="auto", cmap=cmap, interpolation="nearest")
+    hull_sd, hull_mean = efficient_hull(*(envelope if envelope is not None else (p_sd, p_mean)))
+    ax.plot(hull_sd, hull_mean, color="black", linewidth=1, linestyle="--", label="Upper boundary of simulation")
+    return image
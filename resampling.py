@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+
+from optimise import global_minimum_variance, max_sharpe
+from parallel_simulation import _SHARED, _share, _use_shared, run_tasks
+
+# RESAMPLED (BOOTSTRAP) OPTIMAL PORTFOLIOS
+# ----------------------------------------------------------------------------------------------------------------------
+# The exact optimum of one mean / covariance estimate is very sensitive to estimation noise: moving the date range
+# by a few weeks can move most of the max sharpe weight to another asset. Instead, B resamples of the daily log
+# returns are drawn, every resample is optimised and the weights are averaged (resampled efficiency), the spread of
+# the weights over the resamples gives a confidence band for every asset:
+#   - moving block bootstrap: every resample is made of blocks of block_size consecutive days starting at random
+#     days (wrapping around the end), which keeps volatility clustering and short term cross correlation
+#   - a resample only changes how often every day is used, so it is stored as a (B x T) matrix of day counts C and
+#     the moments of a batch of resamples are two matrix products: mean_b = c_b R / T and
+#     cov_b = (R' diag(c_b) R - T mean_b mean_b') / (T - 1), (B x n x n) in one batched matmul
+#   - the resamples are split into fixed size tasks, every task has its own random stream spawned from one
+#     SeedSequence, the returns are placed in shared memory once and the tasks run on the shared process pool (see
+#     parallel_simulation.py), so the result for a seed does not depend on the number of workers
+# Days with a missing return for any asset are left out. Averaged weights keep any weight constraints, the feasible
+# weights are convex.
+
+DEFAULT_NUM_RESAMPLES = 500
+# one trading month per block
+DEFAULT_BLOCK_SIZE = 21
+# lower / upper quantile of the weight bands
+DEFAULT_BAND = (0.05, 0.95)
+TASK_RESAMPLES = 25
+# resamples whose (T x n) weighted returns are formed at once
+BATCH_RESAMPLES = 8
+
+
+def block_bootstrap_counts(rng, num_days, num_resamples, block_size=DEFAULT_BLOCK_SIZE):
+    # (num_resamples x num_days) number of times every day is drawn by a moving block bootstrap, every row sums to
+    # num_days
+    block_size = max(1, min(block_size, num_days))
+    num_blocks = -(-num_days // block_size)
+    starts = rng.integers(0, num_days, size=(num_resamples, num_blocks))
+    days = (starts[:, :, None] + np.arange(block_size)).reshape(num_resamples, -1)[:, :num_days] % num_days
+    flat = (days + np.arange(num_resamples)[:, None] * num_days).ravel()
+    return np.bincount(flat, minlength=num_resamples * num_days).reshape(num_resamples, num_days)
+
+
+def resampled_moments(returns, counts, num_trading_days=252):
+    # annualised (B x n) means and (B x n x n) covariances of the resamples given by the day counts (B x T)
+    num_days = returns.shape[0]
+    # centred on the full sample mean first, the resampled sums stay small
+    centre = returns.mean(axis=0)
+    x = returns - centre
+    counts = counts.astype(np.float64)
+    mean = counts @ x / num_days
+    cov = np.empty((len(counts), x.shape[1], x.shape[1]))
+    for start in range(0, len(counts), BATCH_RESAMPLES):
+        batch = counts[start:start + BATCH_RESAMPLES]
+        cov[start:start + BATCH_RESAMPLES] = np.matmul(x.T[None, :, :], batch[:, :, None] * x[None, :, :])
+    cov -= num_days * mean[:, :, None] * mean[:, None, :]
+    cov /= num_days - 1
+    return (mean + centre) * num_trading_days, cov * num_trading_days
+
+
+def _optimise_resamples(returns, num_resamples, seed_sequence, block_size, num_trading_days, constraints):
+    # (max sharpe weights, min risk weights) of num_resamples resamples, both (num_resamples x n)
+    rng = np.random.default_rng(seed_sequence)
+    counts = block_bootstrap_counts(rng, len(returns), num_resamples, block_size)
+    means, covs = resampled_moments(returns, counts, num_trading_days)
+    w_max_sharpe = np.array([max_sharpe(mean, cov, constraints) for mean, cov in zip(means, covs)])
+    w_min_risk = np.array([global_minimum_variance(cov, constraints=constraints) for cov in covs])
+    return w_max_sharpe, w_min_risk
+
+
+def _resample_task(specs, num_resamples, seed_sequence, block_size, num_trading_days, constraints):
+    # worker: optimise one task of resamples of the shared returns
+    _use_shared(specs)
+    return _optimise_resamples(_SHARED["returns"][1], num_resamples, seed_sequence, block_size, num_trading_days,
+                               constraints)
+
+
+def resample_portfolios(log_returns, num_resamples=DEFAULT_NUM_RESAMPLES, block_size=DEFAULT_BLOCK_SIZE, workers=1,
+                        seed=None, num_trading_days=252, constraints=None, task_size=TASK_RESAMPLES, progress=None):
+    # (max sharpe weights, min risk weights) of every resample, both (num_resamples x n), for (T x n) daily log
+    # returns (array or dataframe). workers > 1 runs the tasks on a process pool.
+    # progress: optional function called with the number of optimised resamples after every task, an exception it
+    # raises stops the run
+    returns = np.asarray(log_returns, dtype=np.float64)
+    returns = np.ascontiguousarray(returns[np.isfinite(returns).all(axis=1)])
+    if len(returns) < 2:
+        raise ValueError("Not enough daily returns to resample")
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    sizes = [min(task_size, num_resamples - start) for start in range(0, num_resamples, task_size)]
+    task_seeds = seed_sequence.spawn(len(sizes))
+
+    def collect(result):
+        results.append(result)
+        if progress is not None:
+            progress(sum(len(r[0]) for r in results))
+
+    results = []
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(sizes) <= 1:
+        for size, task_seed in zip(sizes, task_seeds):
+            collect(_optimise_resamples(returns, size, task_seed, block_size, num_trading_days, constraints))
+    else:
+        blocks = []
+        try:
+            specs = {"returns": _share(returns, blocks)}
+            run_tasks(workers, _resample_task, [(specs, size, task_seed, block_size, num_trading_days, constraints)
+                                                for size, task_seed in zip(sizes, task_seeds)], collect)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def weight_bands(weights, band=DEFAULT_BAND):
+    # (averaged weights, lower quantile, upper quantile) of the weights of every asset over the resamples,
+    # the averaged weights sum to 1
+    mean = weights.mean(axis=0)
+    lower, upper = np.quantile(weights, band, axis=0)
+    return mean / mean.sum(), lower, upper
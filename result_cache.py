@@ -0,0 +1,196 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+
+import numpy as np
+import pandas as pd
+
+# MEMOIZED RESULT CACHE
+# ----------------------------------------------------------------------------------------------------------------------
+# Streamlit re-runs the whole script on every interaction. Intermediate artefacts of a run (aligned prices, log
+# returns, moments, simulation summary, optimal weights, equity curves) are memoized here, keyed by stage and by
+# (sorted tickers, start date, end date, simulation parameters, ALGORITHM_VERSION).
+#   - memory tier: LRU, bounded by the estimated size of the stored values in bytes
+#   - disk tier (optional): one pickle file per entry, survives restarts of the app
+# This module is imported (not re-executed) on every streamlit rerun, so DEFAULT_CACHE lives as long as the process
+# and is shared by every browser session of the server:
+#   - single-flight: while a value is being computed, other threads asking for the same stage and key wait for that
+#     computation instead of starting their own (50 users submitting the default basket run it once). Its error is
+#     raised in every waiting thread, only a stopped computation (e.g. a cancelled job) is run again by a waiter
+#   - values are shared by reference, not copied: the numpy arrays of a stored value are made read-only, pandas
+#     objects must not be modified in place by the page (every stage selects / reorders into new objects)
+#   - one memory budget for the whole process, least recently used values are evicted first
+
+# bump when a change to the analytics makes previously cached results invalid
+ALGORITHM_VERSION = 1
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+# directory of the disk tier, disabled when the environment variable is not set
+DISK_DIR_ENV = "MPT_RESULT_CACHE_DIR"
+# memory budget of the process-wide cache in bytes
+MAX_BYTES_ENV = "MPT_RESULT_CACHE_BYTES"
+# seconds between two calls of the check function of a thread waiting for another thread's computation
+WAIT_INTERVAL = 0.25
+
+
+def basket_key(tickers, start_date, end_date, *params):
+    # cache key of a basket over a date range, extra parameters (e.g. number of portfolios, seed) are appended
+    return (tuple(sorted(tickers)), str(start_date), str(end_date)) + tuple(params) + (ALGORITHM_VERSION,)
+
+
+def estimate_size(value):
+    # approximate memory used by a cached value in bytes
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if hasattr(value, "nbytes"):
+        # array-like containers, e.g. covariance.FactorCovariance
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+
+def freeze(value):
+    # make the numpy arrays of a value (also inside tuples, lists and dicts) read-only, returns the value
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            freeze(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            freeze(item)
+    return value
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # lookups that waited for a computation of another thread instead of computing the value again
+        self.joined = 0
+        self._entries = OrderedDict()
+        # (stage, key) -> Future of the computation in progress
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _disk_path(self, stage, key):
+        digest = hashlib.sha1(repr((stage, key)).encode()).hexdigest()
+        return os.path.join(self.disk_dir, f"{stage}-{digest}.pkl")
+
+    def _put_memory(self, full_key, value):
+        freeze(value)
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if full_key in self._entries:
+                self.current_bytes -= self._entries.pop(full_key)[1]
+            self._entries[full_key] = (value, size)
+            self.current_bytes += size
+            # evict least recently used entries until the cache fits its budget again
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def get(self, stage, key, default=None):
+        full_key = (stage, key)
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is not None:
+                self._entries.move_to_end(full_key)
+                self.hits += 1
+                return entry[0]
+
+        if self.disk_dir is not None:
+            try:
+                with open(self._disk_path(stage, key), "rb") as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+            else:
+                self._put_memory(full_key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, stage, key, value):
+        self._put_memory((stage, key), value)
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            path = self._disk_path(stage, key)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+
+    def get_or_compute(self, stage, key, compute, check=None, retry_on=()):
+        # cached value of stage for key, computing and storing it on a miss. Concurrent misses for the same stage and
+        # key compute it once: the first thread computes, the others wait for its value and get its exception when it
+        # fails. When that computation was stopped instead (an exception of retry_on, e.g. jobs.JobCancelled, or a
+        # BaseException such as a stopped page run) a waiting thread computes the value itself.
+        # check: optional function called every WAIT_INTERVAL seconds while waiting, an exception it raises stops the
+        # wait (e.g. job.check() of a cancelled job)
+        sentinel = object()
+        value = self.get(stage, key, sentinel)
+        if value is not sentinel:
+            return value
+
+        full_key = (stage, key)
+        while True:
+            with self._lock:
+                entry = self._entries.get(full_key)
+                if entry is not None:
+                    # stored by another thread since the lookup above
+                    return entry[0]
+                future = self._inflight.get(full_key)
+                if future is None:
+                    future = self._inflight[full_key] = Future()
+                    break
+                self.joined += 1
+            while not wait([future], timeout=WAIT_INTERVAL).done:
+                if check is not None:
+                    check()
+            error = future.exception()
+            if error is None:
+                return future.result()
+            if isinstance(error, Exception) and not isinstance(error, retry_on):
+                raise error
+
+        try:
+            value = compute()
+            self.put(stage, key, value)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            with self._lock:
+                del self._inflight[full_key]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+DEFAULT_CACHE = ResultCache(int(os.environ.get(MAX_BYTES_ENV, DEFAULT_MAX_BYTES)),
+                            disk_dir=os.environ.get(DISK_DIR_ENV) or None)
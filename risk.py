@@ -0,0 +1,114 @@
+import numpy as np
+
+# HISTORICAL TAIL RISK
+# ----------------------------------------------------------------------------------------------------------------------
+# Daily returns are fat tailed (see the distribution stage), the annualised standard deviation alone understates the
+# losses of concentrated portfolios. The risk of every simulated portfolio is also measured on the history:
+# for a batch of weights W (rows x n) the daily returns of all its portfolios are one matrix product W R' with
+# R the (days x n) simple daily returns of the assets (portfolios rebalanced daily), one contiguous row of days per
+# portfolio, then per portfolio:
+#   - historical VaR at confidence c: the daily loss exceeded on (1 - c) of the days, CVaR: the mean loss over those
+#     days. The worst days are found with a partial sort (np.partition, O(days) per portfolio), only that tail of
+#     k = (1 - c) * days returns is sorted
+#   - max drawdown of the compounded portfolio value
+#   - Sortino ratio: annualised mean return / annualised downside deviation (target return 0)
+#   - return / CVaR: mean daily return / CVaR at the first confidence level, the reward per unit of tail risk
+# A batch is split so the (days x rows) return matrix stays below max_elements values.
+
+CONFIDENCE_LEVELS = (0.9, 0.95, 0.99)
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_MAX_ELEMENTS = 2 ** 22
+# tail risk portfolios picked from the simulation
+MIN_CVAR = "min_cvar"
+MAX_RETURN_CVAR = "max_return_cvar"
+RISK_PORTFOLIOS = (MIN_CVAR, MAX_RETURN_CVAR)
+
+
+def tail_size(num_days, confidence):
+    # number of worst days averaged by the CVaR (the VaR is the best of them), at least 1
+    return max(1, int(np.ceil(round((1 - confidence) * num_days, 9))))
+
+
+class HistoricalRisk:
+
+    def __init__(self, simple_returns, confidence_levels=(DEFAULT_CONFIDENCE,), num_trading_days=252,
+                 max_elements=DEFAULT_MAX_ELEMENTS, dtype=np.float64):
+        # simple_returns: (days x n) simple daily returns of the assets, the first confidence level ranks portfolios
+        self.returns = np.ascontiguousarray(simple_returns, dtype=dtype)
+        self.confidence_levels = tuple(confidence_levels)
+        self.num_trading_days = num_trading_days
+        self.max_elements = max_elements
+        self.tails = [tail_size(len(self.returns), c) for c in self.confidence_levels]
+
+    @classmethod
+    def from_log_returns(cls, log_returns, confidence_levels=(DEFAULT_CONFIDENCE,), num_trading_days=252,
+                         max_elements=DEFAULT_MAX_ELEMENTS, dtype=np.float64):
+        # from (days x n) log returns (array or dataframe), missing returns count as 0
+        log_returns = np.nan_to_num(np.asarray(log_returns, dtype=np.float64))
+        return cls(np.expm1(log_returns), confidence_levels, num_trading_days, max_elements, dtype)
+
+    def params(self):
+        # constructor arguments other than the returns (e.g. to rebuild the model in a worker process)
+        return {"confidence_levels": self.confidence_levels, "num_trading_days": self.num_trading_days,
+                "max_elements": self.max_elements, "dtype": self.returns.dtype}
+
+    def metrics(self, w):
+        # tail risk of every row of the weight matrix w: dict of arrays with one row per portfolio,
+        # "var" and "cvar" are (rows x confidence levels), losses are positive numbers
+        w = np.atleast_2d(np.asarray(w, dtype=self.returns.dtype))
+        rows = len(w)
+        levels = len(self.confidence_levels)
+        out = {"mean_daily": np.empty(rows), "var": np.empty((rows, levels)), "cvar": np.empty((rows, levels)),
+               "max_drawdown": np.empty(rows), "sortino": np.empty(rows), "return_cvar": np.empty(rows)}
+        batch = max(1, self.max_elements // max(len(self.returns), 1))
+        for start in range(0, rows, batch):
+            end = min(start + batch, rows)
+            self._batch_metrics(w[start:end], {key: values[start:end] for key, values in out.items()})
+        return out
+
+    def _batch_metrics(self, w, out):
+        # fills the views in out for one batch
+        days = len(self.returns)
+        if days == 0:
+            for values in out.values():
+                values[...] = np.nan
+            return
+        r = w @ self.returns.T
+        mean = r.mean(axis=1)
+        scratch = np.minimum(r, 0)
+        downside = np.sqrt(np.einsum('ij,ij->i', scratch, scratch) / days)
+
+        # drawdown of the value exp(cumulative log return) from its running peak (the start value is a peak)
+        np.maximum(r, -1 + 1e-12, out=scratch)
+        np.log1p(scratch, out=scratch)
+        np.cumsum(scratch, axis=1, out=scratch)
+        peak = np.maximum.accumulate(scratch, axis=1)
+        np.maximum(peak, 0, out=peak)
+        np.subtract(scratch, peak, out=scratch)
+        out["max_drawdown"][:] = -np.expm1(scratch.min(axis=1))
+        del scratch, peak
+
+        # in place partial sort: the k worst days of the widest tail first, then only that tail is sorted
+        widest = max(self.tails)
+        r.partition(widest - 1, axis=1)
+        tail = np.sort(r[:, :widest], axis=1)
+        worst = np.cumsum(tail, axis=1)
+        for level, k in enumerate(self.tails):
+            out["var"][:, level] = -tail[:, k - 1]
+            out["cvar"][:, level] = -worst[:, k - 1] / k
+
+        out["mean_daily"][:] = mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out["sortino"][:] = mean / downside * np.sqrt(self.num_trading_days)
+            out["return_cvar"][:] = mean / out["cvar"][:, 0]
+
+    def describe(self, w):
+        # tail risk of one portfolio as a flat dict of floats, e.g. {"var_0.95": ..., "cvar_0.95": ..., ...}
+        metrics = self.metrics(w)
+        out = {}
+        for level, confidence in enumerate(self.confidence_levels):
+            out[f"var_{confidence:g}"] = float(metrics["var"][0, level])
+            out[f"cvar_{confidence:g}"] = float(metrics["cvar"][0, level])
+        for key in ("max_drawdown", "sortino", "return_cvar"):
+            out[key] = float(metrics[key][0])
+        return out
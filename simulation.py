@@ -0,0 +1,274 @@
+import warnings
+
+import numpy as np
+
+from covariance import FactorCovariance, covariance_array
+from reduction import DEFAULT_RESERVOIR_SIZE, DEFAULT_TOP_K, PortfolioReducer
+
+# MONTE CARLO PORTFOLIO SIMULATION
+# ----------------------------------------------------------------------------------------------------------------------
+# Random portfolios are generated in chunks: each chunk is a (chunk x n_assets) weight matrix, and the mean and
+# variance of every portfolio in the chunk are computed with matrix operations instead of a python loop.
+#
+# Samplers (how a chunk of weights is drawn):
+#   "uniform"   normalised uniform draws (the original sampler), concentrates portfolios near equal weights
+#   "dirichlet" flat Dirichlet, uniform over the simplex
+#   "sobol"     scrambled Sobol points mapped onto the simplex, a flat Dirichlet with low discrepancy
+#   "sparse"    random subsets of 1..n assets (log-uniform size) with Dirichlet weights on the subset, reaches the
+#               corners and edges of the simplex where the long-only efficient frontier lies
+# With weight constraints (bounds, asset class limits, see constraints.py) every sampler is replaced by a hit-and-run
+# walk inside the constrained polytope: a fixed number of chains, every chain moves `thin` random steps between two
+# draws. Every step is accepted, the cost does not depend on how small the feasible region is.
+# With a tolerance set, the simulation stops as soon as the best sharpe ratio and the minimum volatility have not
+# improved by more than tol (relative) for `patience` consecutive batches, and for at least as many portfolios as
+# were drawn before the last improvement. num_portfolios is then an upper bound.
+
+DEFAULT_CHUNK_SIZE = 65536
+UNIFORM = "uniform"
+DIRICHLET = "dirichlet"
+SOBOL = "sobol"
+SPARSE = "sparse"
+SAMPLERS = (UNIFORM, DIRICHLET, SOBOL, SPARSE)
+# portfolios per convergence check (a power of 2 keeps the sobol sequence balanced)
+CONVERGENCE_BATCH = 8192
+DEFAULT_PATIENCE = 3
+# hit-and-run chains, steps before the first draw of a chain (at least twice the number of assets) and between two
+# draws of a chain
+DEFAULT_CHAINS = 1024
+DEFAULT_BURN_IN = 50
+DEFAULT_THIN = 5
+
+
+def make_rng(seed=None):
+    # accepts None (fresh entropy), an int seed or an existing np.random.Generator
+    return np.random.default_rng(seed)
+
+
+def random_weights(rng, num_rows, num_assets, dtype=np.float64):
+    # generate a (num_rows x num_assets) matrix of random weights, every row sums to 1
+    w = rng.random((num_rows, num_assets), dtype=dtype)
+    w /= w.sum(axis=1, keepdims=True)
+    return w
+
+
+def _normalise(w):
+    w /= w.sum(axis=1, keepdims=True)
+    return w
+
+
+def dirichlet_weights(rng, num_rows, num_assets, dtype=np.float64):
+    # flat Dirichlet: normalised standard exponential draws are uniformly distributed over the simplex
+    return _normalise(rng.standard_exponential((num_rows, num_assets), dtype=dtype))
+
+
+def sparse_weights(rng, num_rows, num_assets, dtype=np.float64):
+    # Dirichlet weights on a random subset of assets, subset sizes are log-uniform in [1, n] so single asset
+    # corners, small subsets (edges / faces of the simplex) and fully diversified portfolios are all sampled
+    sizes = np.exp(rng.random(num_rows) * np.log(num_assets + 1))
+    sizes = np.clip(sizes, 1, num_assets)
+    # every asset is kept with probability size / n (no per row sort, O(n) per portfolio even for large baskets),
+    # the asset with the smallest key is always kept so no row is empty
+    keys = rng.random((num_rows, num_assets))
+    keep = keys < (sizes / num_assets)[:, None]
+    keep[np.arange(num_rows), keys.argmin(axis=1)] = True
+    w = rng.standard_exponential((num_rows, num_assets), dtype=dtype)
+    w[~keep] = 0
+    return _normalise(w)
+
+
+class SobolWeights:
+    # scrambled sobol points u in (0, 1)^n mapped onto the simplex with w = -log(u) / sum(-log(u)),
+    # the quasi-random counterpart of the flat Dirichlet sampler (needs scipy)
+
+    def __init__(self, rng, num_assets):
+        from scipy.stats import qmc
+        self.engine = qmc.Sobol(num_assets, scramble=True, seed=rng)
+
+    def __call__(self, rng, num_rows, num_assets, dtype=np.float64):
+        with warnings.catch_warnings():
+            # sobol balance warnings for a last chunk that is not a power of 2
+            warnings.simplefilter("ignore", UserWarning)
+            u = self.engine.random(num_rows)
+        u = np.clip(u, np.finfo(np.float64).tiny, 1.0)
+        return _normalise((-np.log(u)).astype(dtype, copy=False))
+
+
+class HitAndRunWeights:
+    # uniform weights inside the polytope of a constraints.WeightConstraints: at every step a chain draws a random
+    # direction that keeps the total weight (and the totals of fixed groups), finds the feasible segment through its
+    # current weights along it and jumps to a uniform point of the segment
+
+    def __init__(self, rng, constraints, num_chains=DEFAULT_CHAINS, burn_in=None, thin=DEFAULT_THIN):
+        self.constraints = constraints
+        self.blocks = constraints.free_blocks()
+        self.num_chains = num_chains
+        self.burn_in = max(DEFAULT_BURN_IN, 2 * len(constraints)) if burn_in is None else burn_in
+        self.thin = thin
+        self.state = None
+
+    def _direction(self, rng, rows, dtype):
+        d = rng.standard_normal((rows, len(self.blocks))).astype(dtype, copy=False)
+        d[:, self.blocks < 0] = 0
+        for block in np.unique(self.blocks[self.blocks >= 0]):
+            members = self.blocks == block
+            d[:, members] -= d[:, members].mean(axis=1, keepdims=True)
+        return d
+
+    def _step(self, rng, w, steps):
+        for _ in range(steps):
+            d = self._direction(rng, len(w), w.dtype)
+            t_min, t_max = self.constraints.segment(w, d)
+            t = t_min + (t_max - t_min) * rng.random(len(w), dtype=w.dtype)
+            w += t[:, None] * d
+            # round-off can leave a bound by ~1e-16
+            np.clip(w, self.constraints.lower, self.constraints.upper, out=w)
+        return w
+
+    def __call__(self, rng, num_rows, num_assets, dtype=np.float64):
+        if self.state is None:
+            # the chains start from a feasible point and are burnt in
+            start = np.tile(self.constraints.feasible_point().astype(dtype), (self.num_chains, 1))
+            self.state = self._step(rng, start, self.burn_in)
+        w = np.empty((num_rows, num_assets), dtype=dtype)
+        for row in range(0, num_rows, self.num_chains):
+            self.state = self._step(rng, self.state, self.thin)
+            w[row:row + self.num_chains] = self.state[:num_rows - row]
+        return w
+
+
+def make_sampler(sampler, rng, num_assets, constraints=None):
+    # weight sampler function (rng, num_rows, num_assets, dtype) -> weights for a sampler name,
+    # a hit-and-run walk for any sampler when there are weight constraints
+    if constraints is not None and not constraints.is_trivial():
+        return HitAndRunWeights(rng, constraints)
+    if sampler == UNIFORM:
+        return random_weights
+    if sampler == DIRICHLET:
+        return dirichlet_weights
+    if sampler == SPARSE:
+        return sparse_weights
+    if sampler == SOBOL:
+        return SobolWeights(rng, num_assets)
+    raise ValueError(f"Unknown sampler: {sampler}")
+
+
+class ConvergenceMonitor:
+    # tracks the best sharpe ratio and the minimum volatility seen so far, converged once neither has improved
+    # by more than tol (relative) for `patience` consecutive batches and for as many portfolios as it took to reach
+    # the last improvement (improvements get rarer as the sample grows, a fixed window would stop too early)
+
+    def __init__(self, tol, patience=DEFAULT_PATIENCE):
+        self.tol = tol
+        self.patience = patience
+        self.best_sharpe = -np.inf
+        self.min_sd = np.inf
+        self.stable_batches = 0
+        self.seen = 0
+        self.improved_at = 0
+
+    def update(self, p_mean, p_sd, count=None):
+        # returns True once converged, count is the size of the batch when only its best portfolios are passed
+        self.seen += len(p_mean) if count is None else count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            best_sharpe = float(np.nanmax(p_mean / p_sd, initial=-np.inf))
+        min_sd = float(np.min(p_sd, initial=np.inf))
+
+        sharpe_gain = best_sharpe - self.best_sharpe
+        sd_gain = self.min_sd - min_sd
+        improved = (sharpe_gain > self.tol * abs(self.best_sharpe) or
+                    sd_gain > self.tol * abs(self.min_sd) or
+                    not np.isfinite(self.best_sharpe) or not np.isfinite(self.min_sd))
+        self.best_sharpe = max(self.best_sharpe, best_sharpe)
+        self.min_sd = min(self.min_sd, min_sd)
+        if improved:
+            self.stable_batches = 0
+            self.improved_at = self.seen
+        else:
+            self.stable_batches += 1
+        return self.stable_batches >= self.patience and self.seen >= 2 * self.improved_at
+
+
+def portfolio_mean_sd(w, mean_return, cov_matrix):
+    # portfolio mean: W . mu for every row of the weight matrix
+    p_mean = w @ mean_return
+    if isinstance(cov_matrix, FactorCovariance):
+        # factor model: |W B|^2 + W^2 d row-wise, O(n * k) per portfolio (see covariance.py)
+        p_var = cov_matrix.portfolio_variance(w)
+    else:
+        # portfolio variance: diag(W . cov . W^T), computed row-wise without building the (chunk x chunk) matrix
+        p_var = np.einsum('ij,ij->i', w @ cov_matrix, w)
+    # clip tiny negative values caused by floating point error before taking the square root
+    np.maximum(p_var, 0, out=p_var)
+    return p_mean, np.sqrt(p_var)
+
+
+def iter_random_portfolios(mean_return, cov_matrix, num_portfolios, chunk_size=DEFAULT_CHUNK_SIZE,
+                           dtype=np.float64, seed=None, sampler=UNIFORM, tol=None, patience=DEFAULT_PATIENCE,
+                           constraints=None):
+    # generator yielding (weights, means, sds) for consecutive chunks of at most chunk_size portfolios,
+    # so memory is bounded by chunk_size * n_assets regardless of num_portfolios.
+    # With tol set, chunks are at most CONVERGENCE_BATCH portfolios and the generator stops once converged.
+    rng = make_rng(seed)
+    dtype = np.dtype(dtype)
+    mean_return = np.asarray(mean_return, dtype=dtype)
+    cov_matrix = covariance_array(cov_matrix, dtype)
+    num_assets = len(mean_return)
+    chunk_size = max(1, int(chunk_size))
+    draw = make_sampler(sampler, rng, num_assets, constraints)
+    monitor = None
+    if tol is not None:
+        monitor = ConvergenceMonitor(tol, patience)
+        chunk_size = min(chunk_size, CONVERGENCE_BATCH)
+
+    done = 0
+    while done < num_portfolios:
+        rows = min(chunk_size, num_portfolios - done)
+        w = draw(rng, rows, num_assets, dtype)
+        p_mean, p_sd = portfolio_mean_sd(w, mean_return, cov_matrix)
+        yield w, p_mean, p_sd
+        done += rows
+        if monitor is not None and monitor.update(p_mean, p_sd):
+            break
+
+
+def simulate_portfolios(mean_return, cov_matrix, num_portfolios, chunk_size=DEFAULT_CHUNK_SIZE,
+                        dtype=np.float64, seed=None, sampler=UNIFORM, tol=None, patience=DEFAULT_PATIENCE,
+                        constraints=None):
+    # run the whole simulation and return the stacked (weights, means, sds) arrays,
+    # index in array corresponds to the nth random portfolio generated.
+    # When the simulation stops early the arrays are shorter than num_portfolios.
+    dtype = np.dtype(dtype)
+    num_assets = len(mean_return)
+    portfolio_weights = np.empty((num_portfolios, num_assets), dtype=dtype)
+    portfolio_mean = np.empty(num_portfolios, dtype=dtype)
+    portfolio_sd = np.empty(num_portfolios, dtype=dtype)
+
+    start = 0
+    for w, p_mean, p_sd in iter_random_portfolios(mean_return, cov_matrix, num_portfolios, chunk_size, dtype, seed,
+                                                  sampler, tol, patience, constraints):
+        end = start + len(w)
+        portfolio_weights[start:end] = w
+        portfolio_mean[start:end] = p_mean
+        portfolio_sd[start:end] = p_sd
+        start = end
+
+    if start < num_portfolios:
+        return portfolio_weights[:start].copy(), portfolio_mean[:start].copy(), portfolio_sd[:start].copy()
+    return portfolio_weights, portfolio_mean, portfolio_sd
+
+
+def reduce_portfolios(mean_return, cov_matrix, num_portfolios, chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64,
+                      seed=None, sampler=UNIFORM, tol=None, patience=DEFAULT_PATIENCE, top_k=DEFAULT_TOP_K,
+                      reservoir_size=DEFAULT_RESERVOIR_SIZE, risk=None, constraints=None, progress=None):
+    # run the simulation through a streaming PortfolioReducer (see reduction.py) instead of stacking every
+    # portfolio, memory is O(chunk_size * n_assets + reservoir_size) whatever num_portfolios.
+    # risk: optional risk.HistoricalRisk, the tail risk of every chunk is measured and its best portfolios kept
+    # progress: optional function called with the reducer after every chunk, an exception it raises stops the run
+    rng = make_rng(seed)
+    reducer = PortfolioReducer(len(mean_return), top_k, reservoir_size, seed=rng, dtype=dtype)
+    for w, p_mean, p_sd in iter_random_portfolios(mean_return, cov_matrix, num_portfolios, chunk_size, dtype, rng,
+                                                  sampler, tol, patience, constraints):
+        reducer.update(w, p_mean, p_sd, risk.metrics(w) if risk is not None else None)
+        if progress is not None:
+            progress(reducer)
+    return reducer
@@ -0,0 +1,184 @@
+import bisect
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# INDEXED TICKER UNIVERSE
+# ----------------------------------------------------------------------------------------------------------------------
+# All tickers of the three ticker CSVs (stocks, ETFs, top 100 crypto) in one index:
+#   - hash lookup from a "Ticker + Name" label (or a ticker) to its ticker and asset class
+#   - prefix search over tickers and names with binary search on sorted keys
+#   - substring search with str.find over one lowercase "haystack" string instead of a row-by-row scan
+# The index is saved as an .npz file next to the CSVs (every text column as one utf-8 blob, plus the sort
+# orders) and reloaded in milliseconds, it is rebuilt automatically when one of the CSVs changes.
+# shared_universe() keeps one loaded index per process for every session of the app.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCES = (
+    ("stock", "US STOCK TICKERS.csv"),
+    ("etf", "US ETF TICKERS.csv"),
+    ("crypto", "TOP 100 CRYPTO TICKERS csv.csv"),
+)
+ASSET_CLASSES = tuple(asset_class for asset_class, _ in SOURCES)
+DEFAULT_INDEX_PATH = os.path.join(BASE_DIR, ".universe_index.npz")
+SEPARATOR = "\n"
+
+# (base directory, source signature, universe) loaded by shared_universe()
+_SHARED = None
+_SHARED_LOCK = threading.Lock()
+
+
+def _source_signature(base_dir):
+    # size and modification time of every source CSV, used to detect a stale index file
+    signature = []
+    for _, file_name in SOURCES:
+        stat = os.stat(os.path.join(base_dir, file_name))
+        signature.append(f"{file_name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(signature)
+
+
+class TickerUniverse:
+
+    def __init__(self, tickers, labels, names, asset_class_codes, ticker_order=None, name_order=None):
+        self.tickers = list(tickers)
+        self.labels = list(labels)
+        self.names = list(names)
+        self.asset_class_codes = np.asarray(asset_class_codes, dtype=np.int8)
+
+        # hash lookups, the first occurrence wins (a ticker can be listed as a stock and as an etf)
+        self._by_label = {}
+        self._by_ticker = {}
+        for row in range(len(self.tickers) - 1, -1, -1):
+            self._by_label[self.labels[row]] = row
+            self._by_ticker[self.tickers[row]] = row
+
+        # sorted lowercase keys for prefix search (the sort orders are stored in the index file)
+        lower_tickers = [ticker.lower() for ticker in self.tickers]
+        lower_names = [name.lower() for name in self.names]
+        if ticker_order is None:
+            ticker_order = sorted(range(len(lower_tickers)), key=lower_tickers.__getitem__)
+        if name_order is None:
+            name_order = sorted(range(len(lower_names)), key=lower_names.__getitem__)
+        self._ticker_order = np.asarray(ticker_order, dtype=np.int32)
+        self._name_order = np.asarray(name_order, dtype=np.int32)
+        self._sorted_tickers = [lower_tickers[row] for row in self._ticker_order.tolist()]
+        self._sorted_names = [lower_names[row] for row in self._name_order.tolist()]
+
+        # one haystack string of all labels for substring search, offsets map a match back to its row
+        self._haystack = SEPARATOR.join(self.labels).lower()
+        self._offsets = np.cumsum([0] + [len(label) + 1 for label in self.labels[:-1]]).tolist()
+
+    @classmethod
+    def from_csv(cls, base_dir=BASE_DIR):
+        tickers, labels, names, codes = [], [], [], []
+        for code, (_, file_name) in enumerate(SOURCES):
+            df = pd.read_csv(os.path.join(base_dir, file_name), dtype=str, keep_default_na=False)
+            tickers.extend(df["Ticker"])
+            labels.extend(df["Ticker + Name"])
+            names.extend(df["Name"] if "Name" in df.columns else df["Ticker + Name"])
+            codes.extend([code] * len(df))
+        return cls(tickers, labels, names, codes)
+
+    def save(self, path=DEFAULT_INDEX_PATH, signature=""):
+        def blob(strings):
+            return np.frombuffer(SEPARATOR.join(strings).encode("utf-8"), dtype=np.uint8)
+
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, tickers=blob(self.tickers), labels=blob(self.labels), names=blob(self.names),
+                 asset_class_codes=self.asset_class_codes, ticker_order=self._ticker_order,
+                 name_order=self._name_order, signature=blob([signature]))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH):
+        # returns (universe, signature of the CSVs it was built from)
+        def strings(blob):
+            return blob.tobytes().decode("utf-8").split(SEPARATOR)
+
+        with np.load(path, allow_pickle=False) as f:
+            universe = cls(strings(f["tickers"]), strings(f["labels"]), strings(f["names"]), f["asset_class_codes"],
+                           f["ticker_order"], f["name_order"])
+            return universe, strings(f["signature"])[0]
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def _row(self, label_or_ticker):
+        row = self._by_label.get(label_or_ticker)
+        if row is None:
+            row = self._by_ticker.get(label_or_ticker)
+        if row is None:
+            raise KeyError(f"Unknown ticker: {label_or_ticker}")
+        return row
+
+    def ticker(self, label_or_ticker):
+        # "AAPL | Apple Inc. Common Stock" -> "AAPL"
+        return self.tickers[self._row(label_or_ticker)]
+
+    def asset_class(self, label_or_ticker):
+        # "stock", "etf" or "crypto"
+        return ASSET_CLASSES[self.asset_class_codes[self._row(label_or_ticker)]]
+
+    def labels_for(self, asset_class):
+        # "Ticker + Name" labels of one asset class in file order (the multiselect options)
+        code = ASSET_CLASSES.index(asset_class)
+        return [label for label, row_code in zip(self.labels, self.asset_class_codes.tolist()) if row_code == code]
+
+    def _prefix_rows(self, sorted_keys, order, prefix):
+        lo = bisect.bisect_left(sorted_keys, prefix)
+        hi = bisect.bisect_left(sorted_keys, prefix + "\U0010ffff")
+        return order[lo:hi].tolist()
+
+    def search_prefix(self, prefix, limit=50):
+        # labels whose ticker or name starts with prefix (case insensitive), ticker matches first
+        prefix = prefix.lower()
+        rows = self._prefix_rows(self._sorted_tickers, self._ticker_order, prefix)
+        rows += self._prefix_rows(self._sorted_names, self._name_order, prefix)
+        return [self.labels[row] for row in dict.fromkeys(rows)][:limit]
+
+    def search(self, text, limit=50):
+        # labels containing text anywhere in the ticker or name (case insensitive)
+        text = text.lower()
+        if not text or SEPARATOR in text:
+            return []
+        rows = []
+        position = self._haystack.find(text)
+        while position != -1 and len(rows) < limit:
+            row = bisect.bisect_right(self._offsets, position) - 1
+            rows.append(row)
+            # continue after the end of this label, a label is only reported once
+            next_label = self._offsets[row + 1] if row + 1 < len(self._offsets) else len(self._haystack)
+            position = self._haystack.find(text, next_label)
+        return [self.labels[row] for row in rows]
+
+
+def load_universe(base_dir=BASE_DIR, index_path=DEFAULT_INDEX_PATH):
+    # load the binary index, rebuilding it from the CSVs if it is missing or out of date
+    signature = _source_signature(base_dir)
+    try:
+        universe, saved_signature = TickerUniverse.load(index_path)
+        if saved_signature == signature:
+            return universe
+    except (OSError, KeyError, ValueError):
+        pass
+
+    universe = TickerUniverse.from_csv(base_dir)
+    try:
+        universe.save(index_path, signature)
+    except OSError:
+        # read-only deployment: keep working from the CSVs
+        pass
+    return universe
+
+
+def shared_universe(base_dir=BASE_DIR, index_path=DEFAULT_INDEX_PATH):
+    # one universe per process: loaded by the first caller, reloaded only when a CSV changes (the universe is
+    # read-only, every session of the app uses the same object)
+    global _SHARED
+    signature = _source_signature(base_dir)
+    with _SHARED_LOCK:
+        if _SHARED is None or _SHARED[:2] != (base_dir, signature):
+            _SHARED = (base_dir, signature, load_universe(base_dir, index_path))
+        return _SHARED[2]
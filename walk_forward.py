@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from backtest import growth_matrix
+from moments import MomentEstimator
+from optimise import max_sharpe, global_minimum_variance
+
+# WALK-FORWARD (OUT-OF-SAMPLE) BACKTEST
+# ----------------------------------------------------------------------------------------------------------------------
+# At every rebalance date the annual mean and covariance are estimated from a trailing window of log returns,
+# the portfolio is re-optimised and held (buy and hold) until the next rebalance date.
+# Weights chosen at the close of a rebalance date only use returns up to that date, so the equity curve is
+# out-of-sample. The trailing window is a rolling MomentEstimator: moving to the next rebalance date merges the new
+# returns and evicts the oldest ones instead of recomputing the covariance from scratch.
+
+REBALANCE_FREQUENCIES = {"Monthly": "M", "Quarterly": "Q"}
+
+OPTIMISERS = {
+    "Max Sharpe Ratio": max_sharpe,
+    "Min Risk": lambda mean, cov: global_minimum_variance(cov),
+}
+
+
+def constrained_optimisers(constraints):
+    # OPTIMISERS under weight constraints (see constraints.py), the same weights at every rebalance date
+    return {
+        "Max Sharpe Ratio": lambda mean, cov: max_sharpe(mean, cov, constraints),
+        "Min Risk": lambda mean, cov: global_minimum_variance(cov, constraints=constraints),
+    }
+
+
+def rebalance_positions(index, frequency):
+    # positions in index of the last trading day of every month / quarter
+    periods = pd.DatetimeIndex(index).to_period(REBALANCE_FREQUENCIES.get(frequency, frequency))
+    changes = np.flatnonzero(periods[1:] != periods[:-1])
+    return changes
+
+
+def walk_forward(prices, frequency="Monthly", lookback=252, optimisers=None, start_capital=1000,
+                 num_trading_days=252, progress=None):
+    # prices: dataframe of closing prices without NaN values (rows = trading days, cols = assets)
+    # lookback: number of daily returns in the trailing estimation window
+    # optimisers: dict of name -> function(annual mean, annual cov) returning weights, default max sharpe and min risk
+    # progress: optional function called with the number of rebalance dates done and their total before every
+    # rebalance date, an exception it raises stops the backtest (e.g. a cancelled background job, see jobs.py)
+    # returns (equity curves dataframe with one column per optimiser, dict of name -> weights dataframe)
+    if optimisers is None:
+        optimisers = OPTIMISERS
+    prices = prices.astype(np.float64)
+    gross_returns = (prices / prices.shift(1)).iloc[1:]
+    log_returns = np.log(gross_returns)
+    dates = gross_returns.index
+    gross = gross_returns.to_numpy()
+    logs = log_returns.to_numpy()
+
+    # rebalance at the end of each period, the first one once the trailing window is full
+    positions = [p for p in rebalance_positions(dates, frequency) if p + 1 >= lookback]
+    if not positions:
+        raise ValueError("Date range is too short for the selected walk-forward lookback window")
+
+    estimator = MomentEstimator(prices.columns, window=lookback)
+    estimator.add(logs[positions[0] + 1 - lookback:positions[0] + 1])
+
+    values = {name: [start_capital] for name in optimisers}
+    weights = {name: [] for name in optimisers}
+    bounds = positions + [len(dates) - 1]
+    for k, position in enumerate(positions):
+        if progress is not None:
+            progress(k, len(positions))
+        if k > 0:
+            # roll the estimation window forward to this rebalance date
+            estimator.add(logs[positions[k - 1] + 1:position + 1])
+        mean, cov = estimator.annualised(num_trading_days)
+
+        # hold the new weights from the next trading day until the next rebalance date
+        growth = growth_matrix(gross[position + 1:bounds[k + 1] + 1])[1:]
+        for name, optimiser in optimisers.items():
+            w = np.asarray(optimiser(mean.to_numpy(), cov.to_numpy()), dtype=np.float64)
+            weights[name].append(w)
+            values[name].extend(values[name][-1] * (growth @ w))
+
+    index = dates[positions[0]:]
+    curves = pd.DataFrame(values, index=index)
+    weights = {name: pd.DataFrame(w, index=dates[positions], columns=prices.columns) for name, w in weights.items()}
+    return curves, weights